@@ -0,0 +1,116 @@
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+from optparse import OptionParser
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from memento_damage.batch import CrawlDirectory
+from memento_damage.damage_analysis import MementoDamageAnalysis
+from memento_damage.timing import sum_stages
+from memento_damage.tools import rmdir_recursive
+from synthetic_crawl import DEFAULTS, generate_crawl
+
+# Measure each stage of MementoDamageAnalysis.run separately on synthetic crawl
+# directories of increasing size, one JSON line per scale is printed
+
+# Parameters multiplied by scale
+SCALED_PARAMS = ['images', 'stylesheets', 'redirects', 'videos', 'network_extra', 'words']
+
+
+def time_analysis(output_dir, options={}):
+    # Stages are measured by the analysis itself, in milliseconds
+    crawl = CrawlDirectory(output_dir, options)
+
+    analysis = MementoDamageAnalysis(crawl)
+    analysis.run()
+    with analysis.timer.measure('result'):
+        result = analysis.get_result()
+
+    return analysis.timer.to_dict(), result
+
+
+def run_benchmark(scale, params, repeat=3, options={}, keep_dir=None):
+    params = dict(params)
+    for name in SCALED_PARAMS:
+        params[name] = int(params[name] * scale)
+
+    output_dir = keep_dir or tempfile.mkdtemp()
+    try:
+        start = timer()
+        generate_crawl(output_dir, **params)
+        generate_time = round((timer() - start) * 1000, 3)
+
+        # Keep the fastest run of every stage
+        best = None
+        for _ in range(repeat):
+            timings, result = time_analysis(output_dir, options)
+            if best is None:
+                best = timings
+            else:
+                for stage, ms in timings.items():
+                    best[stage] = min(best[stage], ms)
+    finally:
+        if not keep_dir:
+            rmdir_recursive(output_dir)
+
+    return OrderedDict([
+        ('scale', scale),
+        ('params', params),
+        ('repeat', repeat),
+        ('generate_time', generate_time),
+        ('stages', best),
+        ('total_time', sum_stages(best)),
+        ('total_damage', result['total_damage']),
+    ])
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--scales",
+                      dest="scales", default="1,4,16",
+                      help="comma separated scales of synthetic crawl [default: %default]")
+    parser.add_option("-r", "--repeat",
+                      dest="repeat", type="int", default=3,
+                      help="number of runs per scale, fastest is reported [default: %default]")
+    parser.add_option("-t", "--text-measure",
+                      dest="text_measure", default="stream",
+                      type="choice", choices=["stream", "html2text", "compare"],
+                      help="word counter of text: stream, html2text, or compare "
+                           "[default: %default]")
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="append JSON lines to this file [default: stdout]")
+    for name, value in sorted(DEFAULTS.items()):
+        parser.add_option('--' + name.replace('_', '-'), dest=name, default=value,
+                          type='float' if isinstance(value, float) else 'int',
+                          help='synthetic crawl parameter [default: %default]')
+    parser.add_option("-S", "--screenshot-format",
+                      dest="screenshot_format", default="png",
+                      type="choice", choices=["png", "ppm"],
+                      help="screenshot of synthetic crawl: png, or ppm (raw pixels) "
+                           "[default: %default]")
+
+    (options, args) = parser.parse_args()
+    options = vars(options)
+
+    params = dict((name, options[name]) for name in DEFAULTS)
+    params['screenshot_format'] = options['screenshot_format']
+    out = open(options['output'], 'ab') if options['output'] else sys.stdout
+
+    for scale in options['scales'].split(','):
+        report = run_benchmark(float(scale), params, options['repeat'],
+                               {'text_measure': options['text_measure']})
+        out.write(json.dumps(report) + '\n')
+        out.flush()
+
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import json
+import os
+import random
+import sys
+from optparse import OptionParser
+
+import numpy
+from PIL import Image
+
+# Generate crawl output directory in the same formats crawl.js writes, so the
+# analysis can be measured without phantomjs and a live archive
+
+DEFAULTS = {
+    'images': 100,
+    'rectangles': 2,
+    'stylesheets': 10,
+    'rules': 500,
+    'videos': 2,
+    'redirects': 20,
+    'redirect_length': 2,
+    'network_extra': 200,
+    'words': 2000,
+    'width': 1024,
+    'height': 4000,
+    'missing_rate': 0.2,
+    'seed': 0,
+}
+
+ARCHIVE_PREFIX = 'http://web.archive.example/web/20010101000000/'
+ORIGINAL_URI = 'http://www.example.com/'
+
+
+def _network_resource(url, status_code, content_type, headers=None):
+    # Same keys as crawl.js onResourceReceived
+    return {
+        'url': url,
+        'status_code': status_code,
+        'content_type': content_type,
+        'headers': headers or {'Content-Type': content_type},
+    }
+
+
+def _rectangles(rnd, num, width, height):
+    rectangles = []
+    for _ in range(num):
+        w = rnd.randint(1, width // 3)
+        h = rnd.randint(1, 400)
+        rectangles.append({
+            'width': w,
+            'height': h,
+            'top': rnd.randint(0, max(0, height - h)),
+            'left': rnd.randint(0, max(0, width - w)),
+        })
+    return rectangles
+
+
+def generate_crawl(output_dir, screenshot_format='png', **params):
+    config = dict(DEFAULTS)
+    config.update((k, v) for k, v in params.items() if v is not None)
+    rnd = random.Random(config['seed'])
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    uri = ARCHIVE_PREFIX + ORIGINAL_URI
+    width, height = config['width'], config['height']
+
+    # The crawled page is always the first received resource
+    network = [_network_resource(uri, 200, 'text/html')]
+    images, csses, videos = [], [], []
+
+    def status():
+        return 404 if rnd.random() < config['missing_rate'] else 200
+
+    # Images, some of them are redirected to another archived resource
+    for i in range(config['images']):
+        url = '{}{}images/{}.png'.format(ARCHIVE_PREFIX, ORIGINAL_URI, i)
+        resource = _network_resource(url, status(), 'image/png')
+
+        if i < config['redirects'] and config['redirect_length'] > 0:
+            hop_url = url
+            for hop in range(config['redirect_length']):
+                next_url = '{}{}images/{}-{}.png'.format(ARCHIVE_PREFIX, ORIGINAL_URI, i, hop)
+                network.append(_network_resource(hop_url, 302, 'image/png', {'Location': next_url}))
+                hop_url = next_url
+            network.append(_network_resource(hop_url, status(), 'image/png'))
+
+            # Image log has network resource of url in the document
+            resource = network[-1 - config['redirect_length']]
+        else:
+            network.append(resource)
+
+        image = dict(resource)
+        image['rectangles'] = _rectangles(rnd, config['rectangles'], width, height)
+        image['viewport_size'] = [width, height]
+        images.append(image)
+
+    # Stylesheets, the first one is an internal <style>
+    for i in range(config['stylesheets']):
+        css = {
+            'url': '{}{}css/{}.css'.format(ARCHIVE_PREFIX, ORIGINAL_URI, i) if i else '[INTERNAL]',
+            'rules_tag': ['.rule-{}-{} > div.item'.format(i, r) for r in range(config['rules'])],
+            'hash': '{:032x}'.format(rnd.getrandbits(128)),
+            'frame': -1,
+        }
+        if i:
+            resource = _network_resource(css['url'], status(), 'text/css')
+            network.append(resource)
+            css.update(resource)
+        css['importance'] = rnd.randint(0, config['rules'])
+        csses.append(css)
+
+    for i in range(config['videos']):
+        url = '{}{}video/{}.mp4'.format(ARCHIVE_PREFIX, ORIGINAL_URI, i)
+        resource = _network_resource(url, status(), 'video/mp4')
+        network.append(resource)
+
+        video = dict(resource)
+        video['rectangles'] = _rectangles(rnd, 1, width, height)
+        video['viewport_size'] = [width, height]
+        videos.append(video)
+
+    for i in range(config['network_extra']):
+        url = '{}{}js/{}.js'.format(ARCHIVE_PREFIX, ORIGINAL_URI, i)
+        network.append(_network_resource(url, 200, 'application/javascript'))
+
+    for file_name, logs in (('network.log', network), ('image.log', images),
+                            ('css.log', csses), ('video.log', videos)):
+        with open(os.path.join(output_dir, file_name), 'wb') as f:
+            f.write('\n'.join(json.dumps(log) for log in logs))
+
+    # Source html as serialized by document.body.parentElement.outerHTML
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'archive', 'memento']
+    paragraphs = []
+    for p in range(0, config['words'], 50):
+        paragraphs.append('<p class="text">{}</p>'.format(
+            ' '.join(rnd.choice(words) for _ in range(min(50, config['words'] - p)))))
+    html = '<html><head><title>Synthetic</title><script>var a = 1;</script></head>' \
+           '<body>\n{}\n{}\n</body></html>'.format(
+               '\n'.join(paragraphs),
+               '\n'.join('<img src="{}">'.format(image['url']) for image in images))
+    with open(os.path.join(output_dir, 'source.html'), 'wb') as f:
+        f.write(html)
+
+    # Full page RGBA screenshot, white background with colored blocks. Raw
+    # screenshot (ppm) has RGB pixels only, as rendered by crawl.js
+    pixels = numpy.full((height, width, 4), 255, dtype=numpy.uint8)
+    for image in images:
+        for rect in image['rectangles']:
+            pixels[rect['top']:rect['top'] + rect['height'],
+                   rect['left']:rect['left'] + rect['width'], :3] = rnd.randint(0, 200)
+    if screenshot_format == 'ppm':
+        Image.fromarray(pixels[:, :, :3], 'RGB').save(
+            os.path.join(output_dir, 'screenshot.ppm'), format='PPM')
+    else:
+        Image.fromarray(pixels, 'RGBA').save(os.path.join(output_dir, 'screenshot.png'))
+
+    return uri
+
+
+def main():
+    parser = OptionParser()
+    parser.set_usage(parser.get_usage().replace('\n', '') + ' <output dir>')
+    for name, value in sorted(DEFAULTS.items()):
+        parser.add_option('--' + name.replace('_', '-'), dest=name, default=value,
+                          type='float' if isinstance(value, float) else 'int',
+                          help='[default: %default]')
+    parser.add_option('--screenshot-format', dest='screenshot_format', default='png',
+                      type='choice', choices=['png', 'ppm'], help='[default: %default]')
+
+    (options, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit()
+
+    print(generate_crawl(args[0], **vars(options)))
+
+
+if __name__ == "__main__":
+    main()
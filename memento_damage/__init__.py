@@ -3,19 +3,29 @@ import io
 import json
 import logging
 import os
+import re
 import sys
 import tempfile
-import time
+from collections import OrderedDict
 from datetime import datetime
 from hashlib import md5
 from optparse import OptionParser
+from timeit import default_timer
 
+from memento_damage.crawl_stream import CrawlStream, parse_message
 from memento_damage.damage_analysis import MementoDamageAnalysis
+from memento_damage.replay_proxy import phantomjs_proxy_args
+from memento_damage.resource_filter import load_filter_rules
+from memento_damage.timing import format_timing_table
+
+# Background color of page is sent as hex RGB, e.g. FFFFFF
+BACKGROUND_COLOR_PATTERN = re.compile(r'^[0-9a-fA-F]{6}$')
 
 base_dir = os.path.join(os.path.dirname(__file__))
 base_dir = os.path.abspath(base_dir)
 sys.path.insert(0, base_dir)
-from memento_damage.tools import Command, rmdir_recursive
+from memento_damage.supervisor import get_supervisor
+from memento_damage.tools import rmdir_recursive
 
 
 class MementoDamage(object):
@@ -27,9 +37,36 @@ class MementoDamage(object):
     CSS_LOG_FILE_NAME = 'css.log'
     VIDEO_LOG_FILE_NAME = 'video.log'
     SCREENSHOT_FILE_NAME = 'screenshot.png'
+    RAW_SCREENSHOT_FILE_NAME = 'screenshot.ppm'
     JSON_RESULT_FILE_NAME = 'result.json'
+    FEATURES_FILE_NAME = 'features.json'
 
     background_color = 'FFFFFF'
+    text_measure = 'stream'
+    filter_rules = None
+    renderer_pool = None
+    crawl_stream = None
+
+    # Screenshot is rendered as raw RGB pixels (ppm) and used by analysis
+    # without decoding, viewable image is only encoded when requested. Use
+    # png to render encoded image as previous versions
+    screenshot_format = 'ppm'
+
+    # Crawl is killed after crawl_timeout seconds. Single crawl.js process
+    # can be limited to memory_limit bytes of address space and cpu_limit
+    # seconds of cpu time
+    crawl_timeout = 10 * 60
+    memory_limit = None
+    cpu_limit = None
+
+    # Crawl through caching proxy 'host:port' (see replay_proxy). Renderers
+    # of the pool are given their proxy when the pool is made
+    proxy = None
+
+    # Page is processed when network has been idle for settle_quiet ms, but
+    # not later than settle_max ms after it is loaded
+    settle_quiet = 500
+    settle_max = 5000
 
     _crawljs_script = os.path.join(base_dir, 'phantomjs', 'crawl.js')
     _debug = False
@@ -37,8 +74,12 @@ class MementoDamage(object):
     _mode = 'simple'
     _follow_redirection = False
     _clean_cache = True
+    _show_timing = False
 
     _result = None
+    crawl_exit = None
+    _crawl_timing = None
+    _crawl_settle = None
 
     def __init__(self, uri, output_dir, options={}):
         self.uri = str(uri)
@@ -52,29 +93,40 @@ class MementoDamage(object):
         self.css_log_file = os.path.join(self.output_dir, self.CSS_LOG_FILE_NAME)
         self.video_log_file = os.path.join(self.output_dir, self.VIDEO_LOG_FILE_NAME)
         self.screenshot_file = os.path.join(self.output_dir, self.SCREENSHOT_FILE_NAME)
+        self.raw_screenshot_file = os.path.join(self.output_dir, self.RAW_SCREENSHOT_FILE_NAME)
         self.json_result_file = os.path.join(self.output_dir, self.JSON_RESULT_FILE_NAME)
+        self.features_file = os.path.join(self.output_dir, self.FEATURES_FILE_NAME)
 
         # options
         if 'debug' in options: self._debug = options['debug']
         if 'info' in options: self._info = options['info']
         if 'mode' in options: self._mode = options['mode']
         if 'redirect' in options: self._follow_redirection = options['redirect']
+        if 'text_measure' in options: self.text_measure = options['text_measure']
+        if 'timing' in options: self._show_timing = options['timing']
+        if options.get('blacklist'): self.filter_rules = load_filter_rules(options['blacklist'])
+        if options.get('settle_quiet') is not None: self.settle_quiet = options['settle_quiet']
+        if options.get('settle_max') is not None: self.settle_max = options['settle_max']
+        if options.get('screenshot_format'): self.screenshot_format = options['screenshot_format']
+        if options.get('memory_limit'): self.memory_limit = options['memory_limit'] * 1024 * 1024
+        if options.get('cpu_limit'): self.cpu_limit = options['cpu_limit']
+        if options.get('proxy'): self.proxy = options['proxy']
 
         # Setup logger --> to show debug verbosity
         log_formatter = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
         # To stdout
-        log_stdout_handler = logging.StreamHandler(sys.stdout)
-        log_stdout_handler.setFormatter(log_formatter)
+        self._log_stdout_handler = logging.StreamHandler(sys.stdout)
+        self._log_stdout_handler.setFormatter(log_formatter)
 
         # To file
-        log_file_handler = logging.FileHandler(self.app_log_file, mode='w')
-        log_file_handler.setFormatter(log_formatter)
+        self._log_file_handler = logging.FileHandler(self.app_log_file, mode='w')
+        self._log_file_handler.setFormatter(log_formatter)
 
         # Configure logger
         self.logger = logging.getLogger(uri)
-        self.logger.addHandler(log_file_handler)
-        self.logger.addHandler(log_stdout_handler)
+        self.logger.addHandler(self._log_file_handler)
+        self.logger.addHandler(self._log_stdout_handler)
 
         self.setup_logger()
 
@@ -86,26 +138,39 @@ class MementoDamage(object):
         else:
             self.logger.setLevel(logging.ERROR)
 
-    def log_stdout(self, out, write_fn):
-        if out and hasattr(out, 'readline'):
-            for line in iter(out.readline, b''):
-                line = line.strip()
-                write_fn(line)
-        else:
-            write_fn(out)
-
     def log_output(self, msg):
+        message = parse_message(msg)
+
+        # Crawl data (resources, html, screenshot) is only passed to the stream
+        if message and message[0] in self.crawl_stream.data_types:
+            self.crawl_stream.feed(*message)
+            return
+
+        if message:
+            msg = json.dumps({message[0]: message[1]})
+
         if self.logger.level == logging.DEBUG: self.logger.debug(msg)
         elif self.logger.level == logging.INFO: self.logger.info(msg)
 
-        if 'background_color' in msg:
-            msg = json.loads(msg)
-            if msg['background_color']:
-                self.background_color = msg['background_color']
+        if not message:
+            return
+
+        message_type, data = message
+        self.crawl_stream.feed(message_type, data)
 
-        if 'crawl_result' in msg:
-            msg = json.loads(msg)
-            crawl_result = msg['crawl_result']
+        if message_type == 'background_color':
+            if data and BACKGROUND_COLOR_PATTERN.match(data):
+                self.background_color = data.upper()
+
+        elif message_type == 'crawl_timing':
+            # Stages are sent as list of [stage, ms] to keep their order
+            self._crawl_timing = OrderedDict(data)
+
+        elif message_type == 'crawl_settle':
+            self._crawl_settle = data
+
+        elif message_type == 'crawl_result':
+            crawl_result = data
             self._crawl_result = crawl_result
 
             if crawl_result['error']:
@@ -118,52 +183,92 @@ class MementoDamage(object):
                 else:
                     self.logger.error('Choose mode "simple" or "json"')
 
-    def log_stderr(self, out, write_fn):
-        if out and hasattr(out, 'readline'):
-            for line in iter(out.readline, b''):
-                line = line.strip()
-                write_fn(line)
-        else:
-            write_fn(out)
-
     def log_error(self, msg):
         self.logger.error(msg)
 
     def run(self):
+        # Log is closed and cache is cleaned however calculation ends
+        try:
+            return self._do_calculation()
+        finally:
+            if self.crawl_stream:
+                self.crawl_stream.close()
+            self._close_log()
+            self._do_clean_cache()
+
+    def _do_calculation(self):
         self.request_time = datetime.now()
 
-        # Crawl page with phantomjs crawl.js via arguments
-        # Equivalent with console:
-        phantomjs = os.getenv('PHANTOMJS', 'phantomjs')
+        # Crawl result is streamed from crawl.js to analysis, crawl files are
+        # only written when output directory is kept
+        self.crawl_stream = CrawlStream(save_dir=None if self._clean_cache else self.output_dir)
+
+        # Same job is given to worker of renderer pool, or as argument of
+        # single crawl.js process
+        job = {
+            'uri': self.uri,
+            'output_dir': self.output_dir,
+            'redirect': self._follow_redirection,
+            'log_level': self.logger.level,
+            'settle_quiet': self.settle_quiet,
+            'settle_max': self.settle_max,
+            'screenshot_format': self.screenshot_format,
+            'stream': True
+        }
 
-        pjs_cmd = [phantomjs, '--ssl-protocol=any', self._crawljs_script, self.uri, self.output_dir,
-                   str(self._follow_redirection), str(self.logger.level)]
-        cmd = Command(pjs_cmd, pipe_stdout_callback=self.log_stdout, pipe_stderr_callback=self.log_stderr)
-        err_code = cmd.run(10 * 60,
-                           stdout_callback_args=(self.log_output, ),
-                           stderr_callback_args=(self.log_error, ))
+        crawl_start = default_timer()
 
-        if err_code != 0:
-            self.log_error('Application closed unexpectedly')
-            self._do_clean_cache()
+        # Crawl page with long-lived renderer of the pool if given, it runs
+        # the same crawl.js in worker mode
+        if self.renderer_pool:
+            self.crawl_exit = self.renderer_pool.run(job, self.log_output, self.log_error, self.crawl_timeout)
+
+        # Otherwise crawl page with phantomjs crawl.js, equivalent with console:
+        # phantomjs crawl.js <uri> <output_dir> <redirect> <log_level> ...
+        # but given as job, so the result is streamed
+        else:
+            phantomjs = os.getenv('PHANTOMJS', 'phantomjs')
+
+            pjs_cmd = [phantomjs, '--ssl-protocol=any']
+            if self.proxy:
+                pjs_cmd += phantomjs_proxy_args(self.proxy)
+            pjs_cmd += [self._crawljs_script, '--job', json.dumps(job)]
+            self.crawl_exit = get_supervisor().run(pjs_cmd, self.log_output, self.log_error,
+                                                   timeout=self.crawl_timeout,
+                                                   memory_limit=self.memory_limit,
+                                                   cpu_limit=self.cpu_limit)
+
+        crawl_time = default_timer() - crawl_start
+        self.crawl_stream.close()
+
+        if self.crawl_exit.code != 0:
+            self.log_error('Application closed unexpectedly ({})'.format(
+                self.crawl_exit.message or self.crawl_exit.reason))
+            return
+
+        if not self.crawl_stream.is_complete():
+            self.log_error('Crawl result is incomplete')
             return
 
         # get result of damage analysis
         self._result = self._do_analysis()
         self.response_time = datetime.now()
+        calculation_time = round((self.response_time - self.request_time).total_seconds(), 3)
 
-        self._result['message'] = 'Calculation is finished in {} seconds'.format(
-            (self.response_time - self.request_time).seconds)
+        self._result['message'] = 'Calculation is finished in {} seconds'.format(calculation_time)
         self._result['timer'] = {
             'request_time': (self.request_time - datetime(1970, 1, 1)).total_seconds(),
             'response_time': (self.response_time - datetime(1970, 1, 1)).total_seconds()
         }
-        self._result['calculation_time'] = (self.response_time - self.request_time).seconds
+        self._result['calculation_time'] = calculation_time
+        self._result['timing'] = self._get_timing(crawl_time, calculation_time)
+        self._result['settle'] = self._crawl_settle
 
         # Save output
         io.open(self.json_result_file, 'wb').write(json.dumps(self._result))
+        io.open(self.features_file, 'wb').write(json.dumps({
+            'uri': self.uri, 'features': self._result['features']}))
 
-        self._do_clean_cache()
         return self._result
 
     def get_result(self):
@@ -179,6 +284,27 @@ class MementoDamage(object):
             else:
                 self.logger.error('Choose mode "simple" or "json"')
 
+            # Keep stdout parseable in json mode
+            if self._show_timing:
+                out = sys.stderr if self._mode == 'json' else sys.stdout
+                out.write(format_timing_table(self._result['timing']) + '\n')
+
+    def _get_timing(self, crawl_time, calculation_time):
+        # All values in milliseconds. Phases are measured by crawl.js, the
+        # rest of phantomjs process time is reported as startup
+        crawl = OrderedDict(self._crawl_timing or {})
+        crawl_ms = round(crawl_time * 1000, 3)
+        if 'total' in crawl:
+            crawl['startup'] = round(max(crawl_ms - crawl['total'], 0), 3)
+        crawl['total'] = crawl_ms
+
+        timing = OrderedDict()
+        timing['crawl'] = crawl
+        timing['analysis'] = self._result.get('timing', {}).get('analysis', {})
+        timing['total'] = round(calculation_time * 1000, 3)
+
+        return timing
+
     def _do_analysis(self):
         # Calculate damage
         analysis = MementoDamageAnalysis(self)
@@ -186,10 +312,18 @@ class MementoDamage(object):
 
         return analysis.get_result()
 
+    def _close_log(self):
+        # Handlers are removed from logger of uri when calculation is
+        # finished, so removed or evicted log file does not stay open, and
+        # next calculation of the same uri does not log twice
+        for handler in (self._log_file_handler, self._log_stdout_handler):
+            self.logger.removeHandler(handler)
+            handler.close()
+
     def _do_clean_cache(self):
-        # Remove cache directory
+        # Remove cache directory, crawl.js has exited so nothing is writing
+        # into it anymore
         if self._clean_cache:
-            time.sleep(3)
             rmdir_recursive(self.output_dir)
 
     def set_show_debug_message(self):
@@ -206,6 +340,35 @@ class MementoDamage(object):
     def set_follow_redirection(self):
         self._follow_redirection = True
 
+    def set_text_measure(self, text_measure):
+        self.text_measure = text_measure
+
+    def set_settle_time(self, settle_quiet, settle_max):
+        self.settle_quiet = settle_quiet
+        self.settle_max = settle_max
+
+    def set_resource_limits(self, memory_limit=None, cpu_limit=None):
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+
+    def get_crawl_exit(self):
+        return self.crawl_exit
+
+    def set_screenshot_format(self, screenshot_format):
+        self.screenshot_format = screenshot_format
+
+    def set_proxy(self, proxy):
+        self.proxy = proxy
+
+    def set_renderer_pool(self, renderer_pool):
+        self.renderer_pool = renderer_pool
+
+    def set_filter_rules(self, filter_rules):
+        self.filter_rules = filter_rules
+
+    def set_show_timing(self):
+        self._show_timing = True
+
     def set_dont_clean_cache_on_finish(self):
         self._clean_cache = False
 
@@ -228,6 +391,37 @@ def main():
     parser.add_option("-L", "--redirect",
                       action="store_true", dest="redirect", default=False,
                       help="follow url redirection")
+    parser.add_option("-t", "--text-measure",
+                      dest="text_measure", default="stream",
+                      type="choice", choices=["stream", "html2text", "compare"],
+                      help="word counter of text: stream, html2text, or compare "
+                           "[default: %default]")
+    parser.add_option("-T", "--timing",
+                      action="store_true", dest="timing", default=False,
+                      help="print time spent on every crawl and analysis stage")
+    parser.add_option("-b", "--blacklist",
+                      dest="blacklist", default=None,
+                      help="JSON file of resource filter rules, added to the default ones (optional)")
+    parser.add_option("-q", "--settle-quiet",
+                      dest="settle_quiet", type="int", default=MementoDamage.settle_quiet,
+                      help="process page after network is idle for this many ms [default: %default]")
+    parser.add_option("-M", "--settle-max",
+                      dest="settle_max", type="int", default=MementoDamage.settle_max,
+                      help="process page at the latest this many ms after it is loaded "
+                           "[default: %default]")
+    parser.add_option("-S", "--screenshot-format",
+                      dest="screenshot_format", default=MementoDamage.screenshot_format,
+                      type="choice", choices=["ppm", "png"],
+                      help="screenshot format: ppm (raw pixels) or png [default: %default]")
+    parser.add_option("--memory-limit",
+                      dest="memory_limit", type="int", default=None,
+                      help="limit phantomjs to this many MB of memory (optional)")
+    parser.add_option("--cpu-limit",
+                      dest="cpu_limit", type="int", default=None,
+                      help="limit phantomjs to this many seconds of cpu time (optional)")
+    parser.add_option("--proxy",
+                      dest="proxy", default=None,
+                      help="crawl through caching proxy host:port, see memento-damage-proxy (optional)")
 
     (options, args) = parser.parse_args()
     options = vars(options)
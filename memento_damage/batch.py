@@ -0,0 +1,344 @@
+import csv
+import errno
+import json
+import logging
+import os
+import sys
+import tempfile
+from hashlib import md5
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from memento_damage import MementoDamage
+from memento_damage.damage_analysis import MementoDamageAnalysis
+from memento_damage.renderer import get_shared_renderer_pool
+from memento_damage.replay_proxy import ReplayProxy
+from memento_damage.resource_filter import load_filter_rules
+from memento_damage.tools import rmdir_recursive
+
+
+class CrawlDirectory(object):
+    # Read-only view of a crawl output directory (made with --output-dir),
+    # provides attributes needed by MementoDamageAnalysis
+    background_color = 'FFFFFF'
+    text_measure = 'stream'
+    filter_rules = None
+    crawl_stream = None
+
+    def __init__(self, output_dir, options={}):
+        self.output_dir = output_dir
+
+        self.app_log_file = os.path.join(output_dir, MementoDamage.APP_LOG_FILE_NAME)
+        self.html_file = os.path.join(output_dir, MementoDamage.HTML_FILE_NAME)
+        self.network_log_file = os.path.join(output_dir, MementoDamage.NETWORK_LOG_FILE_NAME)
+        self.image_log_file = os.path.join(output_dir, MementoDamage.IMAGE_LOG_FILE_NAME)
+        self.css_log_file = os.path.join(output_dir, MementoDamage.CSS_LOG_FILE_NAME)
+        self.video_log_file = os.path.join(output_dir, MementoDamage.VIDEO_LOG_FILE_NAME)
+        self.screenshot_file = os.path.join(output_dir, MementoDamage.SCREENSHOT_FILE_NAME)
+        self.raw_screenshot_file = os.path.join(output_dir, MementoDamage.RAW_SCREENSHOT_FILE_NAME)
+        if os.path.exists(self.raw_screenshot_file):
+            self.screenshot_file = self.raw_screenshot_file
+        self.json_result_file = os.path.join(output_dir, MementoDamage.JSON_RESULT_FILE_NAME)
+
+        if 'text_measure' in options: self.text_measure = options['text_measure']
+        if options.get('filter_rules'): self.filter_rules = options['filter_rules']
+
+        self.logger = logging.getLogger('memento_damage.batch')
+        self.uri = None
+
+        self._read_previous_result()
+
+    @classmethod
+    def is_crawl_directory(cls, files):
+        required_files = [MementoDamage.HTML_FILE_NAME, MementoDamage.NETWORK_LOG_FILE_NAME,
+                          MementoDamage.IMAGE_LOG_FILE_NAME, MementoDamage.CSS_LOG_FILE_NAME,
+                          MementoDamage.VIDEO_LOG_FILE_NAME]
+        return all(f in files for f in required_files) and \
+            (MementoDamage.SCREENSHOT_FILE_NAME in files or MementoDamage.RAW_SCREENSHOT_FILE_NAME in files)
+
+    def _read_previous_result(self):
+        # Use uri and background color of previous calculation
+        if os.path.exists(self.json_result_file):
+            with open(self.json_result_file) as f:
+                result = json.load(f)
+            self.uri = result.get('uri')
+            self.background_color = result.get('background_color', self.background_color)
+
+        # Older results do not have background color, but crawl.js prints it
+        # to app.log in debug mode
+        elif os.path.exists(self.app_log_file):
+            with open(self.app_log_file) as f:
+                for line in f:
+                    if '"background_color"' in line:
+                        msg = json.loads(line[line.index('{'):])
+                        if msg['background_color']:
+                            self.background_color = msg['background_color']
+                        break
+
+        # Crawled uri is the first resource received
+        if not self.uri:
+            with open(self.network_log_file) as f:
+                first_line = f.readline().strip()
+            if first_line:
+                self.uri = json.loads(first_line)['url']
+
+
+def find_crawl_directories(root_dir):
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        if CrawlDirectory.is_crawl_directory(filenames):
+            yield dirpath
+
+
+def analyze_crawl_directory(args):
+    # Run in worker process, return summary instead of full result to keep
+    # inter-process traffic small
+    output_dir, options = args
+    summary = {'output_dir': output_dir, 'uri': None, 'error': False}
+
+    try:
+        crawl = CrawlDirectory(output_dir, options)
+        summary['uri'] = crawl.uri
+
+        analysis = MementoDamageAnalysis(crawl)
+        analysis.run()
+        summarize_result(summary, analysis.get_result())
+    except Exception, e:
+        summary['error'] = True
+        summary['message'] = '{}: {}'.format(type(e).__name__, e)
+
+    return summary
+
+
+def crawl_uri(args):
+    # Run in worker thread, crawls share renderer pool of the process
+    uri, output_root, options = args
+    output_dir = os.path.join(output_root, md5(uri).hexdigest())
+    summary = {'output_dir': output_dir, 'uri': uri, 'error': False}
+
+    try:
+        try:
+            os.makedirs(output_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+        damage = MementoDamage(uri, output_dir, options)
+        damage.set_renderer_pool(get_shared_renderer_pool())
+        if options.get('output_dir'):
+            damage.set_dont_clean_cache_on_finish()
+
+        result = damage.run()
+        if result:
+            summarize_result(summary, result)
+        else:
+            summary['error'] = True
+            summary['message'] = 'Crawl failed'
+            if damage.get_crawl_exit():
+                summary['crawl_exit'] = damage.get_crawl_exit().to_dict()
+    except Exception, e:
+        summary['error'] = True
+        summary['message'] = '{}: {}'.format(type(e).__name__, e)
+
+    return summary
+
+
+def summarize_result(summary, result):
+    summary['total_damage'] = result['total_damage']
+    summary['potential_damage'] = result['potential_damage']
+    summary['actual_damage'] = result['actual_damage']
+    summary['features'] = result['features']
+    summary['filtered_resources'] = result['filtered_resources']
+
+
+class SummaryWriter(object):
+    components = ['total', 'image', 'css', 'multimedia', 'text']
+    columns = ['uri', 'output_dir', 'total_damage'] + \
+              ['potential_{}'.format(c) for c in components] + \
+              ['actual_{}'.format(c) for c in components] + \
+              ['error', 'message']
+
+    def __init__(self, out, output_format='jsonl'):
+        self.out = out
+        self.output_format = output_format
+
+        if self.output_format == 'csv':
+            self._csv_writer = csv.writer(out)
+            self._csv_writer.writerow(self.columns)
+
+    def write(self, summary):
+        if self.output_format == 'csv':
+            row = dict(summary)
+            for damage_type in ('potential', 'actual'):
+                damages = summary.get('{}_damage'.format(damage_type)) or {}
+                for c in self.components:
+                    row['{}_{}'.format(damage_type, c)] = damages.get(c)
+
+            self._csv_writer.writerow([self._csv_value(row.get(c)) for c in self.columns])
+        else:
+            self.out.write(json.dumps(summary) + '\n')
+
+        self.out.flush()
+
+    def _csv_value(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+
+def run_batch(root_dir, out, options={}):
+    processes = options.get('processes') or cpu_count()
+    writer = SummaryWriter(out, options.get('format') or 'jsonl')
+
+    tasks = ((output_dir, options) for output_dir in find_crawl_directories(root_dir))
+
+    # Results are written as soon as each directory is analyzed, so they
+    # never need to be held in memory together
+    num_analyzed = 0
+    pool = Pool(processes=processes)
+    try:
+        for summary in pool.imap_unordered(analyze_crawl_directory, tasks, chunksize=4):
+            writer.write(summary)
+            num_analyzed += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return num_analyzed
+
+
+def parse_uris(lines):
+    # One uri per line, or uri in the first column of csv
+    for row in csv.reader(lines):
+        if row and row[0].strip() and not row[0].startswith('#'):
+            yield row[0].strip()
+
+
+def read_uris(uris_file):
+    with open(uris_file) as f:
+        for uri in parse_uris(f):
+            yield uri
+
+
+def run_crawl_batch(uris_file, out, options={}):
+    # Renderers crawl through replay proxy if its cache dir is given, so
+    # resources shared by mementos are fetched from the archive only once
+    proxy = None
+    if options.get('replay_dir'):
+        proxy = ReplayProxy(options['replay_dir'], offline=options.get('offline')).start()
+
+    renderer_pool = get_shared_renderer_pool(size=options.get('renderers') or 2,
+                                             proxy=proxy and proxy.address)
+    writer = SummaryWriter(out, options.get('format') or 'jsonl')
+
+    # Crawl directories are removed after calculation unless output dir is given
+    output_root = options.get('output_dir') or tempfile.mkdtemp()
+    tasks = ((uri, output_root, options) for uri in read_uris(uris_file))
+
+    # Renderers do the crawl in their own processes, so a thread per
+    # renderer is enough to keep all of them busy
+    num_crawled = 0
+    pool = ThreadPool(processes=renderer_pool.size)
+    try:
+        for summary in pool.imap_unordered(crawl_uri, tasks):
+            writer.write(summary)
+            num_crawled += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        renderer_pool.close()
+        if proxy:
+            proxy.close()
+        if not options.get('output_dir'):
+            rmdir_recursive(output_root)
+
+    return num_crawled
+
+
+def main():
+    parser = OptionParser()
+    parser.set_usage(parser.get_usage().replace('\n', '') + ' <crawl dirs root or uris file>')
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="summary output file [default: stdout]")
+    parser.add_option("-f", "--format",
+                      dest="format", default="jsonl",
+                      help="summary format: jsonl or csv [default: %default]")
+    parser.add_option("-p", "--processes",
+                      dest="processes", type="int", default=None,
+                      help="number of worker processes [default: number of cores]")
+    parser.add_option("-t", "--text-measure",
+                      dest="text_measure", default="stream",
+                      type="choice", choices=["stream", "html2text", "compare"],
+                      help="word counter of text: stream, html2text, or compare "
+                           "[default: %default]")
+    parser.add_option("-b", "--blacklist",
+                      dest="blacklist", default=None,
+                      help="JSON file of resource filter rules, added to the default ones (optional)")
+    parser.add_option("-u", "--uris",
+                      action="store_true", dest="uris", default=False,
+                      help="crawl uris listed in the file (one per line or first csv column) "
+                           "instead of analyzing crawl dirs")
+    parser.add_option("-O", "--output-dir",
+                      dest="output_dir", default=None,
+                      help="keep crawl dirs of -u in this directory (optional)")
+    parser.add_option("-r", "--renderers",
+                      dest="renderers", type="int", default=2,
+                      help="number of phantomjs renderers of -u [default: %default]")
+    parser.add_option("-L", "--redirect",
+                      action="store_true", dest="redirect", default=False,
+                      help="follow url redirection of -u")
+    parser.add_option("-q", "--settle-quiet",
+                      dest="settle_quiet", type="int", default=MementoDamage.settle_quiet,
+                      help="process page of -u after network is idle for this many ms "
+                           "[default: %default]")
+    parser.add_option("-M", "--settle-max",
+                      dest="settle_max", type="int", default=MementoDamage.settle_max,
+                      help="process page of -u at the latest this many ms after it is loaded "
+                           "[default: %default]")
+    parser.add_option("--replay-dir",
+                      dest="replay_dir", default=None,
+                      help="record resources of -u in this directory and replay them "
+                           "from there in later crawls (optional)")
+    parser.add_option("--offline",
+                      action="store_true", dest="offline", default=False,
+                      help="only replay resources recorded in --replay-dir")
+
+    (options, args) = parser.parse_args()
+    options = vars(options)
+
+    if len(args) < 1:
+        parser.print_help()
+        exit()
+
+    # Rules are loaded once and sent to every worker
+    if options['blacklist']:
+        options['filter_rules'] = load_filter_rules(options['blacklist'])
+
+    if options['output_dir']:
+        options['output_dir'] = os.path.abspath(options['output_dir'])
+    if options['replay_dir']:
+        options['replay_dir'] = os.path.abspath(options['replay_dir'])
+
+    if options['uris']:
+        run_fn, source = run_crawl_batch, args[0]
+    else:
+        run_fn, source = run_batch, os.path.abspath(args[0])
+
+    if options['output']:
+        with open(options['output'], 'wb') as out:
+            run_fn(source, out, options)
+    else:
+        run_fn(source, sys.stdout, options)
+
+
+if __name__ == "__main__":
+    main()
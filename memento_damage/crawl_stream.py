@@ -0,0 +1,113 @@
+import errno
+import io
+import json
+import os
+
+from memento_damage.resource_log import NetworkLog, ElementLog, StylesheetLog
+from memento_damage.screenshot import load_screenshot_pixels
+
+# Messages of crawl.js are framed as JSON text sequence (RFC 7464): record
+# separator, {"type": ..., "data": ...}, line feed. Other stdout lines are
+# plain log messages
+RECORD_SEPARATOR = '\x1e'
+
+
+def parse_message(line):
+    # Return (type, data) of a framed message, or None for a log line
+    if not line.startswith(RECORD_SEPARATOR):
+        return None
+
+    message = json.loads(line[len(RECORD_SEPARATOR):])
+    return message['type'], message.get('data')
+
+
+class CrawlStream(object):
+    # Crawl result received from crawl.js while it is running, used by
+    # MementoDamageAnalysis instead of reading crawl files back from disk.
+    # If save_dir is given, the same files crawl.js would write are written
+    # there as messages arrive. Screenshot is always rendered into a file by
+    # crawl.js, only its path is received
+    record_types = {
+        'resource': ('network_logs', NetworkLog, 'network.log'),
+        'image': ('image_logs', ElementLog, 'image.log'),
+        'css': ('css_logs', StylesheetLog, 'css.log'),
+        'video': ('video_logs', ElementLog, 'video.log'),
+    }
+    data_types = set(record_types.keys()) | set(['html', 'screenshot_file'])
+    html_file_name = 'source.html'
+    screenshot_file_name = 'screenshot.png'
+    raw_screenshot_file_name = 'screenshot.ppm'
+
+    def __init__(self, save_dir=None):
+        self.save_dir = save_dir
+
+        self.network_logs = []
+        self.image_logs = []
+        self.css_logs = []
+        self.video_logs = []
+        self.html = None
+        self.screenshot_file = None
+
+        # Data of other messages by type, e.g. background_color, crawl_timing
+        self.messages = {}
+
+        # Every log file is written, even without records, so saved crawl is
+        # complete and logs of previous crawl in the same directory are gone
+        self._files = {}
+        if self.save_dir:
+            for attr, record_cls, file_name in self.record_types.values():
+                self._files[file_name] = open(os.path.join(self.save_dir, file_name), 'wb')
+
+    def feed(self, message_type, data):
+        if message_type in self.record_types:
+            attr, record_cls, file_name = self.record_types[message_type]
+            getattr(self, attr).append(record_cls.from_dict(data))
+            if self.save_dir:
+                self._append_line(file_name, json.dumps(data))
+
+        elif message_type == 'html':
+            self.html = data
+            if self.save_dir:
+                with io.open(os.path.join(self.save_dir, self.html_file_name), 'w',
+                             encoding='utf-8') as f:
+                    f.write(data)
+
+        elif message_type == 'screenshot_file':
+            self.screenshot_file = data
+            if self.save_dir:
+                self._remove_stale_screenshot()
+
+        else:
+            self.messages[message_type] = data
+
+    def is_complete(self):
+        return self.html is not None and self.screenshot_file is not None
+
+    def open_html(self):
+        return io.StringIO(self.html)
+
+    def screenshot_pixels(self):
+        # Raw screenshot is memory-mapped, not read into memory
+        return load_screenshot_pixels(self.screenshot_file)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def _remove_stale_screenshot(self):
+        # Screenshot of previous crawl in the other format is stale
+        for file_name in [self.screenshot_file_name, self.raw_screenshot_file_name]:
+            if os.path.basename(self.screenshot_file) == file_name:
+                continue
+            try:
+                os.unlink(os.path.join(self.save_dir, file_name))
+            except OSError, e:
+                if e.errno != errno.ENOENT: raise
+
+    def _append_line(self, file_name, line):
+        # Lines are separated as in files of crawl.js, without trailing newline
+        f = self._files[file_name]
+        if f.tell() > 0:
+            f.write('\n')
+        f.write(line)
@@ -1,10 +1,13 @@
-import io
 import json
-import math
-import urlparse
 
-import html2text
-from PIL import Image
+from memento_damage.redirection import RedirectionIndex
+from memento_damage.resource_filter import get_resource_filter
+from memento_damage.resource_log import read_logs, NetworkLog, ElementLog, \
+    StylesheetLog
+from memento_damage.scoring import score_rectangles
+from memento_damage.text_measure import text_measures
+from memento_damage.timing import StageTimer
+from memento_damage.whitespace import WhitespaceProfile
 
 
 class MementoDamageAnalysis(object):
@@ -23,47 +26,69 @@ class MementoDamageAnalysis(object):
         '[INTERNAL]'
     ]
 
+    # (link uri, rel type) of Link header, e.g. resources marked with
+    # <http://mementoweb.org/terms/donotnegotiate>; rel="type"
+    blacklisted_links = [
+        ('http://mementoweb.org/terms/donotnegotiate', 'type')
+    ]
+
     def __init__(self, memento_damage):
         self.memento_damage = memento_damage
-
-        # Read log contents
-        h = html2text.HTML2Text()
-        h.ignore_links = True
-        self._text = h.handle(u' '.join([line.strip() for line in
-                                         io.open(memento_damage.html_file, "r", encoding="utf-8").readlines()]))
-        self._logs = [json.loads(log) for log in open(memento_damage.network_log_file).readlines()]
-        self._image_logs = [json.loads(log) for log in open(memento_damage.image_log_file).readlines()]
-        self._css_logs = [json.loads(log) for log in open(memento_damage.css_log_file).readlines()]
-        self._mlm_logs = [json.loads(log) for log in open(memento_damage.video_log_file).readlines()]
+        self.timer = StageTimer()
+
+        # Use logs streamed from crawl.js, or read log contents of crawl
+        # files (e.g. when analysing a saved crawl)
+        with self.timer.measure('load'):
+            stream = memento_damage.crawl_stream
+            if stream:
+                self._logs = list(stream.network_logs)
+                self._image_logs = list(stream.image_logs)
+                self._css_logs = list(stream.css_logs)
+                self._mlm_logs = list(stream.video_logs)
+            else:
+                self._logs = list(read_logs(memento_damage.network_log_file, NetworkLog))
+                self._image_logs = list(read_logs(memento_damage.image_log_file, ElementLog))
+                self._css_logs = list(read_logs(memento_damage.css_log_file, StylesheetLog))
+                self._mlm_logs = list(read_logs(memento_damage.video_log_file, ElementLog))
         self._text_logs = {}
+        self._whitespace_profiles = {}
+        self._redirection_index = None
+        self._element_damages = None
+        self._features = {}
+        self._filtered = {}
 
         self._logger = self.memento_damage.logger
 
     def run(self):
         # Filter blacklisted uris
-        self._remove_blacklisted_uris()
-        self._resolve_uri_redirection()
+        with self.timer.measure('blacklist'):
+            self._remove_blacklisted_uris()
+        with self.timer.measure('redirect'):
+            self._resolve_uri_redirection()
 
-        self._calculate_percentage_coverage()
-        self._find_missing_uris()
+        with self.timer.measure('coverage'):
+            self._calculate_percentage_coverage()
+        with self.timer.measure('missing'):
+            self._find_missing_uris()
 
         self._logger.info('Start calculating damage...')
 
-        self._calculate_potential_damage()
-        self._calculate_actual_damage()
+        # Text and whitespace are also measured separately, inside potential
+        # and actual respectively
+        with self.timer.measure('potential'):
+            self._calculate_potential_damage()
+        with self.timer.measure('actual'):
+            self._calculate_actual_damage()
 
         self._logger.info('Done calculating damage')
 
     def get_result(self):
-        logs = {}
-        for log in self._logs:
-            logs[log['url']] = log
-
-        redirect_uris = []
-        self._follow_redirection(self.memento_damage.uri, logs, redirect_uris)
+        redirect_uris = self._follow_redirection(self.memento_damage.uri)
         final_uri, final_status_code = redirect_uris[len(redirect_uris) - 1]
 
-        if (not final_status_code) or (final_status_code != 200):
+        self._features['failed'] = (not final_status_code) or (final_status_code != 200)
+
+        if self._features['failed']:
             total_damage = 1
         elif self._potential_damage != 0:
             total_damage = self._actual_damage / self._potential_damage
@@ -75,15 +100,16 @@ class MementoDamageAnalysis(object):
 
         result = {}
         result['uri'] = self.memento_damage.uri
+        result['background_color'] = self.memento_damage.background_color
         result['weight'] = {
             'multimedia': self.multimedia_weight,
             'css': self.css_weight,
             'image': self.image_weight,
             'text': self.text_weight
         }
-        result['images'] = self._image_logs
-        result['csses'] = self._css_logs
-        result['multimedias'] = self._mlm_logs
+        result['images'] = [log.to_dict() for log in self._image_logs]
+        result['csses'] = [log.to_dict() for log in self._css_logs]
+        result['multimedias'] = [log.to_dict() for log in self._mlm_logs]
         result['text'] = self._text_logs
         result['potential_damage'] = {
             'total': self._potential_damage,
@@ -100,7 +126,10 @@ class MementoDamageAnalysis(object):
             'text': self._actual_damage_text,
         }
         result['total_damage'] = total_damage
+        result['features'] = dict(self._features)
         result['redirect_uris'] = redirect_uris
+        result['filtered_resources'] = dict(self._filtered)
+        result['timing'] = {'analysis': self.timer.to_dict()}
         result['error'] = False
         result['is_archive'] = False
 
@@ -110,74 +139,47 @@ class MementoDamageAnalysis(object):
         return json.dumps(self.get_result(), indent=4)
 
     def _remove_blacklisted_uris(self):
-        # Filter images log
-        tmp_image_logs = []
-        for log in self._image_logs:
-            is_blacklisted = False
-
-            # Check whether uri is defined in blacklisted_uris
-            for b_uri in self.blacklisted_uris:
-                if log['url'].startswith(b_uri):
-                    is_blacklisted = True
-                    break
-
-            # If not defined, check whether uri has header 'Link' containing
-            # <http://mementoweb.org/terms/donotnegotiate>; rel="type"
-            if 'Link' in log['headers'] and not is_blacklisted:
-                if log['headers']['Link'] == '<http://mementoweb.org/terms/' \
-                                             'donotnegotiate>; rel="type"':
-                    is_blacklisted = True
-
-            # If not blacklisted, put into temporary array
-            if not is_blacklisted:
-                tmp_image_logs.append(log)
-
-        self._image_logs = tmp_image_logs
-
-        # Filter csses log
-        tmp_css_logs = []
-        for log in self._css_logs:
-            is_blacklisted = False
-
-            # Check whether uri is defined in blacklisted_uris
-            for b_uri in self.blacklisted_uris:
-                if log['url'].startswith(b_uri):
-                    is_blacklisted = True
-                    break
-
-            # If not defined, check whether uri has header 'Link' containing
-            # <http://mementoweb.org/terms/donotnegotiate>; rel="type"
-            if 'headers' in log and 'Link' in log['headers'] \
-                    and not is_blacklisted:
-                if log['headers']['Link'] == '<http://mementoweb.org/terms/donotnegotiate>; rel="type"':
-                    is_blacklisted = True
-
-            # If not blacklisted, put into temporary array
-            if not is_blacklisted:
-                tmp_css_logs.append(log)
-
-        self._css_logs = tmp_css_logs
+        # Every resource class is filtered with the same compiled rules,
+        # rules given in memento_damage.filter_rules extend the defaults
+        uri_prefixes = list(self.blacklisted_uris)
+        link_rels = list(self.blacklisted_links)
+        if self.memento_damage.filter_rules:
+            uri_prefixes += self.memento_damage.filter_rules.get('uri_prefixes', [])
+            link_rels += self.memento_damage.filter_rules.get('link_rels', [])
+
+        resource_filter = get_resource_filter(uri_prefixes, link_rels)
+
+        # Crawled page itself is never filtered
+        uri = self.memento_damage.uri
+        page_uris = set([uri, uri.rstrip('/'), uri.rstrip('/') + '/'])
+
+        self._logs, self._filtered['network'] = \
+            resource_filter.filter(self._logs, page_uris)
+        self._image_logs, self._filtered['images'] = \
+            resource_filter.filter(self._image_logs)
+        self._css_logs, self._filtered['csses'] = \
+            resource_filter.filter(self._css_logs)
+        self._mlm_logs, self._filtered['multimedias'] = \
+            resource_filter.filter(self._mlm_logs)
 
         self._logger.info('Remove blacklisted URIS')
-        self._logger.info('Blacklisted URIS: {}'.format(', '.join(self.blacklisted_uris)))
+        self._logger.info('Blacklisted URIS: {}'.format(', '.join(resource_filter.uri_prefixes)))
+        self._logger.info('Filtered resources: {}'.format(', '.join(
+            '{} {}'.format(num, name) for name, num in sorted(self._filtered.items()))))
 
     def _resolve_uri_redirection(self):
-        logs = {}
-        for log in self._logs:
-            logs[log['url']] = log
-
         # Resolve redirection for image
-        self._image_logs = self._purify_logs(self._image_logs, logs)
+        self._image_logs = self._purify_logs(self._image_logs)
 
         # Resolve redirection for multimedia
-        self._mlm_logs = self._purify_logs(self._mlm_logs, logs)
+        self._mlm_logs = self._purify_logs(self._mlm_logs)
 
         # Resolve redirection for css
-        self._css_logs = self._purify_logs(self._css_logs, logs)
+        self._css_logs = self._purify_logs(self._css_logs)
 
         self._logger.info('Resolve URI redirection')
 
-    def _purify_logs(self, source_logs, logs):
+    def _purify_logs(self, source_logs):
         log_obj = {}
         for log in source_logs:
             log_obj[log['url']] = log
@@ -186,8 +188,7 @@ class MementoDamageAnalysis(object):
         for log in source_logs:
             uri = log['url']
 
-            redirect_uris = []
-            self._follow_redirection(uri, logs, redirect_uris)
+            redirect_uris = self._follow_redirection(uri)
 
             if len(redirect_uris) > 0:
                 original_uri, original_status = redirect_uris[0]
@@ -203,43 +204,20 @@ class MementoDamageAnalysis(object):
 
         return log_obj.values()
 
-    def _follow_redirection(self, uri, logs, redirect_uris):
-        uri = unicode(uri)
-        while True:
-            if uri.endswith('/'):
-                slashed_uri = uri
-                unslashed_uri = slashed_uri[:-1]
-            else:
-                unslashed_uri = uri
-                slashed_uri = uri + '/'
-
-            line = None
-            if unslashed_uri in logs.keys():
-                line = logs[unslashed_uri]
-            elif slashed_uri in logs.keys():
-                line = logs[slashed_uri]
-
-            if line:
-                status_code = line['status_code']
-                redirect_uris.append((uri, status_code))
-
-                if status_code in [301, 302]:
-                    redirect_url = line['headers']['Location']
-                    uri = urlparse.urljoin(uri, redirect_url)
-                else:
-                    break
-            else:
-                break
+    def _follow_redirection(self, uri):
+        # Network logs are indexed once, and redirection chains are memoized
+        if self._redirection_index is None:
+            self._redirection_index = RedirectionIndex(self._logs)
+
+        return self._redirection_index.follow(uri)
 
     def _calculate_percentage_coverage(self):
         # Coverage of images
         for idx, log in enumerate(self._image_logs):
             viewport_w, vieport_h = log['viewport_size']
-            image_coverage  = 0
-            for rect in log['rectangles']:
-                w = rect['width']
-                h = rect['height']
-                image_coverage += (w * h)
+            # Rectangles are [left, top, width, height]
+            rects = log['rectangles']
+            image_coverage = (rects[:, 2] * rects[:, 3]).sum()
 
             if float(viewport_w * vieport_h) > 0:
                 pct_image_coverage = float(image_coverage) / \
@@ -251,11 +229,8 @@ class MementoDamageAnalysis(object):
         # Coverage of videos
         for idx, log in enumerate(self._mlm_logs):
             viewport_w, vieport_h = log['viewport_size']
-            mlm_coverage  = 0
-            for rect in log['rectangles']:
-                w = rect['width']
-                h = rect['height']
-                mlm_coverage += (w * h)
+            rects = log['rectangles']
+            mlm_coverage = (rects[:, 2] * rects[:, 3]).sum()
 
             pct_mlm_coverage = float(mlm_coverage) / \
                                  float(viewport_w * vieport_h)
@@ -292,29 +267,9 @@ class MementoDamageAnalysis(object):
         # Image
         self._logger.info('Calculate potential damage for Image(s)')
 
-        total_images_damage = 0
-        for idx, log in enumerate(self._image_logs):
-            image_damage = self._calculate_image_damage(log)
-            # Based on measureMemento.pl line 463
-            total_location_importance = 0
-            total_size_importance = 0
-            total_image_damage = 0
-            for location_importance, size_importance, damage in image_damage:
-                total_location_importance += location_importance
-                total_size_importance += size_importance
-                total_image_damage += damage
-
-            total_images_damage += total_image_damage
-
-            self._image_logs[idx]['potential_damage'] = {
-                'location' : total_location_importance,
-                'size' : total_size_importance,
-                'total' : total_image_damage
-            }
-
-            self._logger.info('Potential damage of {} is {}'.format(log['url'], total_image_damage))
-            # print('Potential damage {} for {}'
-            #       .format(total_image_damage, log['url']))
+        image_damages, mlm_damages = self._get_element_damages()
+        total_images_damage = self._sum_element_damage(
+            self._image_logs, image_damages, 'potential_damage')
 
         # Css
         self._logger.info('Calculate potential damage for Stylesheet(s)')
@@ -339,34 +294,14 @@ class MementoDamageAnalysis(object):
         # Multimedia
         self._logger.info('Calculate potential damage for Multimedia(s)')
 
-        total_mlms_damage = 0
-        for idx, log in enumerate(self._mlm_logs):
-            css_damage = self._calculate_image_damage(log)
-            # Based on measureMemento.pl line 463
-            total_location_importance = 0
-            total_size_importance = 0
-            total_mlm_damage = 0
-            for location_importance, size_importance, damage in css_damage:
-                total_location_importance += location_importance
-                total_size_importance += size_importance
-                total_mlm_damage += damage
-
-            total_mlms_damage += total_mlm_damage
-
-            self._mlm_logs[idx]['potential_damage'] = {
-                'location' : total_location_importance,
-                'size' : total_size_importance,
-                'total' : total_mlm_damage
-            }
-
-            self._logger.info('Potential damage of {} is {}'.format(log['url'], total_mlm_damage))
-            # print('Potential damage {} for {}'
-            #       .format(total_mlm_damage, log['url']))
+        total_mlms_damage = self._sum_element_damage(
+            self._mlm_logs, mlm_damages, 'potential_damage')
 
         # Text
         self._logger.info('Calculate potential damage for Text')
 
-        num_words_of_text = len(self._text.split())
+        with self.timer.measure('text'):
+            num_words_of_text = self._count_words()
         total_text_damage = float(num_words_of_text) / self.words_per_image
 
         self._text_logs['num_words'] = num_words_of_text
@@ -378,6 +313,12 @@ class MementoDamageAnalysis(object):
         # Based on measureMemento.pl line 555
         self._logger.info('Weighting potential damage(s)')
 
+        # Keep unweighted damage, so it can be re-weighted without analysis
+        self._features['potential_image'] = total_images_damage
+        self._features['potential_css'] = total_css_damage
+        self._features['potential_multimedia'] = total_mlms_damage
+        self._features['num_words'] = num_words_of_text
+
         self._potential_image_damage = total_images_damage * self.image_weight
         self._potential_css_damage = total_css_damage * self.css_weight
         self._potential_multimedia_damage = total_mlms_damage * \
@@ -397,30 +338,9 @@ class MementoDamageAnalysis(object):
         # Images
         self._logger.info('Calculate actual damage for Image(s)')
 
-        total_images_damage = 0
-        for idx, log in enumerate(self._image_logs):
-            if log['status_code'] > 399:
-                image_damage = self._calculate_image_damage(log)
-                # Based on measureMemento.pl line 463
-                total_location_importance = 0
-                total_size_importance = 0
-                total_image_damage = 0
-                for location_importance, size_importance, damage in image_damage:
-                    total_location_importance += location_importance
-                    total_size_importance += size_importance
-                    total_image_damage += damage
-
-                total_images_damage += total_image_damage
-
-                self._image_logs[idx]['actual_damage'] = {
-                    'location' : total_location_importance,
-                    'size' : total_size_importance,
-                    'total' : total_image_damage
-                }
-
-                self._logger.info('Actual damage of {} is {}'.format(log['url'], total_image_damage))
-                # print('Actual damage {} for {}'
-                #       .format(total_image_damage, log['url']))
+        image_damages, mlm_damages = self._get_element_damages()
+        total_images_damage = self._sum_element_damage(
+            self._image_logs, image_damages, 'actual_damage', only_missing=True)
 
         # Css
         self._logger.info('Calculate actual damage for Stylesheet(s)')
@@ -445,30 +365,8 @@ class MementoDamageAnalysis(object):
         # Multimedia
         self._logger.info('Calculate actual damage for Multimedia(s)')
 
-        total_mlms_damage = 0
-        for idx, log in enumerate(self._mlm_logs):
-            if log['status_code'] > 399:
-                mlm_damage = self._calculate_image_damage(log)
-                # Based on measureMemento.pl line 463
-                total_location_importance = 0
-                total_size_importance = 0
-                total_mlm_damage = 0
-                for location_importance, size_importance, damage in mlm_damage:
-                    total_location_importance += location_importance
-                    total_size_importance += size_importance
-                    total_mlm_damage += damage
-
-                total_mlms_damage += total_mlm_damage
-
-                self._mlm_logs[idx]['actual_damage'] = {
-                    'location' : total_location_importance,
-                    'size' : total_size_importance,
-                    'total' : total_mlm_damage
-                }
-
-                self._logger.info('Actual damage of {} is {}'.format(log['url'], total_mlm_damage))
-                # print('Actual damage {} for {}'
-                #       .format(total_mlm_damage, log['url']))
+        total_mlms_damage = self._sum_element_damage(
+            self._mlm_logs, mlm_damages, 'actual_damage', only_missing=True)
 
         # Text
         total_text_damage = 0
@@ -480,6 +378,10 @@ class MementoDamageAnalysis(object):
         # Based on measureMemento.pl line 555
         self._logger.info('Weighting actual damage(s)')
 
+        self._features['actual_image'] = total_images_damage
+        self._features['actual_css'] = total_css_damage
+        self._features['actual_multimedia'] = total_mlms_damage
+
         self._actual_image_damage = total_images_damage * self.image_weight
         self._actual_css_damage = total_css_damage * self.css_weight
         self._actual_multimedia_damage = total_mlms_damage * \
@@ -491,45 +393,47 @@ class MementoDamageAnalysis(object):
 
         self._logger.info('Actual damage of {} is {}'.format('"webpage"', self._actual_damage))
 
-    def _calculate_image_damage(self, log, size_weight=0.5,
-                                centrality_weight=0.5):
-        importances = []
-
-        #im = Image.open(self.screenshot_file)
-        viewport_w, viewport_h = log['viewport_size'] #im.size
-        middle_x = viewport_w / 2
-        middle_y = viewport_h / 2
-
-        # A line in *.img.log representate an image
-        # An image can be appeared in more than one location in page
-        # Location and size is saved in 'rectangles'
-        for image_rect in log['rectangles']:
-            # Based on measureMemento.pl line 690
-            x = image_rect['left']
-            y = image_rect['top']
-            w = image_rect['width']
-            h = image_rect['height']
+    def _get_element_damages(self):
+        # Rectangles of images and multimedias are scored in one pass
+        # Potential and actual damage of a resource have the same value, so
+        # it is only computed once
+        if self._element_damages is None:
+            logs = list(self._image_logs) + list(self._mlm_logs)
+            location, size, total, counts = score_rectangles(logs)
+
+            damages = []
+            for idx in range(len(logs)):
+                if counts[idx] > 0:
+                    damages.append({
+                        'location' : float(location[idx]),
+                        'size' : float(size[idx]),
+                        'total' : float(total[idx])
+                    })
+                else:
+                    damages.append({'location' : 0, 'size' : 0, 'total' : 0})
 
-            location_importance = 0.0
-            # Based on measureMemento.pl line 703
-            if (x + w) > middle_x and x < middle_x:
-                location_importance += centrality_weight / 2;
+            num_images = len(self._image_logs)
+            self._element_damages = (damages[:num_images],
+                                     damages[num_images:])
 
-            # Based on measureMemento.pl line 715
-            if (y + h) > middle_y and y < middle_y:
-                location_importance += centrality_weight / 2;
+        return self._element_damages
 
-            if viewport_w * viewport_h > 0:
-                prop = float(w * h) / (viewport_w * viewport_h)
-            else: prop = 0
+    def _sum_element_damage(self, logs, damages, damage_key,
+                            only_missing=False):
+        total_damage = 0
+        for log, damage in zip(logs, damages):
+            if only_missing and not log['status_code'] > 399:
+                continue
 
-            size_importance = prop * size_weight
+            # Based on measureMemento.pl line 463
+            total_damage += damage['total']
+            log[damage_key] = dict(damage)
 
-            importance = location_importance + size_importance
-            importances.append((location_importance, size_importance,
-                                importance))
+            self._logger.info('{} of {} is {}'.format(
+                damage_key.replace('_', ' ').capitalize(), log['url'],
+                damage['total']))
 
-        return importances
+        return total_damage
 
     def _calculate_css_damage(self, log, tag_weight=0.5, ratio_weight=0.5,
                               is_potential=False, use_window_size = True,
@@ -563,63 +467,12 @@ class MementoDamageAnalysis(object):
 
             # Based on measureMemento.pl line 777
             if not is_potential:
-                # Code below is a subtitution for Justin's whitespace.pl
-                # Open screenshot file
-                # screenshot_file = os.path.join(self.screenshot_dir,
-                #                                '{}.png'.format(log['hash']))
-                im = Image.open(self.memento_damage.screenshot_file)
-                # Get all pixels
-                pix = im.load()
-
-                # Use vieport_size (screenshot size) or default_window_size (
-                # 1024x768)
-                if not use_window_size:
-                    window_size = im.size
-
-                window_w, windows_h = window_size
-
-                # Whiteguys is representation of pixels having same color with
-                # background color
-                whiteguys_col = {}
-
-                # Iterate over pixels in window size (e.g. 1024x768)
-                # And check whether having same color with background
-                for x in range(0,window_w):
-                    whiteguys_col.setdefault(x, 0)
-                    for y in range(0,windows_h):
-                        # Get RGBA color in each pixel
-                        #     (e.g. White -> (255,255,255,255))
-                        r_, g_, b_, a_ = pix[x,y]
-                        # Convert RGBA to Hex color
-                        #     (e.g. White -> FFFFFF)
-                        pix_hex = self._rgb2hex(r_, g_, b_)
-
-                        if pix_hex.upper() == \
-                                self.memento_damage.background_color.upper():
-                            whiteguys_col[x] += 1
-
-                # divide width into 3 parts
-                # Justin use term : low, mid, and high for 1/3 left,
-                # 1/3 midlle, and 1/3 right
-                one_third = int(math.floor(window_w/3))
-
-                # calculate whiteguys in the 1/3 left
-                leftWhiteguys = 0
-                for c in range(0,one_third):
-                    leftWhiteguys += whiteguys_col[c]
-                leftAvg = leftWhiteguys / one_third
-
-                # calculate whiteguys in the 1/3 center
-                centerWhiteguys = 0
-                for c in range(one_third,2*one_third):
-                    centerWhiteguys += whiteguys_col[c]
-                centerAvg = centerWhiteguys / one_third
-
-                # calculate whiteguys in the 1/3 right
-                rightWhiteguys = 0
-                for c in range(2*one_third,window_w):
-                    rightWhiteguys += whiteguys_col[c]
-                rightAvg = rightWhiteguys / one_third
+                # Whitespace profile only depends on screenshot and
+                # background color, so it is computed once per analysis
+                with self.timer.measure('whitespace'):
+                    leftAvg, centerAvg, rightAvg = \
+                        self._get_whitespace_profile(use_window_size,
+                                                     window_size).averages()
 
                 # Based on measureMemento.pl line 803
                 if (leftAvg + centerAvg + rightAvg) == 0:
@@ -640,5 +493,54 @@ class MementoDamageAnalysis(object):
         return (tag_importance, ratio_importance, total_importance)
 
 
+    def _count_words(self):
+        text_measure = self.memento_damage.text_measure
+
+        # Compare mode scores with streaming counter, and report difference
+        # with html2text (used by previous versions)
+        if text_measure == 'compare':
+            num_words = text_measures['stream'](self._open_html())
+            num_words_html2text = text_measures['html2text'](
+                self._open_html())
+
+            self._text_logs['num_words_html2text'] = num_words_html2text
+            self._text_logs['num_words_difference'] = \
+                num_words - num_words_html2text
+            self._logger.info('Number of words is {} (html2text: {})'.format(
+                num_words, num_words_html2text))
+        else:
+            num_words = text_measures[text_measure](self._open_html())
+
+        self._text_logs['text_measure'] = text_measure
+        return num_words
+
+    def _get_whitespace_profile(self, use_window_size=True,
+                                window_size=(1024,768)):
+        # Use vieport_size (screenshot size) or default_window_size (
+        # 1024x768)
+        if not use_window_size:
+            window_size = None
+
+        if window_size not in self._whitespace_profiles:
+            self._whitespace_profiles[window_size] = WhitespaceProfile(
+                self._open_screenshot(),
+                self.memento_damage.background_color, window_size)
+
+        return self._whitespace_profiles[window_size]
+
+    def _open_html(self):
+        # Html file path, or file-like object of streamed html
+        stream = self.memento_damage.crawl_stream
+        if stream:
+            return stream.open_html()
+        return self.memento_damage.html_file
+
+    def _open_screenshot(self):
+        # Screenshot file path, or pixels of streamed screenshot
+        stream = self.memento_damage.crawl_stream
+        if stream:
+            return stream.screenshot_pixels()
+        return self.memento_damage.screenshot_file
+
     def _rgb2hex(self, r, g, b):
         return '{:02x}{:02x}{:02x}'.format(r, g, b).upper()
\ No newline at end of file
@@ -1,48 +1,256 @@
 var system = require('system');
 var fs = require('fs');
-var page = require('webpage').create();
+var webpage = require('webpage');
 console.error = function () {
     require("system").stderr.write(Array.prototype.join.call(arguments, ' ') + '\n');
 };
 
-page.settings.webSecurityEnabled = false;
 phantom.injectJs('md5.js')
 phantom.injectJs('underscore.js')
 phantom.injectJs('mimetype.js')
 
-var networkResources = {}
+var page = null;
+// Prototype-less, so any url can be used as key
+var networkResources = Object.create(null);
 var Log = {'DEBUG': 10, 'INFO': 20}
 var starttime = Date.now();
 
+// Messages to memento_damage are printed to stdout as JSON text sequence
+// (RFC 7464): record separator, {"type": ..., "data": ...}, line feed.
+// If streamData is set (job "stream"), crawl result (resource, html, image,
+// video, css messages) is sent this way instead of written to files of
+// output_dir. Screenshot is still rendered into output_dir, and only its
+// path is sent (screenshot_file message)
+var RECORD_SEPARATOR = '\x1e';
+var streamData = false;
+
+// Screenshot is rendered as png, or as ppm (binary P6) of raw RGB pixels
+// which is used by memento_damage without decoding
+var screenshotFormats = ['png', 'ppm'];
+var screenshotFormat = 'png';
+
+function emit(type, data) {
+    console.log(RECORD_SEPARATOR + JSON.stringify({'type' : type, 'data' : data}));
+}
+
+// Time spent on every crawl phase in ms, sent as crawl_timing message of
+// [stage, ms] pairs before exiting
+var timings = {};
+var now = (typeof performance !== 'undefined' && performance.now) ?
+    function() { return performance.now(); } : function() { return Date.now(); };
+var startclock = now();
+var openclock = null;
+var loadclock = null;
+
+// In worker mode (phantomjs crawl.js --worker), jobs are read from stdin as
+// JSON lines {"uri", "output_dir", "redirect", "log_level", "settle_quiet",
+// "settle_max", "screenshot_format", "stream"}, and the end of each job is
+// sent as job_done message {"exit_code": ...}. Single job can be given as
+// phantomjs crawl.js --job <JSON>
+var workerMode = (system.args[1] === '--worker');
+var jobId = 0;
+var jobFinished = true;
+var killTimer = null;
+
+// Page is processed once network has been idle (no request in flight) for
+// settleQuiet ms after it is loaded, or at the latest settleMax ms after it
+// is loaded. Chosen settle time is sent as crawl_settle message
+var settleQuiet = 500;
+var settleMax = 5000;
+var settleResult = null;
+var inFlight = {};
+var numInFlight = 0;
+var lastNetworkActivity = null;
+
+function timeStage(stage, fn) {
+    var start = now();
+    var result = fn();
+    timings[stage] = (timings[stage] || 0) + (now() - start);
+    return result;
+}
+
+function trackRequest(id) {
+    if (!(id in inFlight)) {
+        inFlight[id] = true;
+        numInFlight += 1;
+    }
+    lastNetworkActivity = now();
+}
+
+function untrackRequest(id) {
+    if (id in inFlight) {
+        delete inFlight[id];
+        numInFlight -= 1;
+    }
+    lastNetworkActivity = now();
+}
+
+function waitForSettle(pageJobId, callback) {
+    var poll = function() {
+        // Job may have ended meanwhile
+        if (pageJobId !== jobId || jobFinished) return;
+
+        var waited = now() - loadclock;
+        var idle = now() - Math.max(lastNetworkActivity, loadclock);
+        var reason = null;
+        if (numInFlight === 0 && idle >= settleQuiet) {
+            reason = 'idle';
+        } else if (waited >= settleMax) {
+            reason = 'max';
+        }
+
+        if (!reason) {
+            window.setTimeout(poll, Math.max(1, Math.min(50, settleMax - waited)));
+            return;
+        }
+
+        settleResult = {
+            'time' : Math.round(waited * 1000) / 1000,
+            'reason' : reason,
+            'pending' : numInFlight,
+            'quiet' : settleQuiet,
+            'max' : settleMax
+        };
+        callback();
+    };
+
+    window.setTimeout(poll, 0);
+}
+
+function printTimings() {
+    timings['total'] = now() - startclock;
+    emit('crawl_timing', Object.keys(timings).map(function(stage) {
+        return [stage, Math.round(timings[stage] * 1000) / 1000];
+    }));
+    if (settleResult) emit('crawl_settle', settleResult);
+}
+
+// If in worker mode, wait for the first job
+if (workerMode) {
+    nextJob();
+}
+
 // If number of arguments after crawl.js is not 2, show message and exit phantomjs
-if (system.args.length < 3) {
-    console.error('Usage: phantomjs crawl.js <URI> <output_dir> [redirect] [log_level]');
+else if (system.args.length < 3) {
+    console.error('Usage: phantomjs crawl.js <URI> <output_dir> [redirect] [log_level] [settle_quiet] [settle_max]');
+    console.error('       phantomjs crawl.js --job <JSON>');
+    console.error('       phantomjs crawl.js --worker');
     phantom.exit(1);
 }
 
+else if (system.args[1] === '--job') {
+    startJob(JSON.parse(system.args[2]));
+}
+
 // Else, continue opening URI
 else {
     // use 1st param after crawl.js as URL input and 2nd param as output
-    url = system.args[1];
-    hashedUrl = md5(url);
-    outputDir = system.args[2];
-    followRedirect = false
-    logLevel = Log.DEBUG
+    startJob({
+        'uri' : system.args[1],
+        'output_dir' : system.args[2],
+        'redirect' : system.args.length >= 4 ? system.args[3] : false,
+        'log_level' : system.args.length >= 5 ? system.args[4] : Log.DEBUG,
+        'settle_quiet' : system.args.length >= 6 ? system.args[5] : null,
+        'settle_max' : system.args.length >= 7 ? system.args[6] : null
+    });
+}
+
+function nextJob() {
+    // Blocking read is fine, no page is open between jobs
+    var line = system.stdin.readLine();
+    if (!line) {
+        phantom.exit(0);
+        return;
+    }
 
-    if(system.args.length >= 4) {
-        followRedirect = (system.args[3].toLowerCase() == 'true' || system.args[3] == '1');
+    try {
+        var job = JSON.parse(line);
+    } catch (e) {
+        console.error('Invalid job: ' + line);
+        emit('job_done', {'exit_code' : 1});
+        window.setTimeout(nextJob, 0);
+        return;
     }
 
-    if(system.args.length >= 5) {
-        logLevel = parseInt(system.args[4])
+    startJob(job);
+}
+
+function finishJob(exitCode) {
+    // Page may finish loading more than once, only the first end counts
+    if (jobFinished) return;
+    jobFinished = true;
+    window.clearTimeout(killTimer);
+
+    if (!workerMode) {
+        phantom.exit(exitCode);
+        return;
     }
 
+    // Closing page releases its DOM, network manager and memory cache
+    var finishedPage = page;
+    page = null;
+    finishedPage.close();
+
+    emit('job_done', {'exit_code' : exitCode});
+    window.setTimeout(nextJob, 0);
+}
+
+function startJob(job) {
+    url = job['uri'];
+    hashedUrl = md5(url);
+    outputDir = job['output_dir'];
+    followRedirect = (String(job['redirect']).toLowerCase() == 'true' || job['redirect'] == '1');
+    logLevel = parseInt(job['log_level'] || Log.DEBUG);
+    settleQuiet = job['settle_quiet'] != null ? parseInt(job['settle_quiet']) : 500;
+    settleMax = job['settle_max'] != null ? parseInt(job['settle_max']) : 5000;
+    streamData = (job['stream'] === true);
+    screenshotFormat = screenshotFormats.indexOf(job['screenshot_format']) > -1 ? job['screenshot_format'] : 'png';
+
+    // Reset state of previous job
+    jobId += 1;
+    jobFinished = false;
+    networkResources = Object.create(null);
+    pageStatusCode = null;
+    isAborted = false;
+    abortMessage= '';
+    timings = {};
+    settleResult = null;
+    inFlight = {};
+    numInFlight = 0;
+    lastNetworkActivity = null;
+    starttime = Date.now();
+    startclock = now();
+    loadclock = null;
+    phantom.clearCookies();
+
+    page = createPage(jobId);
+
+    // Kill crawl.js, after 5 minutes not responding
+    killTimer = window.setTimeout(function () {
+        finishJob(1);
+    }, 5 * 60 * 1000);
+
+    // Open URI
+    if(logLevel <= Log.INFO) console.log('Start crawling URI ' + url);
+    openclock = now();
+    page.open(url);
+}
+
+function createPage(pageJobId) {
+    var page = webpage.create();
+    page.settings.webSecurityEnabled = false;
+
     // Set timeout on fetching resources to 30 seconds (can be changed)
     page.settings.resourceTimeout = 300000;
     page.onResourceTimeout = function(e) {
+        untrackRequest(e.id);
         console.error('Resource ' + e.url + ' timeout. ' + e.errorCode + ' ' + e.errorString);
     };
 
+    page.onResourceError = function(e) {
+        untrackRequest(e.id);
+    };
+
     // Use browser size 1024x768 (to be used on screenshot)
     page.viewportSize = { width: 1024, height: 777 };
 
@@ -63,10 +271,6 @@ else {
         if(logLevel <= Log.DEBUG) console.log('CONSOLE: ' + msg + ' (from line #' + lineNum + ' in "' + sourceId + '")');
     };
 
-    pageStatusCode = null;
-    isAborted = false;
-    abortMessage= '';
-
     // Request will be execute before resource received
     page.onResourceRequested = function(res, req) {
         if(!followRedirect && (pageStatusCode === 301 || pageStatusCode === 302)) {
@@ -84,6 +288,10 @@ else {
             abortMessage = '404 Not Found';
             req.abort();
         }
+
+        else {
+            trackRequest(res.id);
+        }
     };
 
     // Resource is similiar with all listed in developer tools -> network tab -> refresh
@@ -98,12 +306,12 @@ else {
         if(res.stage === 'start') {
             if(logLevel <= Log.DEBUG) console.log('Resource ' + resUrl + ' (' + res.status + ') is being received');
         } else if(res.stage === 'end') {
+            untrackRequest(res.id);
             if(logLevel <= Log.DEBUG) console.log('Resource ' + resUrl + ' (' + res.status + ') is received');
         }
 
         // Save all network resources to variable
-        // res are sometimes duplicated, so only pushed if array hasnt contains this value
-        // use underscore.js to check whether value has been contained in networkResources key
+        // res are sometimes duplicated, so only the first one is kept
         headers = {}
         res.headers.forEach(function(header) {
             headers[header['name']] = header['value'];
@@ -116,9 +324,9 @@ else {
             'headers' : headers,
         }
 
-        var networkResourcesKeys = Object.keys(networkResources);
-        if(! _.contains(networkResourcesKeys, resUrl)) {
+        if(! (resUrl in networkResources)) {
             networkResources[resUrl] = resource;
+            if(streamData) emit('resource', resource);
         }
     };
 
@@ -130,7 +338,7 @@ else {
               'error' : true,
               'message' : abortMessage
             }}));
-            phantom.exit(1);
+            finishJob(1);
         }
 
         else if (status !== 'success') {
@@ -140,19 +348,24 @@ else {
               'error' : true,
               'message' : 'Unable to load the url'
             }}));
-            phantom.exit(1);
+            finishJob(1);
         }
 
         else {
             if(logLevel <= Log.INFO) console.log('Page is loaded');
+            loadclock = now();
+            timings['page_load'] = loadclock - openclock;
 
-            // After page is opened, process page.
-            // Use setTimeout to delay process
-            // Timeout in ms, means 200 ms
-            window.setTimeout(function () {
-                if (page.injectJs('jquery-3.1.0.min.js') && page.injectJs('underscore.js')) {
+            // After page is opened and network is settled, process page.
+            waitForSettle(pageJobId, function () {
+                timings['settle'] = now() - loadclock;
+
+                var injected = timeStage('inject', function() {
+                    return page.injectJs('jquery-3.1.0.min.js') && page.injectJs('underscore.js');
+                });
+                if (injected) {
                     // Calculate bgcolor
-                    var bgcolor = getBackgroundColor();
+                    var bgcolor = timeStage('background', getBackgroundColor);
                     // If bgcolor == 000000 -> change it to white
                     if(bgcolor == '000000') {
                         page.evaluate(function() {
@@ -162,47 +375,105 @@ else {
 
                     processPage(url, outputDir);
                     // Show bgcolor
-                    if(logLevel <= Log.ERROR) console.log(JSON.stringify({'background_color' : getBackgroundColor()}));
+                    if(logLevel <= Log.ERROR) emit('background_color', getBackgroundColor());
 
                     // Set finished time
                     var finishtime = Date.now()
 
                     // Show message that crawl finished, and calculate executing time
                     if(logLevel <= Log.INFO) console.log('Crawl finished in ' + (finishtime - starttime) + ' miliseconds');
-                    if(logLevel <= Log.DEBUG) console.log(JSON.stringify({'crawl_result' : {
+                    if(logLevel <= Log.DEBUG) emit('crawl_result', {
                       'uri' : url,
                       'status_code' : pageStatusCode,
                       'error' : false,
                       'message' : 'Crawl finished in ' + (finishtime - starttime) + ' miliseconds'
-                    }}));
+                    });
 
-                    phantom.exit();
+                    printTimings();
+                    finishJob(0);
                 }
-            }, 5000);
+            });
         }
     }
 
-    // Kill crawl.js, after 5 minutes not responding
-    window.setTimeout(function () {
-        phantom.exit(1);
-    }, 5 * 60 * 1000);
+    return page;
+}
 
-    // Open URI
-    if(logLevel <= Log.INFO) console.log('Start crawling URI ' + url);
-    page.open(url);
+// Lowercase scheme and host, remove default port and fragment
+function normalizeUrl(url) {
+    var match = url.match(/^([a-z][a-z0-9+.\-]*):\/\/([^\/?#]*)([^#]*)/i);
+    if(!match) return url.split('#')[0];
 
+    var scheme = match[1].toLowerCase();
+    var host = match[2].toLowerCase();
+    if((scheme == 'http' && /:80$/.test(host)) || (scheme == 'https' && /:443$/.test(host))) {
+        host = host.replace(/:\d+$/, '');
+    }
+    return scheme + '://' + host + (match[3] || '/');
+}
+
+// Archive-rewritten url embeds the original one, e.g.
+// http://web.archive.org/web/2016im_/http://example.com/a.png
+// Return every embedded absolute url, longest first
+function embeddedUrls(url) {
+    var urls = [];
+    var pattern = /[a-z][a-z0-9+.\-]*:\/\//ig;
+    var match;
+    while((match = pattern.exec(url)) !== null) {
+        if(match.index > 0) urls.push(url.substr(match.index));
+    }
+    return urls;
+}
+
+// Join document elements (by their url) to network resources. Resource is
+// matched to element of the same url, of the same normalized url, or of
+// the original url embedded in the resource url, in that order.
+// Return map of resource url -> element url
+function matchResourcesToElements(resourceUrls, elementUrls) {
+    var exact = Object.create(null);
+    var normalized = Object.create(null);
+    elementUrls.forEach(function(elementUrl) {
+        // Element without src never matches
+        if(!elementUrl) return;
+        exact[elementUrl] = elementUrl;
+        normalized[normalizeUrl(elementUrl)] = elementUrl;
+    });
+
+    var lookup = function(url) {
+        if(url in exact) return exact[url];
+        var normalizedUrl = normalizeUrl(url);
+        if(normalizedUrl in normalized) return normalized[normalizedUrl];
+        return null;
+    };
+
+    var matches = Object.create(null);
+    resourceUrls.forEach(function(resourceUrl) {
+        var elementUrl = lookup(resourceUrl);
+
+        var suffixes = elementUrl ? [] : embeddedUrls(resourceUrl);
+        for(var i=0; i<suffixes.length && !elementUrl; i++) {
+            elementUrl = lookup(suffixes[i]);
+        }
+
+        if(elementUrl) matches[resourceUrl] = elementUrl;
+    });
+
+    return matches;
 }
 
 function processPage(url, outputDir) {
-    processNetworkResources(url, outputDir);
-    processHtml(url, outputDir);
-    processImages(url, outputDir);
-    processMultimedias(url, outputDir);
-    processCsses(url, outputDir);
-    processScreenshots(url, outputDir);
+    timeStage('network', function() { processNetworkResources(url, outputDir); });
+    timeStage('html', function() { processHtml(url, outputDir); });
+    timeStage('images', function() { processImages(url, outputDir); });
+    timeStage('multimedias', function() { processMultimedias(url, outputDir); });
+    timeStage('csses', function() { processCsses(url, outputDir); });
+    timeStage('screenshot', function() { processScreenshots(url, outputDir); });
 }
 
 function processNetworkResources(url, outputDir) {
+    // Resources have been streamed as they were received
+    if(streamData) return;
+
     resourceFile = outputDir + '/network.log';
 
     // Save all resources
@@ -227,6 +498,11 @@ function processHtml(url, outputDir) {
     var html = page.evaluate(function() {
         return document.body.parentElement.outerHTML;
     });
+    if(streamData) {
+        emit('html', html);
+        if(logLevel <= Log.INFO) console.log('Sending HTML source');
+        return;
+    }
     fs.write(htmlFile, html, "w");
 
     if(logLevel <= Log.INFO) console.log('Saving HTML source --> creating ' + htmlFile)
@@ -292,16 +568,18 @@ function processImages(url, outputDir) {
 
     // Check images url == resource url, append position if same
     var networkImages = {};
-    var docImageUrls = Object.keys(images);
+    var imageUrls = Object.keys(networkResources).filter(function(url) {
+        var contentType = networkResources[url]['content_type'];
+        return contentType && contentType.indexOf('image/') == 0;
+    });
+    var matches = matchResourcesToElements(imageUrls, Object.keys(images));
     for(url in networkResources) {
         if(networkResources[url]['content_type']) {
             if(networkResources[url]['content_type'].indexOf('image/') == 0) {
                 networkImages[url] = networkResources[url];
-                docImageUrls.forEach(function(diUrl, idx) {
-                    if(url.indexOf(diUrl) >= 0) {
-                        networkImages[url] = _.extend(networkImages[url], images[diUrl]);
-                    }
-                });
+                if(url in matches) {
+                    networkImages[url] = _.extend(networkImages[url], images[matches[url]]);
+                }
 
                 if(! ('viewport_size' in networkImages[url])) {
                     networkImages[url]['viewport_size'] = [10,10]
@@ -321,8 +599,10 @@ function processImages(url, outputDir) {
     var networkImagesKeys = Object.keys(networkImages);
     for(r=0; r<networkImagesKeys.length; r++) {
         var value = networkImages[networkImagesKeys[r]];
-        networkImagesValues.push(JSON.stringify(value));
+        if(streamData) emit('image', value);
+        else networkImagesValues.push(JSON.stringify(value));
     }
+    if(streamData) return;
 
     fs.write(resourceImageFile, networkImagesValues.join('\n'), "w");
     if(logLevel <= Log.INFO) console.log('Processing images --> creating ' + resourceImageFile)
@@ -373,18 +653,20 @@ function processMultimedias(url, outputDir) {
         return [document.body.clientWidth, document.body.clientHeight];
     });
 
-    // Check images url == resource url, append position if same
+    // Check videos url == resource url, append position if same
     var networkVideos = {};
-    var docVideoUrls = Object.keys(videos);
+    var videoUrls = Object.keys(networkResources).filter(function(url) {
+        var contentType = networkResources[url]['content_type'];
+        return contentType && contentType.indexOf('video/') == 0;
+    });
+    var matches = matchResourcesToElements(videoUrls, Object.keys(videos));
     for(url in networkResources) {
         if(networkResources[url]['content_type']) {
             if(networkResources[url]['content_type'].indexOf('video/') == 0) {
                 networkVideos[url] = networkResources[url];
-                docVideoUrls.forEach(function(dvUrl, idx) {
-                    if(url.indexOf(dvUrl) >= 0) {
-                        networkVideos[url] = _.extend(networkVideos[url], videos[dvUrl]);
-                    }
-                });
+                if(url in matches) {
+                    networkVideos[url] = _.extend(networkVideos[url], videos[matches[url]]);
+                }
 
                 if(! ('rectangles' in networkVideos[url])) {
                     networkVideos[url]['rectangles'] = []
@@ -401,8 +683,10 @@ function processMultimedias(url, outputDir) {
     var networkVideosKeys = Object.keys(networkVideos);
     for(r=0; r<networkVideosKeys.length; r++) {
         var value = networkVideos[networkVideosKeys[r]];
-        networkVideosValues.push(JSON.stringify(value));
+        if(streamData) emit('video', value);
+        else networkVideosValues.push(JSON.stringify(value));
     }
+    if(streamData) return;
 
     fs.write(resourceVideoFile, networkVideosValues.join('\n'), "w");
     if(logLevel <= Log.INFO) console.log('Processing videos --> creating ' + resourceVideoFile);
@@ -411,15 +695,101 @@ function processMultimedias(url, outputDir) {
 function processCsses(url, resourceBasename) {
     resourceCssFile = outputDir + '/css.log';
 
+    // Importance of every stylesheet is calculated in the same evaluate,
+    // instead of one evaluate per rule
     var csses = page.evaluate(function () {
+        // Elements of main document by tag name, with number of elements
+        // having each class token and each whole className. Keys are prefixed
+        // with '$' so they never clash with Object properties
+        var tagIndexes = {};
+        var idCounts = {};
+        var tagClassCounts = {};
+
+        function getTagIndex(tagName) {
+            var key = '$' + tagName;
+            if(!(key in tagIndexes)) {
+                var elems = document.getElementsByTagName(tagName);
+                var classNames = {};
+                for(var i=0; i<elems.length; i++) {
+                    var className = '$ ' + elems[i].className + ' ';
+                    classNames[className] = (classNames[className] || 0) + 1;
+                }
+
+                // Each distinct className is split once, a token is counted
+                // once per element
+                var tokens = {};
+                for(var className in classNames) {
+                    var seen = {};
+                    var parts = className.substr(1).split(' ');
+                    for(var p=0; p<parts.length; p++) {
+                        var token = '$' + parts[p];
+                        if(token in seen) continue;
+                        seen[token] = true;
+                        tokens[token] = (tokens[token] || 0) + classNames[className];
+                    }
+                }
+
+                tagIndexes[key] = {'length' : elems.length, 'classNames' : classNames, 'tokens' : tokens};
+            }
+            return tagIndexes[key];
+        }
+
+        // Number of elements of tagName whose ' ' + className + ' ' contains
+        // ' ' + className + ' ' of the rule, same as scanning every element
+        function countByTagAndClass(tagName, className) {
+            var key = '$' + tagName + ' ' + className;
+            if(!(key in tagClassCounts)) {
+                var index = getTagIndex(tagName);
+                var counter = 0;
+                if(className !== '' && className.indexOf(' ') < 0) {
+                    counter = index.tokens['$' + className] || 0;
+                } else {
+                    var needle = ' ' + className + ' ';
+                    for(var cn in index.classNames) {
+                        if(cn.substr(1).indexOf(needle) > -1) counter += index.classNames[cn];
+                    }
+                }
+                tagClassCounts[key] = counter;
+            }
+            return tagClassCounts[key];
+        }
+
+        function countById(id) {
+            var key = '$' + id;
+            if(!(key in idCounts)) {
+                idCounts[key] = document.getElementById(id) == null ? 0 : 1;
+            }
+            return idCounts[key];
+        }
+
+        function calculateImportance(rule) {
+            if(rule == undefined) {
+                return 0;
+            } else if(rule.match(/^\..*/i)) {
+                return countByTagAndClass('*', rule);
+            } else if(rule.match(/^#.*/i)) {
+                return countById(rule.split('#')[1].split(' ')[0]);
+            } else if(rule.match(/.*#.*/i)) {
+                return countById(rule);
+            } else if(rule.match(/[a-zA-Z]*\..*/g)) {
+                var theArr = rule.split('.');
+                return countByTagAndClass(theArr[0], theArr[1]);
+            } else if(!(rule.match(/\./ig))) {
+                return getTagIndex(rule).length;
+            }
+            return 0;
+        }
+
         function serialize(docCss, frameId) {
             // For each stylesheet, get its rules
             var rules = docCss.cssRules || [];
             // For each rule, get selectorText
             var rules_tag = []
+            var importance = 0;
             for(var r=0; r<rules.length; r++) {
                 var rule = rules[r].selectorText;
                 rules_tag.push(rule);
+                importance += calculateImportance(rule);
             }
 
             // Create json containing url and rules
@@ -428,6 +798,7 @@ function processCsses(url, resourceBasename) {
                 'rules_tag' : rules_tag || [],
                 'hash' : docCss.ownerNode.outerHTML,
                 'frame' : frameId,
+                'importance' : importance,
             };
 
             return jsonCss;
@@ -452,29 +823,19 @@ function processCsses(url, resourceBasename) {
 
     // Check css url == resource url, append position if same
     var networkCsses = []
-    var networkResourcesKeys = Object.keys(networkResources);
     for(var i=0; i<csses.length; i++) {
         var css = csses[i];
 
         if('hash' in css) css['hash'] = md5(css['hash']);
 
-        idx = _.indexOf(networkResourcesKeys, css['url']);
-        if(idx >= 0) {
-            var networkCss = networkResources[networkResourcesKeys[idx]];
-            css = _.extend(css, networkCss);
+        if(css['url'] in networkResources) {
+            css = _.extend(css, networkResources[css['url']]);
         }
 
-        var importance = 0;
-        if('rules_tag' in css) {
-            for(var r=0; r<css['rules_tag'].length; r++) {
-                var rule = css['rules_tag'][r];
-                importance += calculateImportance(rule);
-            }
-        } else {
+        if(! ('rules_tag' in css)) {
             css['rules_tag'] = []
         }
 
-        css['importance'] = importance;
         networkCsses.push(css);
     }
 
@@ -482,77 +843,30 @@ function processCsses(url, resourceBasename) {
     // var resourceCssFile = path.join(resourceDir, resourceBasename + '.css.log');
     networkCssValues = []
     for(r=0; r<networkCsses.length; r++) {
-        networkCssValues.push(JSON.stringify(networkCsses[r]));
+        if(streamData) emit('css', networkCsses[r]);
+        else networkCssValues.push(JSON.stringify(networkCsses[r]));
     }
+    if(streamData) return;
 
     fs.write(resourceCssFile, networkCssValues.join('\n'), "wb");
     if(logLevel <= Log.INFO) console.log('Processing stylesheets --> creating ' + resourceCssFile);
 }
 
 function processScreenshots(url, outputDir) {
-    screenshotFile = outputDir + '/screenshot.png';
+    screenshotFile = outputDir + '/screenshot.' + screenshotFormat;
+
+    // Screenshot of previous crawl is never taken for this one
+    if(fs.exists(screenshotFile)) fs.remove(screenshotFile);
 
     // Save screenshot
-    page.render(screenshotFile);
+    page.render(screenshotFile, {'format' : screenshotFormat});
     if(logLevel <= Log.INFO) console.log('Processing screenshot --> creating ' + screenshotFile);
-}
-
-function calculateImportance(rule) {
-    var importance = 0;
-
-    if(rule == undefined) {
-    } else if(rule.match(/^\..*/i)) {
-        importance += page.evaluate(getNumElementsByClass, rule);
-    } else if(rule.match(/^#.*/i)) {
-        var theArr = rule.split('#');
-        var theArr2 = theArr[1].split(' ');
-        var theGuy = theArr2[0];
-        importance += page.evaluate(getNumElementByID, theGuy);
-    } else if(rule.match(/.*#.*/i)) {
-        importance += page.evaluate(getNumElementByID, rule);
-    } else if(rule.match(/[a-zA-Z]*\..*/g)) {
-        var theArr = rule.split('.');
-        importance += page.evaluate(getNumElementsByTagAndClass, theArr[0], theArr[1]);
-    } else if(!(rule.match(/\./ig))) {
-        importance += page.evaluate(getNumElementsByTag, rule);
-    } else {
-
-    }
-
-    return importance;
-}
-
-function getNumElementsByClass(className) {
-    var counter = 0;
-    var elems = document.getElementsByTagName('*');
-    for (var i = 0; i < elems.length; i++) {
-        if((' ' + elems[i].className + ' ').indexOf(' ' + className + ' ') > -1) {
-            counter++;
-        }
-    }
-    return counter;
-}
-
-function getNumElementByID(id) {
-    var theThing = document.getElementById(id);
-    if(theThing == null)
-        return 0;
-    return 1;
-}
 
-function getNumElementsByTagAndClass(tagName, className) {
-    var counter = 0;
-    var elems = document.getElementsByTagName(tagName);
-    for (var i = 0; i < elems.length; i++) {
-        if((' ' + elems[i].className + ' ').indexOf(' ' + className + ' ') > -1) {
-            counter++;
-        }
+    // Raw screenshot of a long page is hundreds of MB, so it is not sent
+    // through stdout but read (memory-mapped) from the file
+    if(streamData && fs.exists(screenshotFile)) {
+        emit('screenshot_file', fs.absolute(screenshotFile));
     }
-    return counter;
-}
-
-function getNumElementsByTag(tagName) {
-    return document.getElementsByTagName(tagName).length;
 }
 
 function getBackgroundColor() {
@@ -0,0 +1,82 @@
+import urlparse
+
+
+class RedirectionIndex(object):
+    redirect_status_codes = (301, 302)
+
+    def __init__(self, logs):
+        # Network logs are sometimes duplicated, the last one is used
+        exact_logs = {}
+        for log in logs:
+            exact_logs[log['url']] = log
+
+        # Fold slashed and unslashed uri into one key
+        # Unslashed uri is preferred when both of them are logged
+        self._logs = {}
+        for uri in exact_logs:
+            key = self._unslash(uri)
+            if key in exact_logs:
+                self._logs[key] = exact_logs[key]
+            else:
+                self._logs[key] = exact_logs[key + '/']
+
+        # Loop-free chains can be reused as tail of other chains
+        self._chains = {}
+        self._looped_chains = {}
+
+    def get(self, uri):
+        return self._logs.get(self._unslash(uri))
+
+    def follow(self, uri):
+        # Return list of (uri, status_code) visited from uri until
+        # non-redirect status, unknown uri, or a redirection loop
+        uri = unicode(uri)
+        if uri in self._chains:
+            return list(self._chains[uri])
+        if uri in self._looped_chains:
+            return list(self._looped_chains[uri])
+
+        redirect_uris, is_looped = self._resolve_chain(uri)
+        if is_looped:
+            self._looped_chains[uri] = tuple(redirect_uris)
+        else:
+            # Memoize every tail of the chain
+            for idx in range(len(redirect_uris)):
+                tail_uri, _ = redirect_uris[idx]
+                self._chains.setdefault(tail_uri, tuple(redirect_uris[idx:]))
+
+        return redirect_uris
+
+    def _resolve_chain(self, uri):
+        redirect_uris = []
+        visited_uris = set()
+
+        while True:
+            if uri in visited_uris:
+                return redirect_uris, True
+
+            # Reuse chain which has been resolved before
+            if uri in self._chains:
+                redirect_uris.extend(self._chains[uri])
+                return redirect_uris, False
+
+            line = self.get(uri)
+            if not line:
+                return redirect_uris, False
+
+            visited_uris.add(uri)
+            status_code = line['status_code']
+            redirect_uris.append((uri, status_code))
+
+            redirect_url = None
+            if status_code in self.redirect_status_codes:
+                redirect_url = line.get('headers', {}).get('Location')
+            if not redirect_url:
+                return redirect_uris, False
+
+            uri = urlparse.urljoin(uri, redirect_url)
+
+    def _unslash(self, uri):
+        if uri.endswith('/'):
+            return uri[:-1]
+        return uri
@@ -0,0 +1,194 @@
+import atexit
+import json
+import os
+import time
+from Queue import Queue, Empty
+from subprocess import Popen, PIPE
+from threading import Thread, BoundedSemaphore, Lock
+
+from memento_damage.crawl_stream import parse_message
+from memento_damage.replay_proxy import phantomjs_proxy_args
+from memento_damage.supervisor import ProcessExit, EXIT, TIMEOUT, CRASH, NOT_FOUND, START_ERROR
+
+base_dir = os.path.abspath(os.path.dirname(__file__))
+
+
+class RendererWorker(object):
+    # Long-lived phantomjs running crawl.js in worker mode, jobs are written
+    # to its stdin and the end of each job is read from its stdout
+    def __init__(self, phantomjs, crawljs_script, proxy=None):
+        cmd = [phantomjs, '--ssl-protocol=any']
+        if proxy:
+            cmd += phantomjs_proxy_args(proxy)
+        cmd += [crawljs_script, '--worker']
+
+        # Buffered pipes, long lines (e.g. streamed screenshot) are not read
+        # byte by byte
+        self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True, bufsize=-1)
+        self.num_jobs = 0
+
+        self._stdout_lines = Queue()
+        self._stderr_fn = None
+
+        stdout_thread = Thread(target=self._read_stdout)
+        stdout_thread.daemon = True
+        stdout_thread.start()
+
+        stderr_thread = Thread(target=self._read_stderr)
+        stderr_thread.daemon = True
+        stderr_thread.start()
+
+    def run(self, job, stdout_fn, stderr_fn, timeout):
+        # Return ProcessExit of the job as single crawl.js process would
+        self._stderr_fn = stderr_fn
+        try:
+            self.process.stdin.write(json.dumps(job) + '\n')
+            self.process.stdin.flush()
+        except IOError, e:
+            stderr_fn('Renderer is not running: {}'.format(e))
+            return ProcessExit(-1, CRASH, 'Renderer is not running')
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                stderr_fn('Renderer timed out after {} seconds'.format(timeout))
+                self.close()
+                return ProcessExit(-1, TIMEOUT, 'Killed after timeout')
+
+            try:
+                line = self._stdout_lines.get(timeout=remaining)
+            except Empty:
+                continue
+
+            # Worker exited in the middle of job
+            if line is None:
+                code = self.process.wait() or -1
+                return ProcessExit(code, CRASH, 'Renderer exited with {}'.format(code))
+
+            message = parse_message(line)
+            if message and message[0] == 'job_done':
+                self.num_jobs += 1
+                self._stderr_fn = None
+                return ProcessExit(message[1]['exit_code'], EXIT)
+
+            stdout_fn(line)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def memory_usage(self):
+        # Resident memory in bytes, None if it can not be read
+        try:
+            with open('/proc/{}/status'.format(self.process.pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def close(self):
+        # Worker exits by itself when stdin is closed
+        try: self.process.stdin.close()
+        except: pass
+
+        for _ in range(10):
+            if not self.is_alive(): return
+            time.sleep(0.1)
+
+        try: self.process.kill()
+        except: pass
+        self.process.wait()
+
+    def _read_stdout(self):
+        for line in iter(self.process.stdout.readline, b''):
+            self._stdout_lines.put(line.strip())
+        self._stdout_lines.put(None)
+
+    def _read_stderr(self):
+        for line in iter(self.process.stderr.readline, b''):
+            if self._stderr_fn:
+                self._stderr_fn(line.strip())
+
+
+class RendererPool(object):
+    # Bounded pool of renderer workers shared by concurrent calculations.
+    # Workers are started when first needed, and replaced after max_jobs jobs
+    # or when they use more than max_memory bytes. All workers crawl through
+    # proxy 'host:port' if it is given
+    crawljs_script = os.path.join(base_dir, 'phantomjs', 'crawl.js')
+
+    def __init__(self, size=2, max_jobs=50, max_memory=512 * 1024 * 1024, phantomjs=None,
+                 proxy=None):
+        self.size = size
+        self.proxy = proxy
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.phantomjs = phantomjs or os.getenv('PHANTOMJS', 'phantomjs')
+
+        self._slots = BoundedSemaphore(size)
+        self._idle_workers = Queue()
+        self._closed = False
+
+    def run(self, job, stdout_fn, stderr_fn, timeout):
+        # Blocks while all workers are busy
+        self._slots.acquire()
+        try:
+            try:
+                worker = self._get_worker()
+            except OSError, e:
+                if e.errno == os.errno.ENOENT:
+                    process_exit = ProcessExit(-1, NOT_FOUND, '{} is not installed'.format(self.phantomjs))
+                else:
+                    process_exit = ProcessExit(-1, START_ERROR, str(e))
+                stderr_fn(process_exit.message)
+                return process_exit
+
+            try:
+                return worker.run(job, stdout_fn, stderr_fn, timeout)
+            finally:
+                self._put_worker(worker)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle_workers.get_nowait().close()
+            except Empty:
+                break
+
+    def _get_worker(self):
+        while True:
+            try:
+                worker = self._idle_workers.get_nowait()
+            except Empty:
+                return RendererWorker(self.phantomjs, self.crawljs_script, self.proxy)
+
+            if worker.is_alive():
+                return worker
+
+    def _put_worker(self, worker):
+        memory_usage = worker.memory_usage()
+        if self._closed or not worker.is_alive() or worker.num_jobs >= self.max_jobs or \
+                (memory_usage and memory_usage > self.max_memory):
+            worker.close()
+        else:
+            self._idle_workers.put(worker)
+
+
+_shared_pool = None
+_shared_pool_lock = Lock()
+
+
+def get_shared_renderer_pool(**kwargs):
+    # One pool per process, arguments are used when it is created
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = RendererPool(**kwargs)
+            atexit.register(_shared_pool.close)
+
+    return _shared_pool
@@ -0,0 +1,437 @@
+import BaseHTTPServer
+import SocketServer
+import errno
+import httplib
+import json
+import logging
+import os
+import socket
+import ssl
+import subprocess
+import uuid
+import zlib
+from datetime import datetime
+from optparse import OptionParser
+from threading import Thread, Lock
+from urlparse import urlsplit
+
+# Headers of a single connection, never recorded or forwarded
+HOP_BY_HOP_HEADERS = set(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                          'proxy-connection', 'te', 'trailer', 'trailers', 'transfer-encoding',
+                          'upgrade'])
+
+# Statuses of responses without body
+NO_BODY_STATUSES = (204, 304)
+
+
+def phantomjs_proxy_args(proxy):
+    # Arguments of phantomjs to crawl through proxy 'host:port'. Certificate
+    # of intercepted https is made by the proxy, so it is not verified
+    return ['--proxy={}'.format(proxy), '--proxy-type=http', '--ignore-ssl-errors=true']
+
+
+class WarcStore(object):
+    # Responses recorded as WARC/1.0 response records, each record compressed
+    # as its own gzip member so it can be read back from its offset alone.
+    # Offsets are kept in index file as JSON lines, loaded when store is opened.
+    # Body is recorded after transfer encoding is removed, with Content-Length
+    INDEX_FILE_NAME = 'index.jsonl'
+    WARC_FILE_NAME = 'replay-{:05d}.warc.gz'
+
+    # New WARC file is started when the current one grows over this size
+    max_warc_size = 1024 * 1024 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_file = os.path.join(directory, self.INDEX_FILE_NAME)
+
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+        # uri -> {'filename', 'offset', 'length', 'status'}, latest record wins
+        self._index = {}
+        self._lock = Lock()
+        self._warc_number = 0
+
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                for line in f:
+                    if not line.strip(): continue
+                    entry = json.loads(line)
+                    self._index[entry.pop('uri')] = entry
+
+        for entry in self._index.values():
+            number = int(entry['filename'].split('-')[1].split('.')[0])
+            self._warc_number = max(self._warc_number, number)
+
+        self._index_out = open(self.index_file, 'ab')
+
+    def __contains__(self, uri):
+        return uri in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, uri):
+        # Return (status, reason, headers, body) of recorded response, or None
+        entry = self._index.get(uri)
+        if not entry:
+            return None
+
+        with open(os.path.join(self.directory, entry['filename']), 'rb') as f:
+            f.seek(entry['offset'])
+            record = zlib.decompress(f.read(entry['length']), 16 + zlib.MAX_WBITS)
+
+        # Skip WARC headers, then parse HTTP response block
+        block_start = record.index('\r\n\r\n') + 4
+        head_end = record.index('\r\n\r\n', block_start)
+        head_lines = record[block_start:head_end].split('\r\n')
+
+        status_line = head_lines[0].split(' ', 2)
+        status = int(status_line[1])
+        reason = status_line[2] if len(status_line) > 2 else ''
+
+        headers = []
+        for line in head_lines[1:]:
+            name, value = line.split(':', 1)
+            headers.append((name, value.strip()))
+
+        # Record block is followed by two line breaks
+        body = record[head_end + 4:-4]
+
+        return status, reason, headers, body
+
+    def put(self, uri, status, reason, headers, body):
+        head = ['HTTP/1.1 {} {}'.format(status, reason)]
+        head += ['{}: {}'.format(name, value) for name, value in headers]
+        block = '\r\n'.join(head) + '\r\n\r\n' + body
+
+        warc_headers = [
+            'WARC/1.0',
+            'WARC-Type: response',
+            'WARC-Record-ID: <urn:uuid:{}>'.format(uuid.uuid4()),
+            'WARC-Date: {}'.format(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+            'WARC-Target-URI: {}'.format(uri),
+            'Content-Type: application/http; msgtype=response',
+            'Content-Length: {}'.format(len(block)),
+        ]
+        record = '\r\n'.join(warc_headers) + '\r\n\r\n' + block + '\r\n\r\n'
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(record) + compressor.flush()
+
+        with self._lock:
+            filename = self.WARC_FILE_NAME.format(self._warc_number)
+            warc_file = os.path.join(self.directory, filename)
+            if os.path.exists(warc_file) and os.path.getsize(warc_file) > self.max_warc_size:
+                self._warc_number += 1
+                filename = self.WARC_FILE_NAME.format(self._warc_number)
+                warc_file = os.path.join(self.directory, filename)
+
+            with open(warc_file, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+
+            # Index is written after record, so it never points to partial one
+            entry = {'filename': filename, 'offset': offset, 'length': len(data), 'status': status}
+            self._index_out.write(json.dumps(dict(entry, uri=uri)) + '\n')
+            self._index_out.flush()
+            self._index[uri] = entry
+
+    def close(self):
+        with self._lock:
+            self._index_out.close()
+
+
+class ReplayProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Origin of requests after CONNECT is intercepted, e.g. https://host
+    tunnel_origin = None
+
+    def handle(self):
+        # Clients often close intercepted connections without TLS close_notify
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except (ssl.SSLError, socket.error), e:
+            self.server.logger.debug('Connection closed: %s', e)
+
+    def do_GET(self):
+        uri = self._request_uri()
+        if uri is None:
+            return
+
+        # Partial responses are not recorded
+        if self.headers.get('Range'):
+            return self._forward(uri)
+
+        store = self.server.store
+        response = store.get(uri)
+        if response:
+            self.server.logger.debug('Replay %s', uri)
+            return self._reply(*response)
+
+        if self.server.offline:
+            return self._reply(504, 'Gateway Timeout', [('Content-Type', 'text/plain')],
+                               'Not recorded: {}'.format(uri))
+
+        response = self._fetch(uri)
+        if response:
+            self.server.logger.debug('Record %s', uri)
+            store.put(uri, *response)
+            self._reply(*response)
+
+    def do_HEAD(self):
+        uri = self._request_uri()
+        if uri is not None:
+            self._forward(uri)
+
+    def do_POST(self):
+        uri = self._request_uri()
+        if uri is not None:
+            self._forward(uri)
+
+    do_PUT = do_DELETE = do_OPTIONS = do_PATCH = do_POST
+
+    def do_CONNECT(self):
+        host, _, port = self.path.partition(':')
+        port = int(port or 443)
+
+        if not self.server.ssl_context:
+            return self._tunnel(host, port)
+
+        # Connection is taken over as TLS server, requests inside are handled
+        # as the ones of plain proxy
+        self.wfile.write('{} 200 Connection established\r\n\r\n'.format(self.protocol_version))
+        self.wfile.flush()
+        try:
+            self.connection = self.server.ssl_context.wrap_socket(self.connection, server_side=True)
+        except (ssl.SSLError, socket.error), e:
+            self.server.logger.debug('TLS handshake with client failed: %s', e)
+            self.close_connection = 1
+            return
+
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = self.connection.makefile('wb', self.wbufsize)
+        self.tunnel_origin = 'https://' + (host if port == 443 else '{}:{}'.format(host, port))
+        self.close_connection = 0
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format, *args)
+
+    def _request_uri(self):
+        if self.tunnel_origin:
+            return self.tunnel_origin + self.path
+        if self.path.startswith('http://') or self.path.startswith('https://'):
+            return self.path
+
+        self.send_error(400, 'Absolute URI is required')
+        return None
+
+    def _fetch(self, uri):
+        # Return (status, reason, headers, body) from origin, redirects are
+        # recorded as they are. None if origin can not be reached
+        parts = urlsplit(uri)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if parts.scheme == 'https':
+            connection = httplib.HTTPSConnection(parts.hostname, parts.port, timeout=self.server.fetch_timeout,
+                                                 context=ssl._create_unverified_context())
+        else:
+            connection = httplib.HTTPConnection(parts.hostname, parts.port, timeout=self.server.fetch_timeout)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(length) if length else None
+
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'host')
+        try:
+            connection.request(self.command, path, request_body, headers)
+            response = connection.getresponse()
+            body = response.read() if self.command != 'HEAD' else ''
+        except (socket.error, httplib.HTTPException, ssl.SSLError), e:
+            self.server.logger.debug('Fetch of %s failed: %s', uri, e)
+            self._reply(502, 'Bad Gateway', [('Content-Type', 'text/plain')],
+                        'Fetch failed: {}'.format(e))
+            return None
+        finally:
+            connection.close()
+
+        # Headers are kept in order and repeated headers (e.g. Set-Cookie)
+        # are kept as they are
+        headers = []
+        for line in response.msg.headers:
+            if line[:1] in ' \t' and headers:
+                headers[-1] = (headers[-1][0], headers[-1][1] + ' ' + line.strip())
+                continue
+            name, _, value = line.partition(':')
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length':
+                headers.append((name, value.strip()))
+
+        return response.status, response.reason, headers, body
+
+    def _forward(self, uri):
+        response = self._fetch(uri)
+        if response:
+            self._reply(*response)
+
+    def _reply(self, status, reason, headers, body):
+        self.log_request(status)
+        self.wfile.write('{} {} {}\r\n'.format(self.protocol_version, status, reason))
+        for name, value in headers:
+            self.wfile.write('{}: {}\r\n'.format(name, value))
+
+        if status not in NO_BODY_STATUSES:
+            self.wfile.write('Content-Length: {}\r\n'.format(len(body)))
+        self.wfile.write('\r\n')
+
+        if self.command != 'HEAD' and status not in NO_BODY_STATUSES:
+            self.wfile.write(body)
+        self.wfile.flush()
+
+    def _tunnel(self, host, port):
+        # Bytes are passed in both ways, nothing is recorded
+        try:
+            upstream = socket.create_connection((host, port), timeout=self.server.fetch_timeout)
+        except socket.error, e:
+            return self.send_error(502, 'Connect failed: {}'.format(e))
+
+        self.wfile.write('{} 200 Connection established\r\n\r\n'.format(self.protocol_version))
+        self.wfile.flush()
+
+        def pipe(source, destination):
+            try:
+                while True:
+                    data = source.recv(64 * 1024)
+                    if not data: break
+                    destination.sendall(data)
+            except socket.error:
+                pass
+            finally:
+                try: destination.shutdown(socket.SHUT_WR)
+                except socket.error: pass
+
+        upstream.settimeout(None)
+        self.connection.settimeout(None)
+        thread = Thread(target=pipe, args=(upstream, self.connection))
+        thread.daemon = True
+        thread.start()
+        pipe(self.connection, upstream)
+        thread.join()
+        upstream.close()
+        self.close_connection = 1
+
+
+class ReplayProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ReplayProxy(object):
+    # Caching HTTP proxy for phantomjs. GET responses, including 4xx and 5xx,
+    # are recorded into WARC files of cache_dir on first request and replayed
+    # from there afterwards. In offline mode, responses not recorded get 504.
+    # https is intercepted with self-signed certificate made by openssl, or
+    # tunneled without recording if it can not be made
+    CERT_FILE_NAME = 'proxy-cert.pem'
+    KEY_FILE_NAME = 'proxy-key.pem'
+
+    # Seconds to wait for origin
+    timeout = 30
+
+    def __init__(self, cache_dir, host='127.0.0.1', port=0, offline=False):
+        self.logger = logging.getLogger('memento_damage.replay_proxy')
+        self.store = WarcStore(cache_dir)
+
+        self.server = ReplayProxyServer((host, port), ReplayProxyHandler)
+        self.server.store = self.store
+        self.server.offline = offline
+        self.server.fetch_timeout = self.timeout
+        self.server.logger = self.logger
+        self.server.ssl_context = self._make_ssl_context(cache_dir)
+
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return '{}:{}'.format(host, port)
+
+    def start(self):
+        # Serve in background thread
+        self._thread = Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        if self._thread:
+            self.server.shutdown()
+            self._thread = None
+        self.server.server_close()
+        self.store.close()
+
+    def _make_ssl_context(self, cache_dir):
+        cert_file = os.path.join(cache_dir, self.CERT_FILE_NAME)
+        key_file = os.path.join(cache_dir, self.KEY_FILE_NAME)
+
+        if not os.path.exists(cert_file):
+            try:
+                subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                       '-days', '3650', '-subj', '/CN=memento-damage replay proxy',
+                                       '-keyout', key_file, '-out', cert_file],
+                                      stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
+            except (OSError, subprocess.CalledProcessError), e:
+                self.logger.warning('https is not recorded, certificate can not be made: %s', e)
+                return None
+
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(cert_file, key_file)
+        return context
+
+
+def main():
+    parser = OptionParser()
+    parser.set_usage(parser.get_usage().replace('\n', '') + ' <cache dir>')
+    parser.add_option("-H", "--host",
+                      dest="host", default='127.0.0.1',
+                      help="host of proxy [default: %default]")
+    parser.add_option("-P", "--port",
+                      dest="port", type="int", default=8081,
+                      help="port of proxy [default: %default]")
+    parser.add_option("--offline",
+                      action="store_true", dest="offline", default=False,
+                      help="only replay recorded responses, never fetch from origin")
+    parser.add_option("-d", "--debug",
+                      action="store_true", dest="debug", default=False,
+                      help="print every request")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
+        exit()
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    proxy = ReplayProxy(os.path.abspath(args[0]), options.host, options.port, options.offline)
+    proxy.logger.info('Proxy on %s with %d recorded responses, crawl with '
+                      'memento-damage --proxy %s', proxy.address, len(proxy.store), proxy.address)
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import csv
+import json
+import os
+import sys
+from optparse import OptionParser
+
+import numpy
+
+from memento_damage import MementoDamage
+from memento_damage.damage_analysis import MementoDamageAnalysis
+
+# Unweighted damage of a memento, total damage under any weight profile can
+# be calculated from these values without re-running the analysis
+FEATURE_NAMES = ['potential_image', 'potential_css', 'potential_multimedia', 'num_words',
+                 'actual_image', 'actual_css', 'actual_multimedia', 'failed']
+
+
+def make_weight_profile(multimedia=None, css=None, image=None, text=None,
+                        words_per_image=None, proportion=None):
+    # Missing weights are derived the same way as MementoDamageAnalysis does
+    if multimedia is None: multimedia = MementoDamageAnalysis.multimedia_weight
+    if css is None: css = MementoDamageAnalysis.css_weight
+    if proportion is None: proportion = MementoDamageAnalysis.proportion
+    if image is None: image = proportion * (1 - (multimedia + css))
+    if text is None: text = 1.0 - (multimedia + css + image)
+    if words_per_image is None: words_per_image = MementoDamageAnalysis.words_per_image
+
+    return {
+        'multimedia': multimedia,
+        'css': css,
+        'image': image,
+        'text': text,
+        'words_per_image': words_per_image
+    }
+
+
+def features_from_result(result):
+    # Results saved before features were introduced only have weighted damage
+    if 'features' in result:
+        return result['features']
+
+    weight = result['weight']
+    features = {}
+    for damage_type in ('potential', 'actual'):
+        for component in ('image', 'css', 'multimedia'):
+            damage = result['{}_damage'.format(damage_type)][component]
+            features['{}_{}'.format(damage_type, component)] = \
+                damage / weight[component] if weight[component] else 0.0
+
+    features['num_words'] = result['text']['num_words']
+
+    redirect_uris = result.get('redirect_uris') or []
+    final_status_code = redirect_uris[-1][1] if redirect_uris else None
+    features['failed'] = (not final_status_code) or (final_status_code != 200)
+
+    return features
+
+
+class FeatureMatrix(object):
+    def __init__(self, uris, features):
+        self.uris = list(uris)
+        self.matrix = numpy.array([[float(f[name]) for name in FEATURE_NAMES] for f in features],
+                                  dtype=numpy.float64).reshape(-1, len(FEATURE_NAMES))
+
+    def rescore(self, profiles):
+        # Total damage of every memento (rows) under every profile (columns)
+        potential_weights = numpy.array([[p['image'], p['css'], p['multimedia'],
+                                          float(p['text']) / p['words_per_image']]
+                                         for p in profiles]).T
+        actual_weights = numpy.array([[p['image'], p['css'], p['multimedia']]
+                                      for p in profiles]).T
+
+        potential = self.matrix[:, 0:4].dot(potential_weights)
+        actual = self.matrix[:, 4:7].dot(actual_weights)
+
+        # Based on MementoDamageAnalysis.get_result
+        total = numpy.zeros_like(potential)
+        numpy.divide(actual, potential, out=total, where=potential != 0)
+        total[self.matrix[:, 7] != 0] = 1
+
+        return total
+
+
+def iter_stored_features(source):
+    # Source is either JSONL file (e.g. memento-damage-batch output) or root
+    # directory containing features.json or result.json of crawls
+    if os.path.isfile(source):
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line: continue
+
+                row = json.loads(line)
+                if row.get('features'):
+                    yield row['uri'], row['features']
+        return
+
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        if MementoDamage.FEATURES_FILE_NAME in filenames:
+            with open(os.path.join(dirpath, MementoDamage.FEATURES_FILE_NAME)) as f:
+                row = json.load(f)
+            yield row['uri'], row['features']
+        elif MementoDamage.JSON_RESULT_FILE_NAME in filenames:
+            with open(os.path.join(dirpath, MementoDamage.JSON_RESULT_FILE_NAME)) as f:
+                result = json.load(f)
+            if result and not result.get('error'):
+                yield result['uri'], features_from_result(result)
+
+
+def load_weight_profiles(profiles_file):
+    # Profiles file is JSON object of {name: weights} or list of weights
+    with open(profiles_file) as f:
+        profiles = json.load(f)
+
+    return parse_weight_profiles(profiles)
+
+
+def parse_weight_profiles(profiles):
+    if isinstance(profiles, list):
+        profiles = dict(('profile_{}'.format(i), p) for i, p in enumerate(profiles))
+
+    names = sorted(profiles.keys())
+    return names, [make_weight_profile(**dict((str(k), v) for k, v in profiles[n].items()))
+                   for n in names]
+
+
+def main():
+    parser = OptionParser()
+    parser.set_usage(parser.get_usage().replace('\n', '') + ' <crawl dirs root or features jsonl>')
+    parser.add_option("-w", "--weights",
+                      dest="weights", default=None,
+                      help="JSON file of weight profiles (optional)")
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="output file [default: stdout]")
+    parser.add_option("-f", "--format",
+                      dest="format", default="jsonl",
+                      help="output format: jsonl or csv [default: %default]")
+
+    (options, args) = parser.parse_args()
+    options = vars(options)
+
+    if len(args) < 1:
+        parser.print_help()
+        exit()
+
+    if options['weights']:
+        names, profiles = load_weight_profiles(options['weights'])
+    else:
+        names, profiles = ['default'], [make_weight_profile()]
+
+    uris, features = [], []
+    for uri, f in iter_stored_features(args[0]):
+        uris.append(uri)
+        features.append(f)
+
+    total = FeatureMatrix(uris, features).rescore(profiles)
+
+    out = open(options['output'], 'wb') if options['output'] else sys.stdout
+    if options['format'] == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(['uri'] + names)
+        for uri, row in zip(uris, total.tolist()):
+            writer.writerow([uri.encode('utf-8')] + row)
+    else:
+        for uri, row in zip(uris, total.tolist()):
+            out.write(json.dumps({'uri': uri, 'total_damage': dict(zip(names, row))}) + '\n')
+
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
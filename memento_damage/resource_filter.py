@@ -0,0 +1,107 @@
+import json
+import re
+
+# Link header is comma separated list of <uri>; param=value; ...
+LINK_PATTERN = re.compile(r'<([^>]*)>((?:\s*;\s*(?:"[^"]*"|[^;,<"])+)*)')
+REL_PATTERN = re.compile(r';\s*rel\s*=\s*(?:"([^"]*)"|([^\s;,]+))', re.I)
+
+
+def parse_link_header(value):
+    # Return list of (uri, [rel types])
+    links = []
+    for uri, params in LINK_PATTERN.findall(value):
+        rel = REL_PATTERN.search(params)
+        rels = (rel.group(1) or rel.group(2) or '').lower().split() if rel else []
+        links.append((uri.strip(), rels))
+    return links
+
+
+def compile_prefixes(prefixes):
+    # Prefixes are merged into a trie and written as one regex, so a uri is
+    # matched in a single scan however many prefixes there are
+    if not prefixes:
+        return None
+
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        # Longer prefixes are redundant once a shorter one has ended
+        if '' in node:
+            return ''
+
+        alternatives = [re.escape(char) + pattern(child)
+                        for char, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:{})'.format('|'.join(alternatives))
+
+    return re.compile(pattern(trie))
+
+
+class ResourceFilter(object):
+    def __init__(self, uri_prefixes=(), link_rels=()):
+        # link_rels is list of (link uri, rel type), uri None matches any link
+        self.uri_prefixes = sorted(set(uri_prefixes))
+        self.link_rels = set((uri, rel.lower()) for uri, rel in link_rels)
+        self._link_rel_types = set(rel for _, rel in self.link_rels)
+
+        self._prefix_pattern = compile_prefixes(self.uri_prefixes)
+
+    def match(self, log):
+        # Return reason of filtering log, or None if it is kept
+        if self._prefix_pattern and self._prefix_pattern.match(log['url']):
+            return 'uri'
+
+        if self.link_rels:
+            link = (log.get('headers') or {}).get('Link')
+            if link and self._match_link(link):
+                return 'link'
+
+        return None
+
+    def filter(self, logs, keep_uris=()):
+        # Return (kept logs, number of filtered logs)
+        kept = [log for log in logs
+                if log['url'] in keep_uris or not self.match(log)]
+        return kept, len(logs) - len(kept)
+
+    def _match_link(self, value):
+        for uri, rels in parse_link_header(value):
+            for rel in rels:
+                if rel in self._link_rel_types and \
+                        ((uri, rel) in self.link_rels or (None, rel) in self.link_rels):
+                    return True
+        return False
+
+
+_compiled_filters = {}
+
+
+def get_resource_filter(uri_prefixes=(), link_rels=()):
+    # Filter is compiled once per process for every set of rules
+    key = (tuple(sorted(set(uri_prefixes))), tuple(sorted(set(link_rels))))
+    if key not in _compiled_filters:
+        _compiled_filters[key] = ResourceFilter(*key)
+
+    return _compiled_filters[key]
+
+
+def load_filter_rules(rules_file):
+    # Rules file is JSON object of
+    # {"uri_prefixes": [...], "link_rels": [{"uri": ..., "rel": ...}, ...]}
+    with open(rules_file) as f:
+        rules = json.load(f)
+
+    unknown_keys = set(rules.keys()) - set(['uri_prefixes', 'link_rels'])
+    if unknown_keys:
+        raise ValueError('Unknown filter rules: {}'.format(', '.join(sorted(unknown_keys))))
+
+    return {
+        'uri_prefixes': [unicode(prefix) for prefix in rules.get('uri_prefixes', [])],
+        'link_rels': [(link.get('uri'), link['rel']) for link in rules.get('link_rels', [])],
+    }
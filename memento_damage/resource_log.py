@@ -0,0 +1,104 @@
+import json
+
+import numpy
+
+
+class ResourceLog(object):
+    # Only fields read by damage analysis are kept, others (e.g. rules_tag,
+    # hash, frame, unused headers) are dropped while reading log file
+    __slots__ = ('url', 'status_code', 'content_type', 'headers')
+    fields = __slots__
+    selected_headers = ('Link', 'Location')
+
+    @classmethod
+    def from_dict(cls, log):
+        record = cls()
+        for field in cls.fields:
+            if field in log:
+                record[field] = log[field]
+
+        return record
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+
+        if key == 'headers':
+            value = dict((name, value[name]) for name in self.selected_headers
+                         if name in value)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.fields else default
+
+    def to_dict(self):
+        log = {}
+        for field in self.fields:
+            if hasattr(self, field):
+                log[field] = getattr(self, field)
+
+        return log
+
+
+class NetworkLog(ResourceLog):
+    __slots__ = ()
+
+
+class ElementLog(ResourceLog):
+    # Rectangles are kept as array of [left, top, width, height]
+    __slots__ = ('rectangles', 'viewport_size', 'percentage_coverage',
+                 'potential_damage', 'actual_damage')
+    fields = ResourceLog.fields + __slots__
+    rectangle_keys = ('left', 'top', 'width', 'height')
+
+    def __setitem__(self, key, value):
+        if key == 'rectangles':
+            value = numpy.array([[rect[k] for k in self.rectangle_keys]
+                                 for rect in value]).reshape(-1, 4)
+        elif key == 'viewport_size':
+            value = tuple(value)
+
+        ResourceLog.__setitem__(self, key, value)
+
+    def to_dict(self):
+        log = ResourceLog.to_dict(self)
+        if 'rectangles' in log:
+            log['rectangles'] = [dict(zip(self.rectangle_keys, rect))
+                                 for rect in log['rectangles'].tolist()]
+        if 'viewport_size' in log:
+            log['viewport_size'] = list(log['viewport_size'])
+
+        return log
+
+
+class StylesheetLog(ResourceLog):
+    # Selectors of rules (rules_tag) are only counted
+    __slots__ = ('importance', 'num_rules', 'potential_damage', 'actual_damage')
+    fields = ResourceLog.fields + __slots__
+
+    @classmethod
+    def from_dict(cls, log):
+        record = super(StylesheetLog, cls).from_dict(log)
+        if 'rules_tag' in log:
+            record['num_rules'] = len(log['rules_tag'])
+
+        return record
+
+
+def read_logs(log_file, record_cls):
+    # Read log file line by line, so only one raw log is in memory at a time
+    with open(log_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield record_cls.from_dict(json.loads(line))
@@ -0,0 +1,45 @@
+import numpy
+
+
+def score_rectangles(logs, size_weight=0.5, centrality_weight=0.5):
+    # Score every rectangle of every log in one pass
+    # Return location, size, and total importance summed per log, and number
+    # of rectangles per log
+    num_logs = len(logs)
+    counts = numpy.array([len(log['rectangles']) for log in logs], dtype=numpy.int64)
+    if counts.sum() == 0:
+        zeros = numpy.zeros(num_logs)
+        return zeros, zeros, zeros, counts
+
+    # Pack rectangles of all logs, owner is index of log in logs
+    rects = numpy.concatenate([log['rectangles'] for log in logs if len(log['rectangles'])])
+    owner = numpy.repeat(numpy.arange(num_logs), counts)
+    x, y, w, h = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+
+    middle_x, middle_y, viewport_area = [], [], []
+    for log in logs:
+        viewport_w, viewport_h = log['viewport_size']
+        middle_x.append(viewport_w / 2)
+        middle_y.append(viewport_h / 2)
+        viewport_area.append(viewport_w * viewport_h)
+
+    middle_x = numpy.array(middle_x)[owner]
+    middle_y = numpy.array(middle_y)[owner]
+    viewport_area = numpy.array(viewport_area)[owner]
+
+    # Based on measureMemento.pl line 703 and 715
+    location_importance = \
+        numpy.where(((x + w) > middle_x) & (x < middle_x), centrality_weight / 2, 0.0) + \
+        numpy.where(((y + h) > middle_y) & (y < middle_y), centrality_weight / 2, 0.0)
+
+    prop = numpy.zeros(len(rects))
+    has_area = viewport_area > 0
+    prop[has_area] = (w * h)[has_area].astype(float) / viewport_area[has_area]
+    size_importance = prop * size_weight
+
+    importance = location_importance + size_importance
+
+    return (numpy.bincount(owner, weights=location_importance, minlength=num_logs),
+            numpy.bincount(owner, weights=size_importance, minlength=num_logs),
+            numpy.bincount(owner, weights=importance, minlength=num_logs),
+            counts)
@@ -0,0 +1,141 @@
+import os
+import re
+import threading
+
+import numpy
+from PIL import Image
+
+# Raw screenshot is binary PPM (P6) rendered by crawl.js: small text header
+# "P6 <width> <height> <maxval>" followed by RGB pixels, top row first. Its
+# pixels are used in place, without decoding
+RAW_SCREENSHOT_MAGIC = 'P6'
+PPM_HEADER_PATTERN = re.compile(r'P6(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)'
+                                r'(?:\s+|#[^\n]*\n)+(\d+)\s')
+PPM_HEADER_MAX_SIZE = 512
+
+# Viewable renditions of screenshot by format: (PIL format, file extension,
+# mimetype). Scaled renditions (thumbnails) are named with their width, e.g.
+# screenshot-320.jpg
+RENDITION_FORMATS = {
+    'png': ('PNG', 'png', 'image/png'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+}
+RENDITION_QUALITY = 85
+# Largest width and height the encoder of format can write
+RENDITION_MAX_SIZE = {'jpeg': 65535, 'webp': 16383}
+# Temporary files left by failed encoding are matched as well
+RENDITION_FILE_PATTERN = re.compile(r'^screenshot(?:-\d+\.(?:png|jpg|webp)|\.(?:jpg|webp))'
+                                    r'(?:\.\d+\.\d+\.tmp)?$')
+
+
+def is_raw_screenshot(data):
+    return data[:len(RAW_SCREENSHOT_MAGIC)] == RAW_SCREENSHOT_MAGIC
+
+
+def read_ppm_header(data):
+    # Return (width, height, offset of pixels) from beginning of raw screenshot
+    match = PPM_HEADER_PATTERN.match(data[:PPM_HEADER_MAX_SIZE])
+    if not match:
+        raise ValueError('Invalid PPM header')
+
+    width, height, maxval = [int(value) for value in match.groups()]
+    if maxval != 255:
+        raise ValueError('Unsupported PPM maxval {}'.format(maxval))
+
+    return width, height, match.end()
+
+
+def load_screenshot_pixels(screenshot_file):
+    # Raw screenshot file is memory-mapped, other image files are decoded
+    with open(screenshot_file, 'rb') as f:
+        head = f.read(PPM_HEADER_MAX_SIZE)
+
+    if is_raw_screenshot(head):
+        width, height, offset = read_ppm_header(head)
+        return numpy.memmap(screenshot_file, dtype=numpy.uint8, mode='r',
+                            offset=offset, shape=(height, width, 3))
+
+    return _decode_image(Image.open(screenshot_file))
+
+
+def rendition_file_name(format, width=None):
+    extension = RENDITION_FORMATS[format][1]
+    if width:
+        return 'screenshot-{}.{}'.format(width, extension)
+    return 'screenshot.{}'.format(extension)
+
+
+def screenshot_size(screenshot_file):
+    # Only header of image is read
+    return Image.open(screenshot_file).size
+
+
+def rendition_size(size, width=None):
+    # Size of rendition of screenshot of size, scaled to width if narrower
+    if not width or width >= size[0]:
+        return size
+    return width, max(1, size[1] * width // size[0])
+
+
+def rendition_fits(format, size):
+    max_size = RENDITION_MAX_SIZE.get(format)
+    return max_size is None or max(size) <= max_size
+
+
+def save_screenshot_renditions(screenshot_file, output_dir, formats, widths=()):
+    # Encode renditions of screenshot in every format, at full size and
+    # scaled to every width narrower than screenshot. Screenshot is decoded
+    # once, each rendition is written to temporary file first. Renditions
+    # too large for their format (see RENDITION_MAX_SIZE) are skipped. If
+    # encoding fails, the other renditions are still written before the
+    # error is raised. Return names of rendition files
+    im = Image.open(screenshot_file).convert('RGB')
+
+    images = [(None, im)]
+    for width in sorted(set(widths)):
+        if width < im.size[0]:
+            images.append((width, im.resize(rendition_size(im.size, width), Image.LANCZOS)))
+
+    file_names = []
+    error = None
+    for format in formats:
+        pil_format = RENDITION_FORMATS[format][0]
+        for width, image in images:
+            file_name = rendition_file_name(format, width)
+            image_file = os.path.join(output_dir, file_name)
+            if os.path.abspath(image_file) == os.path.abspath(screenshot_file) or \
+                    not rendition_fits(format, image.size):
+                continue
+
+            # Requests may encode the same rendition in other threads
+            temp_file = '{}.{}.{}.tmp'.format(image_file, os.getpid(), threading.current_thread().ident)
+            try:
+                if pil_format == 'PNG':
+                    image.save(temp_file, format=pil_format)
+                else:
+                    image.save(temp_file, format=pil_format, quality=RENDITION_QUALITY)
+                os.rename(temp_file, image_file)
+            except (IOError, ValueError), e:
+                error = error or e
+                if os.path.exists(temp_file):
+                    os.unlink(temp_file)
+                continue
+            file_names.append(file_name)
+
+    if error:
+        raise error
+    return file_names
+
+
+def remove_screenshot_renditions(output_dir):
+    # Renditions of previous screenshot, the screenshot itself is kept
+    for file_name in os.listdir(output_dir):
+        if RENDITION_FILE_PATTERN.match(file_name):
+            os.unlink(os.path.join(output_dir, file_name))
+
+
+def _decode_image(im):
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    return numpy.asarray(im)
@@ -0,0 +1,322 @@
+import atexit
+import errno
+import logging
+import os
+import resource
+import select
+import signal
+import time
+from Queue import Queue
+from subprocess import Popen, PIPE
+from threading import Thread, Lock, Event
+
+# Exit reasons of supervised process
+EXIT = 'exit'               # exited by itself, see exit code
+TIMEOUT = 'timeout'         # killed after its deadline
+OOM = 'oom'                 # out of memory under memory limit
+CPU_LIMIT = 'cpu_limit'     # killed after cpu limit
+CRASH = 'crash'             # killed by other signal, or by SIGKILL of
+                            # unknown origin (e.g. OOM killer, supervisor)
+NOT_FOUND = 'not_found'     # program is not installed
+START_ERROR = 'start_error'
+
+# Signals of a process running out of memory under RLIMIT_AS: allocation
+# fails (abort or segfault), or the kernel OOM killer sends SIGKILL. Without
+# memory limit they are not told apart from other crashes
+OOM_SIGNALS = (signal.SIGABRT, signal.SIGSEGV, signal.SIGBUS, signal.SIGKILL)
+
+
+class ProcessExit(object):
+    # code is exit code of the process, negative signal number if it was
+    # killed, or -1 if it was not started. cpu_time (seconds) and max_memory
+    # (bytes) are resource usage of the process, if it was started
+    def __init__(self, code, reason, message=None, cpu_time=None, max_memory=None):
+        self.code = code
+        self.reason = reason
+        self.message = message
+        self.cpu_time = cpu_time
+        self.max_memory = max_memory
+
+    def to_dict(self):
+        return {'code': self.code, 'reason': self.reason, 'message': self.message,
+                'cpu_time': self.cpu_time, 'max_memory': self.max_memory}
+
+    def __repr__(self):
+        return 'ProcessExit({!r}, {!r})'.format(self.code, self.reason)
+
+
+class SupervisedProcess(object):
+    # Process with its own process group, so it is killed with all its
+    # children. Output is split into lines by Supervisor, and passed to
+    # stdout_fn and stderr_fn in a thread of the process, so slow handling
+    # of a line (e.g. a large frame) never blocks the loop of other processes
+    def __init__(self, cmd, stdout_fn=None, stderr_fn=None, timeout=None,
+                 memory_limit=None, cpu_limit=None):
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self.deadline = time.time() + timeout if timeout else None
+        self.kill_time = None
+        self.timed_out = False
+        self.closed = False
+        self.returncode = None
+        self.rusage = None
+        self.exit = None
+        self.done = Event()
+        self.lines = Queue()
+        self.logger = logging.getLogger('memento_damage.supervisor')
+
+        # Pipes of other processes are closed in child, otherwise their end
+        # of file would never be seen
+        self.process = Popen(cmd, stdout=PIPE, stderr=PIPE, close_fds=True,
+                             preexec_fn=self._preexec)
+
+        self.pipes = {
+            self.process.stdout.fileno(): (self.process.stdout, stdout_fn, []),
+            self.process.stderr.fileno(): (self.process.stderr, stderr_fn, []),
+        }
+
+        thread = Thread(target=self._handle_lines)
+        thread.daemon = True
+        thread.start()
+
+    def wait(self):
+        # Event.wait without timeout can not be interrupted in Python 2
+        while not self.done.wait(1):
+            pass
+        return self.exit
+
+    def kill(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError, e:
+            if e.errno != errno.ESRCH: raise
+
+    def poll(self):
+        # Reap process if it has exited, its resource usage is kept as well
+        if self.returncode is not None:
+            return True
+
+        pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+        if pid == 0:
+            return False
+
+        self.rusage = rusage
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        self.process.returncode = self.returncode
+
+        return True
+
+    def get_exit(self):
+        code = self.returncode
+        cpu_time = round(self.rusage.ru_utime + self.rusage.ru_stime, 3)
+        # ru_maxrss is in kilobytes on Linux
+        max_memory = self.rusage.ru_maxrss * 1024
+        usage = {'cpu_time': cpu_time, 'max_memory': max_memory}
+
+        if self.timed_out:
+            return ProcessExit(code, TIMEOUT, 'Killed after timeout', **usage)
+        if self.closed:
+            return ProcessExit(code, CRASH, 'Killed when supervisor was closed', **usage)
+        if code >= 0:
+            return ProcessExit(code, EXIT, **usage)
+
+        sig = -code
+        if self.cpu_limit and sig in (signal.SIGXCPU, signal.SIGKILL) and cpu_time >= self.cpu_limit:
+            return ProcessExit(code, CPU_LIMIT, 'Killed after cpu limit of {} seconds'.format(
+                self.cpu_limit), **usage)
+        if sig in OOM_SIGNALS and self.memory_limit:
+            return ProcessExit(code, OOM, 'Killed by signal {}, out of memory'.format(sig), **usage)
+        return ProcessExit(code, CRASH, 'Killed by signal {}'.format(sig), **usage)
+
+    def finish(self):
+        # Done is set once lines already read are handled
+        self.exit = self.get_exit()
+        self.lines.put(None)
+
+    def _handle_lines(self):
+        while True:
+            item = self.lines.get()
+            if item is None:
+                break
+
+            # Failing callback must not stop handling of the next lines
+            line_fn, line = item
+            try:
+                line_fn(line.strip())
+            except Exception:
+                self.logger.exception('Error while handling output line')
+
+        self.done.set()
+
+    def _preexec(self):
+        # Run in child before exec
+        os.setsid()
+        if self.memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+        if self.cpu_limit:
+            # SIGXCPU at soft limit, SIGKILL at hard limit
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_limit, self.cpu_limit + 1))
+
+
+class Supervisor(object):
+    # Runs many processes from one loop thread: pipes of all processes are
+    # polled together, deadlines are checked on every turn, and processes are
+    # reaped as soon as they exit
+    poll_interval = 0.5
+    read_size = 256 * 1024
+
+    # Seconds between SIGTERM and SIGKILL of a timed out process
+    kill_grace = 2
+
+    def __init__(self):
+        self.logger = logging.getLogger('memento_damage.supervisor')
+
+        self._processes = set()
+        self._pipes = {}
+        self._new_processes = []
+        self._lock = Lock()
+        self._poller = select.poll()
+        self._thread = None
+
+        # Loop is woken up from poll when process is added
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._poller.register(self._wakeup_read, select.POLLIN)
+
+    def run(self, cmd, stdout_fn=None, stderr_fn=None, timeout=None,
+            memory_limit=None, cpu_limit=None):
+        # Block until process ends, return its ProcessExit. Lines of stdout
+        # and stderr are passed to stdout_fn and stderr_fn in loop thread
+        try:
+            process = SupervisedProcess(cmd, stdout_fn, stderr_fn, timeout,
+                                        memory_limit, cpu_limit)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                process_exit = ProcessExit(-1, NOT_FOUND, '{} is not installed'.format(cmd[0]))
+            else:
+                process_exit = ProcessExit(-1, START_ERROR, str(e))
+
+            if stderr_fn: stderr_fn(process_exit.message)
+            return process_exit
+
+        with self._lock:
+            self._new_processes.append(process)
+            if not self._thread:
+                self._thread = Thread(target=self._loop)
+                self._thread.daemon = True
+                self._thread.start()
+        os.write(self._wakeup_write, 'x')
+
+        return process.wait()
+
+    def close(self):
+        # Kill processes still running
+        with self._lock:
+            processes = list(self._processes) + self._new_processes
+        for process in processes:
+            process.closed = True
+            process.kill(signal.SIGKILL)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                new_processes, self._new_processes = self._new_processes, []
+            for process in new_processes:
+                self._processes.add(process)
+                for fd in process.pipes:
+                    self._pipes[fd] = process
+                    self._poller.register(fd, select.POLLIN)
+
+            for fd, event in self._poller.poll(self._poll_timeout() * 1000):
+                if fd == self._wakeup_read:
+                    os.read(fd, self.read_size)
+                elif fd in self._pipes:
+                    self._read_pipe(fd)
+
+            now = time.time()
+            for process in list(self._processes):
+                self._check_process(process, now)
+
+    def _poll_timeout(self):
+        timeout = self.poll_interval
+        now = time.time()
+        for process in self._processes:
+            # Pipes are closed, process is about to exit
+            if not process.pipes:
+                timeout = min(timeout, 0.01)
+
+            deadline = process.deadline if not process.timed_out else process.kill_time
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - now, 0))
+        return timeout
+
+    def _read_pipe(self, fd):
+        process = self._pipes[fd]
+        pipe, line_fn, partial = process.pipes[fd]
+
+        data = os.read(fd, self.read_size)
+        if not data:
+            # End of file, last line may have no newline
+            if partial:
+                self._call(process, line_fn, ''.join(partial))
+            self._poller.unregister(fd)
+            del self._pipes[fd]
+            del process.pipes[fd]
+            pipe.close()
+            return
+
+        # Long lines are kept as chunks until their newline arrives
+        lines = data.split('\n')
+        if len(lines) == 1:
+            partial.append(data)
+            return
+
+        partial.append(lines[0])
+        self._call(process, line_fn, ''.join(partial))
+        for line in lines[1:-1]:
+            self._call(process, line_fn, line)
+
+        del partial[:]
+        if lines[-1]:
+            partial.append(lines[-1])
+
+    def _call(self, process, line_fn, line):
+        if line_fn:
+            process.lines.put((line_fn, line))
+
+    def _check_process(self, process, now):
+        if process.deadline is not None and now >= process.deadline and not process.timed_out:
+            process.timed_out = True
+            process.kill_time = now + self.kill_grace
+            process.kill(signal.SIGTERM)
+        elif process.kill_time is not None and now >= process.kill_time:
+            process.kill_time = None
+            process.kill(signal.SIGKILL)
+
+        if not process.poll():
+            return
+
+        # Children left in process group may still hold the pipes
+        process.kill(signal.SIGKILL)
+        if process.pipes:
+            return
+
+        self._processes.discard(process)
+        process.finish()
+
+
+_shared_supervisor = None
+_shared_supervisor_lock = Lock()
+
+
+def get_supervisor():
+    # One supervisor (and loop thread) per process
+    global _shared_supervisor
+    with _shared_supervisor_lock:
+        if _shared_supervisor is None:
+            _shared_supervisor = Supervisor()
+            atexit.register(_shared_supervisor.close)
+
+    return _shared_supervisor
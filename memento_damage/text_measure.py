@@ -0,0 +1,118 @@
+import io
+import unicodedata
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+
+import html2text
+
+MAX_CODEPOINT = 0x10FFFF
+
+
+class WordCounter(HTMLParser):
+    # Text inside these tags is not visible on the page
+    invisible_tags = ('head', 'title', 'script', 'style', 'noscript', 'template')
+
+    # These tags separate words, e.g. <p>a</p><p>b</p> has 2 words, while
+    # inline tags (e.g. <b>, <span>) do not, e.g. a<b>b</b> has 1 word
+    breaking_tags = ('address', 'article', 'aside', 'blockquote', 'br', 'dd',
+                     'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure',
+                     'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                     'header', 'hr', 'iframe', 'img', 'input', 'li', 'main',
+                     'nav', 'ol', 'option', 'p', 'pre', 'section', 'select',
+                     'table', 'tbody', 'td', 'textarea', 'tfoot', 'th',
+                     'thead', 'tr', 'ul')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.num_words = 0
+        self._in_word = False
+        self._invisible_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.invisible_tags:
+            self._invisible_depth += 1
+        if tag in self.breaking_tags:
+            self._in_word = False
+
+    def handle_endtag(self, tag):
+        if tag in self.invisible_tags and self._invisible_depth > 0:
+            self._invisible_depth -= 1
+        if tag in self.breaking_tags:
+            self._in_word = False
+
+    def handle_data(self, data):
+        if self._invisible_depth > 0:
+            return
+
+        # Count a word when non-space character follows a space, so words
+        # split across chunks or inline tags are only counted once
+        for word_idx, word in enumerate(data.split()):
+            if word_idx > 0 or not self._in_word or data[0].isspace():
+                self.num_words += 1
+
+        self._in_word = bool(data) and not data[-1].isspace()
+
+    def handle_entityref(self, name):
+        self._handle_char(unichr(name2codepoint[name])
+                          if name in name2codepoint else u'&')
+
+    def handle_charref(self, name):
+        try:
+            if name.lower().startswith('x'):
+                codepoint = int(name[1:], 16)
+            else:
+                codepoint = int(name)
+
+            # Reference beyond Unicode range is not a character either
+            if not 0 <= codepoint <= MAX_CODEPOINT:
+                raise ValueError('Invalid code point {}'.format(codepoint))
+            char = unichr(codepoint)
+        except (ValueError, OverflowError):
+            char = u'&'
+
+        self._handle_char(char)
+
+    def _handle_char(self, char):
+        # Non-breaking space is a separator as well
+        if char.isspace() or unicodedata.category(char) == 'Zs':
+            self._in_word = False
+        else:
+            self.handle_data(char)
+
+
+def open_html(html_file):
+    # html_file is path of utf-8 file, or file-like object of unicode html
+    # (e.g. html streamed from crawl.js)
+    if isinstance(html_file, basestring):
+        return io.open(html_file, "r", encoding="utf-8")
+    return html_file
+
+
+def count_words_stream(html_file, chunk_size=64 * 1024):
+    # Feed html incrementally, only one chunk is kept in memory
+    counter = WordCounter()
+    with open_html(html_file) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            counter.feed(chunk)
+
+    counter.close()
+    return counter.num_words
+
+
+def count_words_html2text(html_file):
+    # Convert html to markdown, then count words of markdown
+    h = html2text.HTML2Text()
+    h.ignore_links = True
+    with open_html(html_file) as f:
+        text = h.handle(u' '.join(line.strip() for line in f))
+
+    return len(text.split())
+
+
+text_measures = {
+    'stream': count_words_stream,
+    'html2text': count_words_html2text,
+}
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+# Analysis stages measured inside other stages, text inside potential and
+# whitespace inside CSS damage of potential and actual. Their time is part
+# of their parent stages already, so they are not added to the total
+NESTED_STAGES = ('text', 'whitespace')
+
+
+class StageTimer(object):
+    def __init__(self):
+        self._stages = OrderedDict()
+
+    @contextmanager
+    def measure(self, stage):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add(stage, default_timer() - start)
+
+    def add(self, stage, seconds):
+        # Stage measured more than once is accumulated
+        self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def to_dict(self):
+        # In milliseconds, rounded to microseconds
+        return OrderedDict((stage, round(seconds * 1000, 3))
+                           for stage, seconds in self._stages.items())
+
+
+def sum_stages(stages):
+    # Total ms of {stage: ms}, nested stages are not counted twice
+    return sum(ms for stage, ms in stages.items() if stage not in NESTED_STAGES)
+
+
+def format_timing_table(timing):
+    # timing is {group: {stage: ms}} as in result['timing']. Nested stages
+    # are indented under their group, and total of a group (crawl.total is
+    # its phases and startup) follows it, both without share of the total
+    rows = []
+    total = timing.get('total') or 0.0
+    for group in ('crawl', 'analysis'):
+        stages = timing.get(group) or {}
+        for stage, ms in stages.items():
+            if stage not in NESTED_STAGES and stage != 'total':
+                rows.append(('{}.{}'.format(group, stage), ms, True))
+        for stage, ms in stages.items():
+            if stage in NESTED_STAGES:
+                rows.append(('  {}.{}'.format(group, stage), ms, False))
+        if 'total' in stages:
+            rows.append(('{}.total'.format(group), stages['total'], False))
+    rows.append(('total', total, True))
+
+    width = max(len(name) for name, _, _ in rows)
+    lines = ['{}  {:>12}  {:>6}'.format('stage'.ljust(width), 'ms', '%')]
+    for name, ms, counted in rows:
+        if counted:
+            pct = 100.0 * ms / total if total else 0.0
+            lines.append('{}  {:>12.3f}  {:>6.1f}'.format(name.ljust(width), ms, pct))
+        else:
+            lines.append('{}  {:>12.3f}  {:>6}'.format(name.ljust(width), ms, '-'))
+
+    return '\n'.join(lines)
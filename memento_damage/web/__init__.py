@@ -3,15 +3,22 @@ import os
 import pkgutil
 import sys
 import tempfile
-import time
 from optparse import OptionParser
 
 from flask import Flask, Blueprint, render_template
 from flask.globals import _request_ctx_stack
 from flask.templating import DispatchingJinjaLoader
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.pool import QueuePool
 
-from memento_damage import rmdir_recursive
+from memento_damage import MementoDamage, rmdir_recursive
+from memento_damage.renderer import get_shared_renderer_pool
+from memento_damage.replay_proxy import ReplayProxy
+from memento_damage.web.bulk import BulkRuns
+from memento_damage.web.cache_manager import CacheManager
+from memento_damage.web.jobs import JobManager
+from memento_damage.web.result_cache import ResultCache
 
 
 class ModifiedLoader(DispatchingJinjaLoader):
@@ -29,6 +36,19 @@ class ModifiedLoader(DispatchingJinjaLoader):
 
 flask_app = None
 
+
+def set_sqlite_pragmas(connection, connection_record):
+    # Readers are not blocked by writer in WAL mode, and it needs fsync only
+    # at checkpoints with synchronous=NORMAL
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=30000')
+    cursor.execute('PRAGMA cache_size=-16000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
 class FlaskApp(Flask):
     def __init__(self, options):
         Flask.__init__(self, __name__)
@@ -51,11 +71,55 @@ class FlaskApp(Flask):
         self.load_modules()
         self.create_database()
 
+        # Archived resources are recorded by replay proxy if its directory is
+        # given, and fresh calculations replay them instead of fetching again
+        self.replay_proxy = None
+        if self.config.get('REPLAY_DIR'):
+            self.replay_proxy = ReplayProxy(self.config['REPLAY_DIR'],
+                                            offline=self.config.get('REPLAY_OFFLINE')).start()
+
+        # Renderers are started on the first calculation
+        self.renderer_pool = get_shared_renderer_pool(size=self.config.get('RENDERERS', 2),
+                                                      proxy=self.replay_proxy and self.replay_proxy.address)
+
+        # Calculations run in jobs, one worker per renderer
+        self.jobs = JobManager(workers=self.config.get('RENDERERS', 2),
+                               queue_size=self.config.get('QUEUE_SIZE', 100))
+
+        # Calculation directories are evicted when cache is over its budget,
+        # except the ones of calculations in flight
+        self.cache_manager = CacheManager(self.config['CACHE_DIR'],
+                                          max_size=self.config.get('CACHE_MAX_SIZE', 0),
+                                          max_items=self.config.get('CACHE_MAX_ITEMS', 0),
+                                          max_age=self.config.get('CACHE_MAX_AGE', 0),
+                                          is_in_use=self.jobs.is_in_flight)
+
+        # Results of bulk calculations are kept in files until streamed
+        self.bulk_runs = BulkRuns(os.path.join(self.config['CACHE_DIR'], 'bulk'))
+
+        # Serialized results of archived calculations
+        self.result_cache = ResultCache(max_entries=self.config.get('RESULT_CACHE_SIZE', 1000),
+                                        ttl=self.config.get('RESULT_CACHE_TTL', 60 * 60),
+                                        negative_ttl=self.config.get('FAILURE_CACHE_TTL', 60))
+
     def configure_database(self):
+        # SQLite database is shared by web and job threads: connections are
+        # pooled across threads, and wait for each other's writes
+        if self.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:///'):
+            self.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+                'poolclass': QueuePool,
+                'pool_size': self.config.get('RENDERERS', 2) + 4,
+                'max_overflow': 8,
+                'connect_args': {'check_same_thread': False, 'timeout': 30},
+            })
+
         # Define the database object which is imported
         # by modules and controllers
         self.db = SQLAlchemy(self)
 
+        if self.db.engine.dialect.name == 'sqlite':
+            event.listen(self.db.engine, 'connect', set_sqlite_pragmas)
+
     def load_modules(self):
         # Sample HTTP error handling
         @self.errorhandler(404)
@@ -78,14 +142,34 @@ class FlaskApp(Flask):
         # Build the database:
         # This will create the database file using SQLAlchemy
         self.db.create_all()
+        self.add_missing_columns()
+
+        from memento_damage.web.models.memento import migrate_memento_model
+        migrate_memento_model(self.db.engine)
+
+    def add_missing_columns(self):
+        # create_all() does not alter existing tables, add new nullable
+        # columns to database created by previous version
+        inspector = inspect(self.db.engine)
+        for table in self.db.metadata.sorted_tables:
+            existing_columns = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(dialect=self.db.engine.dialect)
+                    self.db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column_type))
 
     def run_server(self):
         self.run(host=self.config['HOST'], port=self.config['PORT'], debug=self.config['DEBUG'],
                       threaded=True, use_reloader=False)
+        self.jobs.close()
+        self.renderer_pool.close()
+        self.cache_manager.close()
+        if self.replay_proxy:
+            self.replay_proxy.close()
 
         # If CLEAN_CACHE set to True, clean cache directory after server is closed
         if self.config['CLEAN_CACHE']:
-            time.sleep(3)
             rmdir_recursive(self.config['CACHE_DIR'], exception_files=[r'app.db'])
 
 def main():
@@ -102,6 +186,46 @@ def main():
     parser.add_option("-d", "--debug",
                       action="store_true", dest="DEBUG", default=False,
                       help="print server debug messages")
+    parser.add_option("-R", "--renderers",
+                      dest="RENDERERS", type="int", default=2,
+                      help="number of phantomjs renderers [default: %default]")
+    parser.add_option("-q", "--settle-quiet",
+                      dest="SETTLE_QUIET", type="int", default=MementoDamage.settle_quiet,
+                      help="process page after network is idle for this many ms [default: %default]")
+    parser.add_option("-M", "--settle-max",
+                      dest="SETTLE_MAX", type="int", default=MementoDamage.settle_max,
+                      help="process page at the latest this many ms after it is loaded "
+                           "[default: %default]")
+    parser.add_option("--queue-size",
+                      dest="QUEUE_SIZE", type="int", default=100,
+                      help="number of calculations waiting for renderer, more are refused "
+                           "[default: %default]")
+    parser.add_option("--result-cache-size",
+                      dest="RESULT_CACHE_SIZE", type="int", default=1000,
+                      help="number of archived results kept in memory [default: %default]")
+    parser.add_option("--cache-size",
+                      dest="CACHE_MAX_SIZE", type="int", default=1024,
+                      help="MB of calculation files kept in output directory, least recently used "
+                           "are deleted first, 0 is unlimited [default: %default]")
+    parser.add_option("--cache-items",
+                      dest="CACHE_MAX_ITEMS", type="int", default=10000,
+                      help="number of calculation directories kept in output directory, "
+                           "0 is unlimited [default: %default]")
+    parser.add_option("--cache-max-age",
+                      dest="CACHE_MAX_AGE", type="int", default=0,
+                      help="delete calculation files not used for this many hours, "
+                           "0 is never [default: %default]")
+    parser.add_option("--screenshot-widths",
+                      dest="SCREENSHOT_WIDTHS", default='320,1024',
+                      help="widths of screenshot thumbnails encoded after calculation, "
+                           "comma separated [default: %default]")
+    parser.add_option("--replay-dir",
+                      dest="REPLAY_DIR", default=None,
+                      help="record archived resources in this directory and replay them "
+                           "from there in later calculations (optional)")
+    parser.add_option("--offline",
+                      action="store_true", dest="REPLAY_OFFLINE", default=False,
+                      help="only replay resources recorded in --replay-dir")
 
     (options, args) = parser.parse_args()
     options = vars(options)
@@ -119,6 +243,14 @@ def main():
         options['CACHE_DIR'] = tempfile.mkdtemp()
         options['CLEAN_CACHE'] = True
 
+    options['CACHE_MAX_SIZE'] = options['CACHE_MAX_SIZE'] * 1024 * 1024
+    options['CACHE_MAX_AGE'] = options['CACHE_MAX_AGE'] * 60 * 60
+    options['SCREENSHOT_WIDTHS'] = [int(w) for w in options['SCREENSHOT_WIDTHS'].split(',') if w.strip()]
+    options['SCREENSHOT_FORMATS'] = ['jpeg', 'webp']
+
+    if options['REPLAY_DIR']:
+        options['REPLAY_DIR'] = os.path.abspath(options['REPLAY_DIR'])
+
     # Add some necessary config variables
     options['BASE_URL']                         = 'http://{}:{}'.format(options['HOST'], options['PORT'])
     options['BASE_DIR']                         = os.path.abspath(os.path.join(os.path.dirname(__file__)))
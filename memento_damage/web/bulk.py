@@ -0,0 +1,153 @@
+import errno
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque, OrderedDict
+from threading import Thread, Lock
+
+from memento_damage.web.jobs import QueueFull, JobFailed, DONE
+from memento_damage.web.result_cache import CachedResult
+
+
+class BulkRun(object):
+    # Calculations of a list of uris. At most window of them are submitted
+    # at once, so single bulk does not fill the job queue. Every finished
+    # calculation is appended to results file as NDJSON line, in the order
+    # they finish; byte offset in that file is the cursor to resume from
+    poll_interval = 0.2
+
+    def __init__(self, uris, submit_fn, directory, window=4):
+        self.id = uuid.uuid4().hex
+        self.uris = uris
+        self.results_file = os.path.join(directory, '{}.ndjson'.format(self.id))
+        self.window = window
+        self.finished = False
+
+        self._submit_fn = submit_fn
+        self._out = open(self.results_file, 'wb')
+
+        self.logger = logging.getLogger('memento_damage.bulk')
+
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def stream(self, cursor=0):
+        # Generate lines of results file from cursor until every calculation
+        # is finished. Cursor after each line is added to it, and the last
+        # line tells that the stream is complete
+        with open(self.results_file, 'rb') as f:
+            f.seek(cursor)
+            partial = ''
+            while True:
+                finished = self.finished
+                data = f.read(64 * 1024)
+                if not data:
+                    if finished:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    cursor += len(line) + 1
+                    yield '{}, "cursor": {}}}\n'.format(line[:-1], cursor)
+
+        yield json.dumps({'bulk_id': self.id, 'complete': True, 'total': len(self.uris),
+                          'cursor': cursor}) + '\n'
+
+    def close(self):
+        try:
+            os.unlink(self.results_file)
+        except OSError, e:
+            if e.errno != errno.ENOENT: raise
+
+    def _run(self):
+        pending = deque(enumerate(self.uris))
+        in_flight = []
+
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.window:
+                    index, uri = pending[0]
+                    try:
+                        job = self._submit_fn(uri)
+                    except QueueFull:
+                        break
+                    except JobFailed, e:
+                        pending.popleft()
+                        self._write(index, uri, error=str(e))
+                        continue
+                    except Exception, e:
+                        self.logger.exception('Submit of %s failed', uri)
+                        pending.popleft()
+                        self._write(index, uri, error='{}: {}'.format(type(e).__name__, e))
+                        continue
+
+                    pending.popleft()
+                    in_flight.append((index, uri, job))
+
+                still_running = []
+                for index, uri, job in in_flight:
+                    if not job.is_finished():
+                        still_running.append((index, uri, job))
+                    elif job.status == DONE:
+                        self._write(index, uri, result=job.result)
+                    else:
+                        self._write(index, uri, error=job.error)
+
+                if len(still_running) == len(in_flight):
+                    time.sleep(self.poll_interval)
+                in_flight = still_running
+        finally:
+            self._out.close()
+            self.finished = True
+
+    def _write(self, index, uri, result=None, error=None):
+        # Cached result is written as it is serialized
+        if isinstance(result, CachedResult) and result.failed:
+            error = result.get_error()
+
+        if error is not None:
+            line = json.dumps({'index': index, 'uri': uri, 'status': 'failed', 'error': error})
+        else:
+            body = result.body if isinstance(result, CachedResult) else json.dumps(result)
+            line = '{{"index": {}, "uri": {}, "status": "done", "result": {}}}'.format(
+                index, json.dumps(uri), body)
+
+        self._out.write(line + '\n')
+        self._out.flush()
+
+
+class BulkRuns(object):
+    # Bulk runs by id, oldest finished ones (and their results files) are
+    # dropped when there are more than max_runs
+    max_runs = 100
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+        self._runs = OrderedDict()
+        self._lock = Lock()
+
+    def start(self, uris, submit_fn, window):
+        run = BulkRun(uris, submit_fn, self.directory, window)
+        with self._lock:
+            self._runs[run.id] = run
+            for run_id in list(self._runs.keys()):
+                if len(self._runs) <= self.max_runs:
+                    break
+                if self._runs[run_id].finished:
+                    self._runs.pop(run_id).close()
+        return run
+
+    def get(self, run_id):
+        with self._lock:
+            return self._runs.get(run_id)
@@ -0,0 +1,223 @@
+import errno
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from Queue import Queue
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+
+from memento_damage.tools import rmdir_recursive
+
+# Entries are calculation directories named by hashed uri, anything else in
+# cache directory (database, bulk results) is not managed
+ENTRY_NAME_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+INDEX_FILE_NAME = 'cache-index.json'
+TRASH_DIR_NAME = 'trash'
+
+
+def directory_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class CacheManager(object):
+    # Keeps cache directory within max_size bytes and max_items entries
+    # (0 is unlimited). Least recently used entries are evicted first, and
+    # entries not used for max_age seconds whatever the size is. Entries in
+    # use (is_in_use(key) is true) are never evicted.
+    #
+    # Size and last access of every entry are kept in memory and saved in
+    # index file, so eviction never walks the cache tree, only updated entry
+    # is walked. Evicted entry is renamed into trash at once and deleted by
+    # another thread
+    interval = 60
+
+    def __init__(self, directory, max_size=0, max_items=0, max_age=0, is_in_use=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_items = max_items
+        self.max_age = max_age
+        self.is_in_use = is_in_use or (lambda key: False)
+
+        self.index_file = os.path.join(directory, INDEX_FILE_NAME)
+        self.trash_dir = os.path.join(directory, TRASH_DIR_NAME)
+        self.logger = logging.getLogger('memento_damage.cache')
+
+        try:
+            os.makedirs(self.trash_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+        # Least recently used entry is the first, key: (size, last access)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._dirty = False
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._closed = False
+        self._load_index()
+
+        # Trash left by previous run is deleted as well
+        self._deletions = Queue()
+        for name in os.listdir(self.trash_dir):
+            self._deletions.put(os.path.join(self.trash_dir, name))
+
+        self._evict_thread = Thread(target=self._run_eviction)
+        self._evict_thread.daemon = True
+        self._evict_thread.start()
+
+        self._delete_thread = Thread(target=self._run_deletion)
+        self._delete_thread.daemon = True
+        self._delete_thread.start()
+
+    def touch(self, key):
+        # Mark entry as used. Eviction in progress is waited for, so entry
+        # directory can be written right after this
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._entries[key] = (entry[0], time.time())
+                self._dirty = True
+
+    def update(self, key):
+        # Add entry, or measure it again after its files are changed
+        path = os.path.join(self.directory, key)
+        size = directory_size(path) if os.path.isdir(path) else None
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._size -= entry[0]
+            if size is not None:
+                self._entries[key] = (size, time.time())
+                self._size += size
+            self._dirty = True
+
+            if self._is_over_budget():
+                self._wakeup.set()
+
+    def get_size(self):
+        return self._size
+
+    def get_count(self):
+        return len(self._entries)
+
+    def evict(self):
+        # Return keys of entries moved into trash
+        evicted = []
+        now = time.time()
+
+        with self._lock:
+            for key, (size, last_access) in list(self._entries.items()):
+                expired = self.max_age and now - last_access > self.max_age
+                if not expired and not self._is_over_budget():
+                    break
+                if self.is_in_use(key):
+                    continue
+
+                del self._entries[key]
+                self._size -= size
+                self._dirty = True
+                self._move_to_trash(key)
+                evicted.append(key)
+
+        if evicted:
+            self.logger.info('Evicted %d entries, %d entries of %d bytes are kept',
+                             len(evicted), len(self._entries), self._size)
+        return evicted
+
+    def close(self):
+        # Index is saved, and trash is deleted before return
+        self._closed = True
+        self._wakeup.set()
+        self._evict_thread.join()
+        self._save_index()
+
+        self._deletions.put(None)
+        self._delete_thread.join()
+
+    def _is_over_budget(self):
+        return (self.max_size and self._size > self.max_size) or \
+               (self.max_items and len(self._entries) > self.max_items)
+
+    def _move_to_trash(self, key):
+        path = os.path.join(self.trash_dir, '{}-{}'.format(key, uuid.uuid4().hex))
+        try:
+            os.rename(os.path.join(self.directory, key), path)
+        except OSError, e:
+            if e.errno != errno.ENOENT: raise
+            return
+        self._deletions.put(path)
+
+    def _load_index(self):
+        # Index is checked against entry directories; directories missing
+        # from it (e.g. made by previous versions) are measured once
+        try:
+            with open(self.index_file, 'rb') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not ENTRY_NAME_PATTERN.match(name) or not os.path.isdir(path):
+                continue
+
+            if name in index:
+                size, last_access = index[name]
+            else:
+                size, last_access = directory_size(path), os.path.getmtime(path)
+                self._dirty = True
+            entries.append((last_access, name, size))
+
+        for last_access, name, size in sorted(entries):
+            self._entries[name] = (size, last_access)
+            self._size += size
+
+        self._dirty = self._dirty or len(entries) != len(index)
+
+    def _save_index(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            index = dict(self._entries)
+            self._dirty = False
+
+        # Index is replaced at once, never left half written
+        temp_file = '{}.{}'.format(self.index_file, uuid.uuid4().hex)
+        with open(temp_file, 'wb') as f:
+            json.dump(index, f)
+        os.rename(temp_file, self.index_file)
+
+    def _run_eviction(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+            try:
+                self.evict()
+                self._save_index()
+            except (IOError, OSError):
+                self.logger.exception('Cache eviction failed')
+
+    def _run_deletion(self):
+        while True:
+            path = self._deletions.get()
+            if path is None:
+                return
+
+            try:
+                rmdir_recursive(path)
+            except OSError:
+                self.logger.exception('Deletion of %s failed', path)
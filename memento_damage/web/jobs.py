@@ -0,0 +1,180 @@
+import logging
+import time
+import uuid
+from Queue import Queue, Full
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+
+# Status of job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    # Raised by function of job that fails for a known reason (e.g. crawl of
+    # the page failed), error of job is its message
+    pass
+
+
+class Job(object):
+    def __init__(self, key, uri):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.uri = uri
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        # HTTP status of failed job, 502 if it failed for a known reason
+        self.error_status = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+        self._done = Event()
+
+    def is_finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        # Event.wait without timeout can not be interrupted in Python 2
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self._done.wait(1):
+            if deadline is not None and time.time() >= deadline:
+                break
+        return self.is_finished()
+
+    def to_dict(self):
+        return {'id': self.id, 'uri': self.uri, 'status': self.status, 'error': self.error,
+                'submit_time': self.submit_time, 'start_time': self.start_time,
+                'end_time': self.end_time}
+
+    def _finish(self, status, result=None, error=None, error_status=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.error_status = error_status
+        self.end_time = time.time()
+        self._done.set()
+
+
+class JobManager(object):
+    # Runs calculations in a bounded pool of worker threads, so web threads
+    # only submit jobs and poll them. Jobs of the same key (hashed uri) are
+    # coalesced while one is queued or running, and submit fails with
+    # QueueFull when queue_size jobs are waiting. Finished jobs are kept for
+    # lookup, up to max_finished of them. Jobs of results known without
+    # calculation are kept apart, so they never push calculated ones out
+    max_finished = 1000
+    max_known_results = 1000
+
+    def __init__(self, workers=2, queue_size=100):
+        self.logger = logging.getLogger('memento_damage.jobs')
+
+        self._queue = Queue(maxsize=queue_size)
+        self._in_flight = {}
+        self._finished = OrderedDict()
+        self._known_results = OrderedDict()
+        self._lock = Lock()
+
+        self._threads = []
+        for _ in range(workers):
+            thread = Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, uri, fn, *args):
+        # Return job of fn(*args), or the job of the same key already in flight
+        with self._lock:
+            job = self._in_flight.get(key)
+            if job:
+                return job
+
+            job = Job(key, uri)
+            try:
+                self._queue.put_nowait((job, fn, args))
+            except Full:
+                raise QueueFull('{} jobs are waiting'.format(self._queue.qsize()))
+
+            self._in_flight[key] = job
+            return job
+
+    def add_result(self, key, uri, result, keep=True):
+        # Finished job of result known without calculation, e.g. from
+        # archive. It is only kept for lookup if keep is true
+        job = Job(key, uri)
+        job.start_time = job.submit_time
+        job._finish(DONE, result)
+        if keep:
+            self._keep_known_result(job)
+        return job
+
+    def add_failure(self, key, uri, error, error_status=502, keep=True):
+        # Failed job of failure known without calculation, e.g. cached one
+        job = Job(key, uri)
+        job.start_time = job.submit_time
+        job._finish(FAILED, error=error, error_status=error_status)
+        if keep:
+            self._keep_known_result(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._finished.get(job_id) or self._known_results.get(job_id)
+            if job:
+                return job
+            for job in self._in_flight.values():
+                if job.id == job_id:
+                    return job
+        return None
+
+    def is_in_flight(self, key):
+        with self._lock:
+            return key in self._in_flight
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def close(self):
+        # Workers exit after their current job
+        for _ in self._threads:
+            self._queue.put((None, None, None))
+
+    def _work(self):
+        while True:
+            job, fn, args = self._queue.get()
+            if job is None:
+                return
+
+            job.status = RUNNING
+            job.start_time = time.time()
+            try:
+                result = fn(*args)
+            except JobFailed, e:
+                job._finish(FAILED, error=str(e), error_status=502)
+            except Exception, e:
+                self.logger.exception('Job of %s failed', job.uri)
+                job._finish(FAILED, error='{}: {}'.format(type(e).__name__, e), error_status=500)
+            else:
+                job._finish(DONE, result)
+
+            with self._lock:
+                del self._in_flight[job.key]
+                self._keep_finished(job)
+
+    def _keep_known_result(self, job):
+        with self._lock:
+            self._known_results[job.id] = job
+            while len(self._known_results) > self.max_known_results:
+                self._known_results.popitem(last=False)
+
+    def _keep_finished(self, job):
+        self._finished[job.id] = job
+        while len(self._finished) > self.max_finished:
+            self._finished.popitem(last=False)
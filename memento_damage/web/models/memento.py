@@ -1,9 +1,124 @@
+import json
+import zlib
+
+from sqlalchemy import MetaData, Table, inspect, literal_column, select, text
+
+from memento_damage.timing import sum_stages
+
 from memento_damage.web import flask_app
 
-class MementoModel(flask_app.db.Model):
-    # id = flask_app.db.Column(flask_app.db.Integer, primary_key=True)
-    uri = flask_app.db.Column(flask_app.db.String(255), nullable=False)
-    hashed_uri = flask_app.db.Column(flask_app.db.String(255), primary_key=True, nullable=False)
-    request_time = flask_app.db.Column(flask_app.db.DateTime(), nullable=False)
-    response_time = flask_app.db.Column(flask_app.db.DateTime(), nullable=True)
-    result = flask_app.db.Column(flask_app.db.Text, nullable=True)
\ No newline at end of file
+db = flask_app.db
+
+# Status of calculation
+DONE = 'done'
+FAILED = 'failed'
+
+
+class CalculationModel(db.Model):
+    # Every calculation of a uri is kept. Result is stored as compressed
+    # JSON, its summary is in columns of its own, so listing and lookups never
+    # decompress results
+    __table_args__ = (
+        db.Index('ix_calculation_model_hashed_uri_response_time', 'hashed_uri', 'response_time'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    uri = db.Column(db.Text, nullable=False)
+    hashed_uri = db.Column(db.String(32), nullable=False)
+    request_time = db.Column(db.DateTime(), nullable=False)
+    response_time = db.Column(db.DateTime(), nullable=True)
+    status = db.Column(db.String(16), nullable=False, default=DONE)
+
+    # Summary of result, times are in seconds
+    total_damage = db.Column(db.Float, nullable=True)
+    calculation_time = db.Column(db.Float, nullable=True)
+    crawl_time = db.Column(db.Float, nullable=True)
+    analysis_time = db.Column(db.Float, nullable=True)
+
+    # zlib compressed JSON of result, only loaded when it is accessed
+    result_data = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    # Unweighted damage (see memento_damage.rescoring.FEATURE_NAMES) as JSON
+    features = db.deferred(db.Column(db.Text, nullable=True))
+
+    def set_result(self, result):
+        if not result:
+            self.status = FAILED
+            return
+
+        self.status = DONE
+        self.result_data = compress_result(json.dumps(result))
+        self.total_damage = result.get('total_damage')
+        self.calculation_time = result.get('calculation_time')
+
+        # Timing of result is in milliseconds
+        timing = result.get('timing') or {}
+        crawl_time = (timing.get('crawl') or {}).get('total')
+        self.crawl_time = crawl_time / 1000.0 if crawl_time is not None else None
+        analysis = timing.get('analysis') or {}
+        self.analysis_time = sum_stages(analysis) / 1000.0 if analysis else None
+
+        if 'features' in result:
+            self.features = json.dumps(result['features'])
+
+    def get_result_json(self):
+        if self.result_data is None:
+            return None
+        return decompress_result(self.result_data)
+
+    def summary(self):
+        return {'id': self.id, 'uri': self.uri, 'status': self.status,
+                'request_time': self.request_time.isoformat(),
+                'response_time': self.response_time.isoformat() if self.response_time else None,
+                'total_damage': self.total_damage, 'calculation_time': self.calculation_time,
+                'crawl_time': self.crawl_time, 'analysis_time': self.analysis_time}
+
+
+def compress_result(result_json):
+    return zlib.compress(result_json, 6)
+
+
+def decompress_result(data):
+    return zlib.decompress(data)
+
+
+def migrate_memento_model(engine, batch_size=500):
+    # Results of previous versions (one row per uri in memento_model) are
+    # moved into calculation history, old rows are kept in
+    # memento_model_migrated. Every batch is copied and moved in one
+    # transaction, so interrupted migration goes on where it stopped
+    if 'memento_model' not in inspect(engine).get_table_names():
+        return 0
+
+    engine.execute('CREATE TABLE IF NOT EXISTS memento_model_migrated AS '
+                   'SELECT * FROM memento_model WHERE 0')
+
+    table = Table('memento_model', MetaData(), autoload=True, autoload_with=engine)
+    rowid = literal_column('rowid')
+    columns = [c.name for c in CalculationModel.__table__.columns if c.name != 'id']
+
+    num_rows = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select([rowid.label('row_id')] + list(table.columns))
+                                      .order_by(rowid).limit(batch_size)).fetchall()
+            if not rows:
+                break
+
+            values = []
+            for row in rows:
+                model = CalculationModel(uri=row['uri'], hashed_uri=row['hashed_uri'],
+                                         request_time=row['request_time'], response_time=row['response_time'])
+                model.set_result(json.loads(row['result'] or 'null'))
+                if model.features is None and 'features' in table.columns:
+                    model.features = row['features']
+                values.append(dict((name, getattr(model, name)) for name in columns))
+            connection.execute(CalculationModel.__table__.insert(), values)
+
+            last_rowid = rows[-1]['row_id']
+            connection.execute(text('INSERT INTO memento_model_migrated '
+                                    'SELECT * FROM memento_model WHERE rowid <= :row_id'), row_id=last_rowid)
+            connection.execute(text('DELETE FROM memento_model WHERE rowid <= :row_id'), row_id=last_rowid)
+            num_rows += len(rows)
+
+    engine.execute('DROP TABLE memento_model')
+    return num_rows
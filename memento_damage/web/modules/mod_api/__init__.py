@@ -1,18 +1,24 @@
 import errno
-import io
 import json
 import os
+import time
 from datetime import datetime
 from hashlib import md5
 from urlparse import urlparse
 
-from PIL import Image
-from flask import Blueprint, request, render_template, \
+from flask import Blueprint, request, render_template, send_file, \
     Response, current_app as app
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 
 from memento_damage import MementoDamage
-from memento_damage.web.models.memento import MementoModel
+from memento_damage.batch import parse_uris
+from memento_damage.rescoring import FeatureMatrix, parse_weight_profiles
+from memento_damage.screenshot import RENDITION_FORMATS, rendition_file_name, rendition_size, \
+    rendition_fits, screenshot_size, save_screenshot_renditions, remove_screenshot_renditions
+from memento_damage.web.jobs import QueueFull, JobFailed, DONE
+from memento_damage.web.progress import read_log_lines, log_events
+from memento_damage.web.result_cache import CachedResult
+from memento_damage.web.models.memento import CalculationModel, DONE as CALCULATION_DONE
 
 
 class API(Blueprint):
@@ -34,19 +40,56 @@ class API(Blueprint):
 
         @self.route('/damage/progress/<path:uri>', methods=['GET'])
         def api_damage_progress(uri):
-            start = request.args.get('start', '0')
-            start = int(start)
             hashed_uri = md5(uri).hexdigest()
-
             app_log_file = os.path.join(app.config['CACHE_DIR'], hashed_uri, 'app.log')
+
+            # Lines after byte offset are sent with the offset of next request,
+            # so the log is never read again from its beginning
+            if 'offset' in request.args:
+                offset = request.args.get('offset', type=int)
+                if offset is None or offset < 0:
+                    return self.invalid_offset_response()
+                lines, offset = read_log_lines(app_log_file, offset)
+                return Response(response=json.dumps({'lines': lines, 'offset': offset}),
+                                status=200, mimetype='application/json')
+
+            start = request.args.get('start', type=int) if 'start' in request.args else 0
+            if start is None or start < 0:
+                return self.invalid_offset_response()
+
+            # Calculation job may be still queued
+            if not os.path.exists(app_log_file):
+                return Response(response=json.dumps([]), status=200, mimetype='application/json')
+
             with open(app_log_file, 'rb') as f:
                 lines_to_send = []
-                for idx, line in enumerate(f.readlines()):
+                for idx, line in enumerate(f):
                     if idx >= start:
                         lines_to_send.append(line.strip())
 
                 return Response(response=json.dumps(lines_to_send), status=200, mimetype='application/json')
 
+        @self.route('/damage/events/<path:uri>', methods=['GET'])
+        def api_damage_events(uri):
+            # Log lines as Server-Sent Events while calculation is running
+            hashed_uri = md5(uri).hexdigest()
+            app_log_file = os.path.join(app.config['CACHE_DIR'], hashed_uri, 'app.log')
+
+            offset = request.headers.get('Last-Event-ID') or request.args.get('offset', '0')
+            try:
+                offset = int(offset)
+            except ValueError:
+                offset = -1
+            if offset < 0:
+                return self.invalid_offset_response()
+            jobs = app.jobs
+
+            events = log_events(app_log_file, offset, lambda: jobs.is_in_flight(hashed_uri))
+            response = Response(response=events, status=200, mimetype='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
         @self.route('/damage/error/<path:uri>', methods=['GET'])
         def api_damage_error(uri):
             hashed_uri = md5(uri).hexdigest()
@@ -68,14 +111,171 @@ class API(Blueprint):
         @self.route('/damage/screenshot/<path:uri>', methods=['GET'])
         def api_damage_screenshot(uri):
             hashed_uri = md5(uri).hexdigest()
+            output_dir = os.path.join(app.config['CACHE_DIR'], hashed_uri)
+
+            # Rendition is chosen with ?format=jpeg|webp|png and ?width=<pixels>
+            format = request.args.get('format', 'jpeg').lower()
+            if format not in RENDITION_FORMATS:
+                return Response(response=json.dumps({'error': True, 'message': 'Unknown format {}'.format(format)}),
+                                status=400, mimetype='application/json')
+
+            width = self.rendition_width(request.args.get('width'))
+            image_file = os.path.join(output_dir, rendition_file_name(format, width))
+
+            if not os.path.exists(image_file):
+                screenshot_file = self.find_screenshot(output_dir)
+
+                # Rendition too large for its format (e.g. WebP of a long
+                # page) is sent as JPEG
+                if screenshot_file and not rendition_fits(
+                        format, rendition_size(screenshot_size(screenshot_file), width)):
+                    format = 'jpeg'
+                    image_file = os.path.join(output_dir, rendition_file_name(format, width))
+                full_image_file = os.path.join(output_dir, rendition_file_name(format))
+
+                # Renditions of crawls made before are encoded when first requested
+                if not os.path.exists(image_file) and not os.path.exists(full_image_file):
+                    if not screenshot_file:
+                        return Response(response=json.dumps({'error': True, 'message': 'No screenshot'}),
+                                        status=404, mimetype='application/json')
+                    try:
+                        save_screenshot_renditions(screenshot_file, output_dir, [format],
+                                                   app.config.get('SCREENSHOT_WIDTHS', []))
+                    except (IOError, ValueError):
+                        app.logger.exception('Screenshot renditions of %s failed', uri)
+                    app.cache_manager.update(hashed_uri)
+
+                # Screenshot narrower than width is not scaled
+                if not os.path.exists(image_file):
+                    image_file = full_image_file
+                if not os.path.exists(image_file):
+                    return Response(response=json.dumps({'error': True, 'message': 'No screenshot rendition'}),
+                                    status=404, mimetype='application/json')
+
+            app.cache_manager.touch(hashed_uri)
+
+            # Screenshot of versioned url (?v=) never changes, others are revalidated
+            cache_timeout = 365 * 24 * 60 * 60 if request.args.get('v') else 0
+            return send_file(image_file, mimetype=RENDITION_FORMATS[format][2], conditional=True,
+                             cache_timeout=cache_timeout)
+
+        @self.route('/damage/history/<path:uri>', methods=['GET'])
+        def api_damage_history(uri):
+            # Summaries of previous calculations, results are not loaded
+            limit = max(min(request.args.get('limit', 100, type=int), 1000), 1)
+            calculations = self.list_calculation_archives(md5(uri).hexdigest(), limit)
+
+            return Response(response=json.dumps([c.summary() for c in calculations]),
+                            status=200, mimetype='application/json')
+
+        @self.route('/damage/rescore', methods=['POST'])
+        def api_damage_rescore():
+            # Body is JSON object of {name: weights} or list of weights
+            profiles = request.get_json(force=True, silent=True)
+            if not profiles:
+                profiles = {'default': {}}
+
+            try:
+                results = self.rescore_calculation_archives(profiles)
+            except (TypeError, ValueError, ZeroDivisionError), e:
+                return Response(response=json.dumps({'error': True, 'message': str(e)}),
+                                status=400, mimetype='application/json')
+
+            return Response(response=json.dumps(results), status=200, mimetype='application/json')
+
+        @self.route('/damage/submit/<path:uri>', methods=['GET', 'POST'])
+        def api_damage_submit(uri):
+            # Calculation runs in job, its status and result are polled
+            fresh = request.args.get('fresh', 'false').lower() == 'true'
+
+            try:
+                job = self.submit_calculation(uri, fresh)
+            except QueueFull, e:
+                return self.queue_full_response(e)
+
+            response = Response(response=json.dumps(job.to_dict()), status=202, mimetype='application/json')
+            response.headers['Location'] = '/api/damage/jobs/{}'.format(job.id)
+            return response
+
+        @self.route('/damage/bulk', methods=['POST'])
+        def api_damage_bulk():
+            # Uris are JSON list (or {"uris": [...], "fresh": ...}), or csv
+            # uploaded as file or sent as body, uri in the first column
+            fresh = request.args.get('fresh', 'false').lower() == 'true'
+
+            body = request.get_json(force=True, silent=True)
+            if isinstance(body, dict):
+                fresh = body.get('fresh', fresh) in (True, 'true')
+                body = body.get('uris')
+
+            # Entries which are not absolute http(s) uris (e.g. header row of
+            # csv) are answered as failed, never submitted
+            if isinstance(body, list):
+                uris = [uri.strip() if isinstance(uri, basestring) else uri for uri in body if uri]
+            elif 'file' in request.files:
+                uris = list(parse_uris(request.files['file'].stream))
+            else:
+                uris = list(parse_uris(request.get_data().splitlines()))
+
+            if not uris:
+                return Response(response=json.dumps({'error': True, 'message': 'No uris'}),
+                                status=400, mimetype='application/json')
+
+            max_uris = app.config.get('BULK_MAX_URIS', 10000)
+            if len(uris) > max_uris:
+                return Response(response=json.dumps({'error': True, 'message': 'More than {} uris'.format(max_uris)}),
+                                status=413, mimetype='application/json')
+
+            flask_app = app._get_current_object()
+
+            # Jobs of bulk are never looked up by id
+            def submit(uri):
+                if not self.is_web_uri(uri):
+                    raise JobFailed('Not an absolute http(s) uri')
+                with flask_app.app_context():
+                    return self.submit_calculation(uri, fresh, keep_archived=False)
+
+            # Calculations of bulk use twice as many jobs as there are workers
+            run = app.bulk_runs.start(uris, submit, window=app.config.get('RENDERERS', 2) * 2)
+            return self.bulk_response(run, 0)
 
-            screenshot_file = os.path.join(app.config['CACHE_DIR'], hashed_uri, 'screenshot.png')
-            f = Image.open(screenshot_file)
-            o = io.BytesIO()
-            f.save(o, format="JPEG")
-            s = o.getvalue()
+        @self.route('/damage/bulk/<string:bulk_id>', methods=['GET'])
+        def api_damage_bulk_resume(bulk_id):
+            # Interrupted stream is resumed from cursor of the last line received
+            run = app.bulk_runs.get(bulk_id)
+            if not run:
+                return Response(response=json.dumps({'error': True, 'message': 'Bulk not found'}),
+                                status=404, mimetype='application/json')
 
-            return Response(response=s, status=200, mimetype='image/png')
+            cursor = request.args.get('cursor', type=int) if 'cursor' in request.args else 0
+            if cursor is None or cursor < 0:
+                return self.invalid_offset_response()
+            return self.bulk_response(run, cursor)
+
+        @self.route('/damage/jobs/<string:job_id>', methods=['GET'])
+        def api_damage_job(job_id):
+            job = app.jobs.get(job_id)
+            if not job:
+                return Response(response=json.dumps({'error': True, 'message': 'Job not found'}),
+                                status=404, mimetype='application/json')
+
+            return Response(response=json.dumps(job.to_dict()), status=200, mimetype='application/json')
+
+        @self.route('/damage/jobs/<string:job_id>/result', methods=['GET'])
+        def api_damage_job_result(job_id):
+            job = app.jobs.get(job_id)
+            if not job:
+                return Response(response=json.dumps({'error': True, 'message': 'Job not found'}),
+                                status=404, mimetype='application/json')
+
+            # Not finished yet, status is sent instead
+            if not job.is_finished():
+                return Response(response=json.dumps(job.to_dict()), status=202, mimetype='application/json')
+            if job.status != DONE:
+                return Response(response=json.dumps({'error': True, 'message': job.error}),
+                                status=job.error_status or 500, mimetype='application/json')
+
+            return self.result_response(job.result)
 
         # @self.route('/api/damage/<path:uri>/<string:fresh>', methods=['GET'])
         @self.route('/damage/<path:uri>', methods=['GET'])
@@ -83,50 +283,210 @@ class API(Blueprint):
             fresh = request.args.get('fresh', 'false')
             fresh = True if fresh.lower() == 'true' else False
 
-            hashed_uri = md5(uri).hexdigest()
-            output_dir = os.path.join(app.config['CACHE_DIR'], hashed_uri)
+            # Archived result is sent without job
+            if not fresh:
+                cached_result = self.get_archived_result(md5(uri).hexdigest())
+                if cached_result:
+                    return self.result_response(cached_result)
+
+            # Wait for the job, so the same uri is never calculated twice at once
+            try:
+                job = self.submit_calculation(uri, fresh)
+            except QueueFull, e:
+                return self.queue_full_response(e)
+            job.wait()
+
+            if job.status != DONE:
+                return Response(response=json.dumps({'error': True, 'message': job.error}),
+                                status=job.error_status or 500, mimetype='application/json')
 
+            return self.result_response(job.result)
+
+    def submit_calculation(self, uri, fresh, keep_archived=True):
+        # Return job of damage calculation of uri. Archived result is used
+        # unless fresh is requested, its job is only kept for lookup if
+        # keep_archived is true. Calculation of the same uri in flight is
+        # shared. Raises QueueFull if too many calculations are waiting
+        hashed_uri = md5(uri).hexdigest()
+
+        if not fresh:
+            cached_result = self.get_archived_result(hashed_uri)
+            if cached_result and cached_result.failed:
+                return app.jobs.add_failure(hashed_uri, uri, cached_result.get_error(),
+                                            keep=keep_archived)
+            if cached_result:
+                return app.jobs.add_result(hashed_uri, uri, cached_result, keep_archived)
+
+        output_dir = os.path.join(app.config['CACHE_DIR'], hashed_uri)
+        return app.jobs.submit(hashed_uri, uri, self.run_calculation_job,
+                               app._get_current_object(), uri, hashed_uri, output_dir)
+
+    def run_calculation_job(self, flask_app, uri, hashed_uri, output_dir):
+        # Run in worker thread of JobManager
+        with flask_app.app_context():
+            # Directory is not evicted while job is in flight, touch waits
+            # for the eviction already started
+            flask_app.cache_manager.touch(hashed_uri)
             try:
                 os.makedirs(output_dir)
             except OSError, e:
                 if e.errno != errno.EEXIST: raise
 
-            # If fresh == True, do fresh calculation
-            if fresh:
+            # Renditions of previous crawl are stale
+            remove_screenshot_renditions(output_dir)
+
+            try:
                 result = self.do_fresh_calculation(uri, hashed_uri, output_dir)
-            else:
-                # If there are calculation history, use it
-                last_calculation = self.check_calculation_archives(hashed_uri)
-                if last_calculation:
-                    result = last_calculation.result
-                    time = last_calculation.response_time
-
-                    result = json.loads(result)
-                    result['is_archive'] = True
-                    result['archive_time'] = time.isoformat()
-                    # result['calculation_time'] = (self.end_time - self.start_time).seconds
-                else:
-                    result = self.do_fresh_calculation(uri, hashed_uri, output_dir)
 
+                # Renditions are encoded once here instead of on every request
+                screenshot_file = self.find_screenshot(output_dir)
+                if screenshot_file:
+                    try:
+                        save_screenshot_renditions(screenshot_file, output_dir,
+                                                   flask_app.config.get('SCREENSHOT_FORMATS', ['jpeg']),
+                                                   flask_app.config.get('SCREENSHOT_WIDTHS', []))
+                    except (IOError, ValueError):
+                        flask_app.logger.exception('Screenshot renditions of %s failed', uri)
+            except JobFailed, e:
+                # Failed crawl is not retried by requests without fresh for a while
+                flask_app.result_cache.put_failure(hashed_uri, json.dumps({'error': True, 'message': str(e)}),
+                                                   datetime.utcnow())
+                raise
+            finally:
+                # Directory is measured once its files are written
+                flask_app.cache_manager.update(hashed_uri)
+
+            # Archived result is replaced by the new one
+            flask_app.result_cache.invalidate(hashed_uri)
+            return result
+
+    def find_screenshot(self, output_dir):
+        # Raw screenshot if crawl rendered it, otherwise png
+        for file_name in [MementoDamage.RAW_SCREENSHOT_FILE_NAME, MementoDamage.SCREENSHOT_FILE_NAME]:
+            screenshot_file = os.path.join(output_dir, file_name)
+            if os.path.exists(screenshot_file):
+                return screenshot_file
+        return None
+
+    def is_web_uri(self, uri):
+        if not isinstance(uri, basestring):
+            return False
+        parsed_uri = urlparse(uri)
+        return parsed_uri.scheme.lower() in ('http', 'https') and bool(parsed_uri.netloc)
+
+    def rendition_width(self, width):
+        # Narrowest configured width not narrower than requested one, None
+        # for full size
+        try:
+            width = int(width)
+        except (TypeError, ValueError):
+            return None
+
+        widths = [w for w in app.config.get('SCREENSHOT_WIDTHS', []) if w >= width]
+        return min(widths) if widths else None
+
+    def get_archived_result(self, hashed_uri):
+        # Return CachedResult of the last calculation of hashed uri, or None.
+        # Database is only queried when it is not cached
+        cached_result = app.result_cache.get(hashed_uri)
+        if cached_result:
+            return cached_result
+
+        # If there are calculation history, use it
+        last_calculation = self.check_calculation_archives(hashed_uri)
+        if not last_calculation:
+            return None
+
+        result = json.loads(last_calculation.get_result_json())
+
+        result['is_archive'] = True
+        result['archive_time'] = last_calculation.response_time.isoformat()
+
+        # Response time is local time
+        last_modified = datetime.utcfromtimestamp(time.mktime(last_calculation.response_time.timetuple()))
+        return app.result_cache.put(hashed_uri, json.dumps(result), last_modified)
+
+    def result_response(self, result):
+        # Cached result is sent as it is serialized, with validators so that
+        # repeated requests are answered with 304
+        if not isinstance(result, CachedResult):
             return Response(response=json.dumps(result), status=200, mimetype='application/json')
 
+        # Cached failure is never revalidated
+        if result.failed:
+            return Response(response=result.body, status=502, mimetype='application/json')
+
+        response = Response(response=result.body, status=200, mimetype='application/json')
+        response.set_etag(result.etag)
+        response.last_modified = result.last_modified
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    def bulk_response(self, run, cursor):
+        response = Response(response=run.stream(cursor), status=200, mimetype='application/x-ndjson')
+        response.headers['X-Bulk-Id'] = run.id
+        response.headers['Location'] = '/api/damage/bulk/{}'.format(run.id)
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def invalid_offset_response(self):
+        return Response(response=json.dumps({'error': True, 'message': 'Offset must be a non-negative integer'}),
+                        status=400, mimetype='application/json')
+
+    def queue_full_response(self, error):
+        response = Response(response=json.dumps({'error': True, 'message': 'Too many calculations '
+                                                 'in progress ({}), try again later'.format(error)}),
+                            status=503, mimetype='application/json')
+        response.headers['Retry-After'] = '30'
+        return response
+
+    def rescore_calculation_archives(self, profiles):
+        # Only features column is loaded, results are never decoded
+        # Latest calculation of every uri
+        latest = app.db.session.query(func.max(CalculationModel.id)) \
+            .filter(CalculationModel.features != None) \
+            .group_by(CalculationModel.hashed_uri)
+        rows = app.db.session.query(CalculationModel.uri, CalculationModel.features) \
+            .filter(CalculationModel.id.in_(latest)).all()
+
+        uris = [uri for uri, _ in rows]
+        features = [json.loads(f) for _, f in rows]
+        names, profiles = parse_weight_profiles(profiles)
+        total = FeatureMatrix(uris, features).rescore(profiles)
+
+        return [{'uri': uri, 'total_damage': dict(zip(names, row))}
+                for uri, row in zip(uris, total.tolist())]
+
     def check_calculation_archives(self, hashed_uri):
-        last_calculation = MementoModel.query\
-            .filter(MementoModel.hashed_uri == hashed_uri) \
-            .order_by(desc(MementoModel.response_time)) \
+        # Last successful calculation, failed ones are saved without result
+        last_calculation = CalculationModel.query\
+            .filter(CalculationModel.hashed_uri == hashed_uri) \
+            .filter(CalculationModel.status == CALCULATION_DONE) \
+            .order_by(desc(CalculationModel.response_time)) \
             .first()
 
         return last_calculation
 
+    def list_calculation_archives(self, hashed_uri, limit):
+        # Summaries of calculations of uri, newest first
+        return CalculationModel.query\
+            .filter(CalculationModel.hashed_uri == hashed_uri) \
+            .order_by(desc(CalculationModel.response_time)) \
+            .limit(limit) \
+            .all()
+
     def do_fresh_calculation(self, uri, hashed_url, output_dir):
-        # Instantiate MementoModel
-        model = MementoModel()
+        # Instantiate CalculationModel
+        model = CalculationModel()
         model.uri = uri
         model.hashed_uri = hashed_url
         model.request_time = datetime.now()
 
         # Do crawl and damage calculation
         damage = MementoDamage(uri, output_dir)
+        damage.set_renderer_pool(app.renderer_pool)
+        damage.set_settle_time(app.config.get('SETTLE_QUIET', MementoDamage.settle_quiet),
+                               app.config.get('SETTLE_MAX', MementoDamage.settle_max))
         damage.set_follow_redirection()
         damage.set_output_mode_json()
         damage.set_show_debug_message()
@@ -136,11 +496,20 @@ class API(Blueprint):
         result = damage.get_result()
 
         model.response_time = datetime.now()
-        model.result = json.dumps(result)
+        model.set_result(result)
 
         try:
             app.db.session.add(model)
             app.db.session.commit()
-        except: pass
+        except:
+            app.db.session.rollback()
+            app.logger.exception('Calculation of %s is not saved', uri)
+
+        # Job of failed crawl fails with its reason
+        if result is None:
+            crawl_exit = damage.get_crawl_exit()
+            if crawl_exit and crawl_exit.code != 0:
+                raise JobFailed('Crawl failed: {}'.format(crawl_exit.message or crawl_exit.reason))
+            raise JobFailed('Crawl result is incomplete')
 
         return result
@@ -64,9 +64,8 @@
 
             // Detail - rules
             var liDetail = $('<li>').appendTo(detail)
-            $('<span>Rules Selector</span><span>:</span>').appendTo(liDetail)
-            $('<span>'+ css['rules_tag'].join(', ') +
-              ' (Total '+ css['rules_tag'].length +')' +'</span>').appendTo(liDetail);
+            $('<span>Rule Selectors</span><span>:</span>').appendTo(liDetail)
+            $('<span>'+ ('num_rules' in css ? css['num_rules'] : '-') +'</span>').appendTo(liDetail);
 
             // Detail - importance
             var liDetail = $('<li>').appendTo(detail)
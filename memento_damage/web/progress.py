@@ -0,0 +1,73 @@
+import json
+import os
+import time
+
+# Most bytes of log read at once. Only the offset is kept between reads, so
+# memory of a watcher is bounded by this whatever the log size is
+MAX_READ_SIZE = 64 * 1024
+
+
+def read_log_lines(log_file, offset=0, max_size=MAX_READ_SIZE):
+    # Return (lines, next offset) of complete lines written after offset.
+    # Line longer than max_size is returned in pieces. Log rewritten by a
+    # new calculation (shorter than offset) is read from its beginning
+    try:
+        size = os.path.getsize(log_file)
+    except OSError:
+        return [], offset
+
+    if offset > size:
+        offset = 0
+    if offset == size:
+        return [], offset
+
+    with open(log_file, 'rb') as f:
+        f.seek(offset)
+        data = f.read(max_size)
+
+    end = data.rfind('\n') + 1
+    if end == 0:
+        # Last line is still being written
+        if len(data) < max_size:
+            return [], offset
+        end = len(data)
+
+    lines = [line.strip() for line in data[:end].split('\n') if line.strip()]
+    return lines, offset + end
+
+
+def log_events(log_file, offset, is_running, poll_interval=0.5, keepalive=15, timeout=15 * 60,
+               start_grace=5):
+    # Generate Server-Sent Events of lines written to log_file after offset.
+    # Event id is the offset after the last line read, so the stream can be
+    # resumed with Last-Event-ID. Ends with "end" event once is_running() is
+    # false and the log is read, or after timeout seconds. Calculation not
+    # running yet is waited for start_grace seconds
+    started = time.time()
+    last_sent = started
+    was_running = False
+
+    yield 'retry: 3000\n\n'
+    while time.time() - started < timeout:
+        running = is_running()
+        was_running = was_running or running
+
+        lines, offset = read_log_lines(log_file, offset)
+        for line in lines[:-1]:
+            yield 'data: {}\n\n'.format(line)
+        if lines:
+            yield 'id: {}\ndata: {}\n\n'.format(offset, lines[-1])
+            last_sent = time.time()
+            continue
+
+        if not running and (was_running or time.time() - started >= start_grace):
+            break
+
+        # Comment line keeps connection open, and finds closed ones
+        if time.time() - last_sent >= keepalive:
+            yield ': keepalive\n\n'
+            last_sent = time.time()
+
+        time.sleep(poll_interval)
+
+    yield 'event: end\ndata: {}\n\n'.format(json.dumps({'offset': offset}))
@@ -0,0 +1,64 @@
+import json
+import time
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+
+
+class CachedResult(object):
+    # Serialized response of a result. Failed calculation is cached as well
+    # (negative entry), so it is not retried by every request for a while;
+    # its body is JSON error of the failure
+    def __init__(self, body, last_modified, expires, failed=False):
+        self.body = body
+        self.etag = md5(body).hexdigest()
+        self.last_modified = last_modified
+        self.expires = expires
+        self.failed = failed
+
+    def get_error(self):
+        # Message of failure, None for result
+        if not self.failed:
+            return None
+        return json.loads(self.body).get('message') or 'Calculation failed'
+
+
+class ResultCache(object):
+    # Bounded LRU of serialized results by hashed uri. Entries expire after
+    # ttl seconds, negative entries after negative_ttl seconds
+    def __init__(self, max_entries=1000, ttl=60 * 60, negative_ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry.expires <= time.time():
+                return None
+
+            # Most recently used entry is kept at the end
+            self._entries[key] = entry
+            return entry
+
+    def put(self, key, body, last_modified):
+        return self._put(key, CachedResult(body, last_modified, time.time() + self.ttl))
+
+    def put_failure(self, key, body, last_modified):
+        return self._put(key, CachedResult(body, last_modified, time.time() + self.negative_ttl,
+                                           failed=True))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
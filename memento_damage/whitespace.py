@@ -0,0 +1,92 @@
+import math
+
+import numpy
+
+from memento_damage.screenshot import load_screenshot_pixels
+
+
+class WhitespaceProfile(object):
+    # Number of screenshot rows compared against background color at once,
+    # keeps temporary arrays small on very tall screenshots
+    chunk_rows = 1024
+
+    # screenshot is path of screenshot file (raw or image), or array of its
+    # RGB pixels
+    def __init__(self, screenshot, background_color, window_size=None):
+        self.screenshot = screenshot
+        self.background_color = background_color
+        self.window_size = window_size
+
+        self._column_counts = None
+        self._averages = None
+
+    def column_counts(self):
+        if self._column_counts is None:
+            self._column_counts = self._count_background_columns()
+
+        return self._column_counts
+
+    def averages(self):
+        # Divide width into 3 parts
+        # Justin use term : low, mid, and high for 1/3 left,
+        # 1/3 midlle, and 1/3 right
+        if self._averages is None:
+            whiteguys_col = self.column_counts()
+            window_w = len(whiteguys_col)
+            one_third = int(math.floor(window_w / 3))
+
+            if one_third > 0:
+                left_avg = int(whiteguys_col[0:one_third].sum()) // one_third
+                center_avg = int(whiteguys_col[one_third:2*one_third].sum()) // one_third
+                right_avg = int(whiteguys_col[2*one_third:window_w].sum()) // one_third
+            else:
+                left_avg, center_avg, right_avg = 0, 0, 0
+
+            self._averages = (left_avg, center_avg, right_avg)
+
+        return self._averages
+
+    def _count_background_columns(self):
+        # Code below is a subtitution for Justin's whitespace.pl
+        # Raw screenshot is mapped, others are decoded only once. Compare with
+        # background color per chunk
+        if isinstance(self.screenshot, numpy.ndarray):
+            pixels = self.screenshot
+        else:
+            pixels = load_screenshot_pixels(self.screenshot)
+
+        # Use vieport_size (screenshot size) or given window size (e.g. 1024x768)
+        if self.window_size:
+            window_w, window_h = self.window_size
+        else:
+            window_w, window_h = pixels.shape[1], pixels.shape[0]
+
+        pixels = pixels[:window_h, :window_w]
+        window_h, window_w = pixels.shape[0], pixels.shape[1]
+
+        # Whiteguys is representation of pixels having same color with
+        # background color
+        whiteguys_col = numpy.zeros(window_w, dtype=numpy.int64)
+
+        background = self._hex2rgb(self.background_color)
+        if background is None:
+            return whiteguys_col
+
+        background = numpy.array(background, dtype=numpy.uint8)
+        for y in range(0, window_h, self.chunk_rows):
+            chunk = pixels[y:y + self.chunk_rows]
+            whiteguys_col += (chunk == background).all(axis=2).sum(axis=0)
+
+        return whiteguys_col
+
+    def _hex2rgb(self, hex_color):
+        # Background color reported by crawl.js is a hex string (e.g. FFFFFF),
+        # anything else never matches a pixel
+        hex_color = (hex_color or '').strip().lstrip('#')
+        if len(hex_color) != 6:
+            return None
+
+        try:
+            return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+        except ValueError:
+            return None
@@ -47,9 +47,12 @@ setup(
     packages=packages,
     package_dir=package_dir,
     package_data=package_data,
-    scripts=['memento_damage/cli/memento-damage', 'memento_damage/cli/memento-damage-server'],
+    scripts=['memento_damage/cli/memento-damage', 'memento_damage/cli/memento-damage-server',
+             'memento_damage/cli/memento-damage-batch', 'memento_damage/cli/memento-damage-rescore',
+             'memento_damage/cli/memento-damage-proxy'],
     install_requires=[
         'pillow',
+        'numpy',
         'html2text',
         'flask',
         'Flask-SQLAlchemy'